@@ -60,6 +60,35 @@ USE_TZ = True
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = BASE_DIR + '/ReFlow-data/'
 
+# Optionally let the front-end web server send file downloads, either
+# 'X-Sendfile' (Apache mod_xsendfile) or 'X-Accel-Redirect' (nginx). For
+# nginx, FILE_DOWNLOAD_ACCEL_REDIRECT_URL is an internal location aliased
+# to MEDIA_ROOT.
+FILE_DOWNLOAD_SENDFILE_HEADER = None
+# FILE_DOWNLOAD_ACCEL_REDIRECT_URL = '/protected-data/'
+
+# Files derived from samples (e.g. clean FCS files) are cached here, the
+# least recently used are removed when the cache exceeds the size in bytes.
+# The size is checked at most every DERIVED_FILE_CACHE_EVICT_INTERVAL
+# seconds, or once a tenth of the size has been written.
+DERIVED_FILE_CACHE_DIR = MEDIA_ROOT + 'ReFlow-data/cache/'
+DERIVED_FILE_CACHE_SIZE = 10 * 1024 ** 3
+DERIVED_FILE_CACHE_EVICT_INTERVAL = 300
+
+# Largest file size in bytes accepted for resumable sample uploads, and
+# the hours of inactivity after which an unfinished upload expires. Expired
+# uploads are removed by the delete_expired_sample_uploads command.
+SAMPLE_UPLOAD_MAX_SIZE = 20 * 1024 ** 3
+SAMPLE_UPLOAD_EXPIRY_HOURS = 48
+
+# Times a failed or stale background sample job (see process_sample_jobs)
+# is attempted before it's left in the 'Error' status
+SAMPLE_JOB_MAX_ATTEMPTS = 3
+
+# Most samples in a sample collection archive of clean FCS files, which
+# are all generated before the archive starts streaming
+SAMPLE_COLLECTION_CLEAN_ARCHIVE_MAX_SAMPLES = 50
+
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash.
 # Examples: "http://media.lawrence.com/media/", "http://example.com/media/"
@@ -37,6 +37,7 @@ admin.site.register(SitePanelParameterMarker)
 
 admin.site.register(Sample)
 admin.site.register(SampleMetadata)
+admin.site.register(SampleJob)
 admin.site.register(Compensation)
 
 admin.site.register(SampleCollection)
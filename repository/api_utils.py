@@ -10,10 +10,31 @@ from rest_framework.response import Response
 from rest_framework.views import exception_handler
 from rest_framework.exceptions import NotAuthenticated
 
+from django.conf import settings
 from django.views.generic.detail import SingleObjectMixin
 from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+import errno
+import io
+import os
+import re
+import tarfile
+import time
+import zlib
+
+import numpy as np
 
 from repository import models
+from repository.cache import get_cache_key, find_cached_file, \
+    iter_cached_stream, open_generated_file
+from repository.upload_handlers import FCSUploadHandler
+from repository.utils import FCS_CHUNK_SIZE
+
+# single byte range requests, e.g. 'bytes=0-499', 'bytes=500-', 'bytes=-500'
+RANGE_HEADER_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
 
 
 def custom_exception_handler(exc, context):
@@ -57,6 +78,7 @@ def repository_api_root(request):
         'create_samples': reverse('create-sample', request=request),
         'samples': reverse('sample-list', request=request),
         'sample_metadata': reverse('sample-metadata-list', request=request),
+        'sample_uploads': reverse('sample-upload-list', request=request),
         'sample_collections': reverse(
             'sample-collection-list', request=request),
         'sample_collection_members': reverse(
@@ -102,6 +124,24 @@ class LoginRequiredMixin(object):
     permission_classes = (IsAuthenticated,)
 
 
+class FCSUploadMixin(object):
+    """
+    View mixin to hash & parse uploaded FCS files while they are being
+    received (see FCSUploadHandler). The handler is installed before the
+    request body is parsed, which may happen as early as authentication
+    (e.g. the CSRF check of SessionAuthentication reads the POST data).
+    """
+
+    def initialize_request(self, request, *args, **kwargs):
+        request.upload_handlers.insert(0, FCSUploadHandler(request))
+
+        return super(FCSUploadMixin, self).initialize_request(
+            request,
+            *args,
+            **kwargs
+        )
+
+
 class AdminRequiredMixin(object):
     """
     View mixin to verify a user is an administrator.
@@ -137,3 +177,378 @@ class PermissionRequiredMixin(SingleObjectMixin):
                 raise PermissionDenied
 
         return obj
+
+
+def parse_range_header(range_header, size):
+    """
+    Returns the inclusive (start, end) byte range requested by an HTTP
+    Range header for a file of the given size. None is returned when the
+    header should be ignored (multiple or malformed ranges) and a
+    ValueError is raised if the range can't be satisfied.
+    """
+    match = RANGE_HEADER_REGEX.match(range_header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if start == '':
+        # suffix range, the last N bytes
+        suffix_length = int(end)
+        if suffix_length == 0 or size == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(0, size - suffix_length), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+
+    return start, end
+
+
+def iter_file_range(range_file, start, length):
+    """
+    Yield length bytes of an open file, from offset start, in chunks. The
+    file is closed once done.
+    """
+    with range_file:
+        range_file.seek(start)
+        while length > 0:
+            chunk = range_file.read(min(FCS_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _file_range_response(download_file, range_header):
+    """
+    Returns a response streaming an open file, or the byte range requested
+    by range_header (see parse_range_header)
+    """
+    size = os.fstat(download_file.fileno()).st_size
+    byte_range = None
+
+    if range_header:
+        try:
+            byte_range = parse_range_header(range_header, size)
+        except ValueError:
+            response = HttpResponse(
+                status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+            response['Content-Range'] = 'bytes */%d' % size
+            download_file.close()
+            return response
+
+    if byte_range is None:
+        response = FileResponse(
+            download_file,
+            content_type='application/octet-stream'
+        )
+        response['Content-Length'] = size
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            iter_file_range(download_file, start, end - start + 1),
+            status=status.HTTP_206_PARTIAL_CONTENT,
+            content_type='application/octet-stream'
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+    response['Accept-Ranges'] = 'bytes'
+
+    return response
+
+
+def get_accepted_encoding(request):
+    """
+    Returns the compression ('gzip' or 'deflate') to use for a response,
+    based on the request's Accept-Encoding header, or None
+    """
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[params[0].strip().lower()] = quality
+
+    for encoding in ('gzip', 'deflate'):
+        if qualities.get(encoding, qualities.get('*', 0.0)) > 0:
+            return encoding
+
+    return None
+
+
+def iter_compressed_file(source_file, encoding):
+    """
+    Yields the gzip or deflate (zlib) compressed content of an open file,
+    closing it once done
+    """
+    if encoding == 'gzip':
+        window_bits = 16 + zlib.MAX_WBITS
+    else:
+        window_bits = zlib.MAX_WBITS
+    compressor = zlib.compressobj(6, zlib.DEFLATED, window_bits)
+
+    size = os.fstat(source_file.fileno()).st_size
+    for chunk in iter_file_range(source_file, 0, size):
+        compressed_chunk = compressor.compress(chunk)
+        if compressed_chunk:
+            yield compressed_chunk
+
+    yield compressor.flush()
+
+
+def not_modified_response(request, etag, last_modified=None):
+    """
+    Returns a 304 (or 412) response if the request's conditional headers
+    (If-None-Match, If-Modified-Since, etc.) match the strong ETag and/or
+    Last-Modified timestamp of the resource, otherwise None
+    """
+    response = get_conditional_response(
+        request,
+        etag=quote_etag(etag),
+        last_modified=None if last_modified is None else int(last_modified)
+    )
+    if response is not None:
+        response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+
+    return response
+
+
+def file_download_response(request, path, filename, compress=False,
+                           etag=None):
+    """
+    Returns a response downloading a file within MEDIA_ROOT as an
+    attachment, without reading it into memory. Single byte Range requests
+    get a partial (206) response so clients can resume downloads.
+
+    The etag should identify the file content (e.g. its SHA-1), it's sent
+    as a strong ETag and conditional requests matching it or the file's
+    Last-Modified get a 304 response without the body.
+
+    With compress, the body is gzip or deflate compressed if the client
+    accepts it. Compressed versions are kept in the derived file cache,
+    the first request for one is compressed on the fly while the cache
+    entry is written. Each encoding has its own ETag.
+
+    If the FILE_DOWNLOAD_SENDFILE_HEADER setting is 'X-Sendfile' or
+    'X-Accel-Redirect' the body is left to the front-end server (which
+    can also do any compression). For X-Accel-Redirect,
+    FILE_DOWNLOAD_ACCEL_REDIRECT_URL is the internal location serving
+    MEDIA_ROOT.
+
+    The path may be a function returning the path, for files generated on
+    demand. It isn't called if the request's If-None-Match has the etag
+    (of any encoding), so a client with a current copy doesn't cause the
+    file to be generated. It's called again if the generated file is
+    evicted from the cache before it can be opened.
+    """
+    if callable(path):
+        if etag is not None and request.META.get('HTTP_IF_MATCH') is None:
+            etags = [etag]
+            if compress:
+                etags.extend(['%s-gzip' % etag, '%s-deflate' % etag])
+            for candidate_etag in etags:
+                response = not_modified_response(request, candidate_etag)
+                if response is not None:
+                    if compress:
+                        response['Vary'] = 'Accept-Encoding'
+                    return response
+
+        download_file = open_generated_file(path)
+    else:
+        download_file = open(path, 'rb')
+    path = download_file.name
+
+    stat = os.fstat(download_file.fileno())
+    last_modified = http_date(stat.st_mtime)
+    sendfile_header = getattr(settings, 'FILE_DOWNLOAD_SENDFILE_HEADER', None)
+
+    range_header = None
+    encoding = None
+    compressed_file = None
+    if sendfile_header not in ('X-Accel-Redirect', 'X-Sendfile'):
+        range_header = request.META.get('HTTP_RANGE')
+        if_range = request.META.get('HTTP_IF_RANGE')
+
+        # a stale If-Range means the client's partial copy is out of date
+        if if_range is not None and if_range not in (
+                last_modified,
+                None if etag is None else quote_etag(etag)
+        ):
+            range_header = None
+
+        encoding = get_accepted_encoding(request) if compress else None
+        if encoding is not None:
+            cache_key = get_cache_key(
+                path,
+                stat.st_mtime,
+                stat.st_size,
+                encoding
+            )
+            extension = '.gz' if encoding == 'gzip' else '.zz'
+            compressed_path = find_cached_file(
+                'compressed',
+                cache_key,
+                extension
+            )
+            if compressed_path is not None:
+                try:
+                    compressed_file = open(compressed_path, 'rb')
+                except IOError as e:
+                    # evicted since it was found, compress it again
+                    if e.errno != errno.ENOENT:
+                        raise
+
+            if compressed_file is None and range_header is not None:
+                # ranges need the compressed size, send uncompressed
+                encoding = None
+
+    if etag is not None:
+        if encoding is not None:
+            etag = '%s-%s' % (etag, encoding)
+
+        response = not_modified_response(request, etag, stat.st_mtime)
+        if response is not None:
+            download_file.close()
+            if compressed_file is not None:
+                compressed_file.close()
+            if compress:
+                response['Vary'] = 'Accept-Encoding'
+            return response
+
+    if sendfile_header in ('X-Accel-Redirect', 'X-Sendfile'):
+        # the front-end server opens the file itself
+        download_file.close()
+
+    if sendfile_header == 'X-Accel-Redirect':
+        response = HttpResponse(content_type='application/octet-stream')
+        response['X-Accel-Redirect'] = getattr(
+            settings,
+            'FILE_DOWNLOAD_ACCEL_REDIRECT_URL',
+            settings.MEDIA_URL
+        ) + os.path.relpath(path, settings.MEDIA_ROOT)
+    elif sendfile_header == 'X-Sendfile':
+        response = HttpResponse(content_type='application/octet-stream')
+        response['X-Sendfile'] = path
+    else:
+        if compressed_file is not None:
+            download_file.close()
+            response = _file_range_response(compressed_file, range_header)
+        elif encoding is not None:
+            response = StreamingHttpResponse(
+                iter_cached_stream(
+                    'compressed',
+                    cache_key,
+                    extension,
+                    iter_compressed_file(download_file, encoding)
+                ),
+                content_type='application/octet-stream'
+            )
+        else:
+            response = _file_range_response(download_file, range_header)
+
+        if encoding is not None and response.status_code != \
+                status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE:
+            response['Content-Encoding'] = encoding
+
+        if compress:
+            response['Vary'] = 'Accept-Encoding'
+
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = last_modified
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+
+    return response
+
+
+def npy_download_response(shape, chunks, filename):
+    """
+    Returns a response streaming a little-endian float32 .npy file of the
+    given 2-D shape, from an iterable of arrays holding consecutive rows.
+    Only one chunk of rows is in memory at a time.
+    """
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        header,
+        {'descr': '<f4', 'fortran_order': False, 'shape': tuple(shape)}
+    )
+
+    def iter_npy():
+        yield header.getvalue()
+        for chunk in chunks:
+            yield chunk.astype('<f4').tostring()
+
+    response = StreamingHttpResponse(
+        iter_npy(),
+        content_type='application/octet-stream'
+    )
+    response['Content-Length'] = len(header.getvalue()) + \
+        4 * shape[0] * shape[1]
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+
+    return response
+
+
+def iter_tar(entries):
+    """
+    Yields a tar archive of entries, given as (name, source) pairs, one
+    block at a time. The source is either the content as a string (unicode
+    is UTF-8 encoded) or a callable returning the path of the file, called
+    when the entry is reached so files can be generated lazily (see
+    open_generated_file). Files are read in chunks, so memory use doesn't
+    depend on their size.
+    """
+    for name, source in entries:
+        if callable(source):
+            source_file = open_generated_file(source)
+            size = os.fstat(source_file.fileno()).st_size
+        else:
+            if isinstance(source, unicode):
+                source = source.encode('utf-8')
+            source_file = None
+            size = len(source)
+
+        tar_info = tarfile.TarInfo(name)
+        tar_info.size = size
+        tar_info.mtime = time.time()
+        tar_info.mode = 0644
+        yield tar_info.tobuf(format=tarfile.USTAR_FORMAT)
+
+        if source_file is None:
+            yield source
+        else:
+            for chunk in iter_file_range(source_file, 0, size):
+                yield chunk
+
+        # file content is padded to a whole number of blocks
+        if size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+
+    # end of archive
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+def tar_download_response(entries, filename):
+    """
+    Returns a response streaming a tar archive of entries (see iter_tar),
+    generated as it is sent
+    """
+    response = StreamingHttpResponse(
+        iter_tar(entries),
+        content_type='application/x-tar'
+    )
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+
+    return response
@@ -16,18 +16,29 @@ from django.core.exceptions import PermissionDenied, ObjectDoesNotExist, \
     MultipleObjectsReturned, ValidationError
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
+from django.utils.http import quote_etag
 
 from guardian.models import UserObjectPermission
 from guardian.shortcuts import assign_perm, remove_perm
 
+from collections import Counter
 import datetime
+import json
+import os
 import re
-import io
 
 from repository import models
 from repository import serializers
 from repository import controllers
-from repository.api_utils import LoginRequiredMixin, PermissionRequiredMixin
+from repository.cache import get_cache_key
+from repository.transforms import TRANSFORMS, TRANSFORM_PARAMETERS
+from repository.api_utils import LoginRequiredMixin, FCSUploadMixin, \
+    PermissionRequiredMixin, file_download_response, npy_download_response, \
+    not_modified_response
+from repository.upload_handlers import StagedFile, add_fcs_file, \
+    extract_fcs_archive
+from repository.utils import FCS_CHUNK_SIZE, read_fcs_file, \
+    get_fcs_channels, get_fcs_channel_signature
 
 # Design Note: For any detail view the PermissionRequiredMixin will
 # restrict access to users of that project
@@ -188,18 +199,13 @@ def retrieve_sample(request, pk):
     if not sample.has_view_permission(request.user):
         raise PermissionDenied
 
-    # using BytesIO to make download faster, for some reason
-    # using the sample.sample_file takes ~30 seconds to start 
-    # downloading...maybe a bug in Django?
-    sample_file = io.BytesIO(sample.sample_file.read())
-    sample_file.seek(0)
-
-    response = HttpResponse(
-        sample_file,
-        content_type='application/octet-stream')
-    response['Content-Disposition'] = 'attachment; filename="%s"' \
-        % sample.original_filename
-    return response
+    return file_download_response(
+        request,
+        sample.sample_file.path,
+        sample.original_filename,
+        compress=True,
+        etag=sample.sha1
+    )
 
 
 @api_view(['GET'])
@@ -211,18 +217,12 @@ def retrieve_sample_as_pk(request, pk):
     if not sample.has_view_permission(request.user):
         raise PermissionDenied
 
-    # using BytesIO to make download faster, for some reason
-    # using the sample.sample_file takes ~30 seconds to start 
-    # downloading...maybe a bug in Django?
-    sample_file = io.BytesIO(sample.sample_file.read())
-    sample_file.seek(0)
-
-    response = HttpResponse(
-        sample_file,
-        content_type='application/octet-stream')
-    response['Content-Disposition'] = 'attachment; filename="%s"' \
-        % str(sample.id) + '.fcs'
-    return response
+    return file_download_response(
+        request,
+        sample.sample_file.path,
+        '%d.fcs' % sample.id,
+        etag=sample.sha1
+    )
 
 
 @api_view(['GET'])
@@ -252,15 +252,403 @@ def retrieve_clean_sample(request, pk):
             ]
         )
 
-    clean_file = sample.get_clean_fcs()
-    response = HttpResponse(
-        clean_file,
-        content_type='application/octet-stream')
-    response['Content-Disposition'] = 'attachment; filename="%s"' \
-        % file_name
+    return file_download_response(
+        request,
+        sample.get_clean_fcs_path,
+        file_name,
+        compress=True,
+        etag=sample.get_clean_fcs_key()
+    )
+
+
+@api_view(['GET'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def retrieve_sample_events(request, pk):
+    """
+    Returns a slice of the sample's events as a float32 .npy file, with
+    a row per event and a column per channel. Optional query parameters:
+        channels: comma separated channel numbers (the SitePanelParameter
+                  fcs_number), in the column order wanted. Default is all.
+        start: index of the first event, default 0
+        stop: index after the last event, default is the event count
+    """
+    sample = get_object_or_404(models.Sample, pk=pk)
+
+    if not sample.has_view_permission(request.user):
+        raise PermissionDenied
+
+    metadata = sample.get_fcs_metadata()
+    event_count = int(metadata['tot'])
+    panel_fcs_numbers = sorted(
+        sample.site_panel.sitepanelparameter_set.values_list(
+            'fcs_number',
+            flat=True
+        )
+    )
+
+    try:
+        if 'channels' in request.query_params:
+            fcs_numbers = [
+                int(n) for n in request.query_params['channels'].split(',')
+            ]
+        else:
+            fcs_numbers = panel_fcs_numbers
+        start = int(request.query_params.get('start', 0))
+        stop = min(
+            int(request.query_params.get('stop', event_count)),
+            event_count
+        )
+    except ValueError:
+        return Response(
+            data={'detail': 'channels, start & stop must be integers'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    invalid_numbers = set(fcs_numbers) - set(panel_fcs_numbers)
+    if invalid_numbers:
+        return Response(
+            data={
+                'detail': 'Channels not in site panel: %s' % ', '.join(
+                    [str(n) for n in sorted(invalid_numbers)]
+                )
+            },
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if start < 0 or stop < start:
+        return Response(
+            data={'detail': 'Invalid event range'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    etag = get_cache_key(sample.sha1, fcs_numbers, start, stop)
+    response = not_modified_response(request, etag)
+    if response is not None:
+        return response
+
+    try:
+        chunks = sample.iter_events(fcs_numbers, start, stop)
+    except ValidationError as e:
+        return Response(
+            data={'detail': e.messages[0]},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    response = npy_download_response(
+        (stop - start, len(fcs_numbers)),
+        chunks,
+        '%d_events.npy' % sample.id
+    )
+    response['ETag'] = quote_etag(etag)
+
     return response
 
 
+@api_view(['GET'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def retrieve_sample_subsample(request, pk):
+    """
+    Returns a random subsample of the sample's events as a float64 .npy
+    file, the 1st column is the original event index followed by a column
+    for each channel. Query parameters:
+        count: number of events (required), all events if count exceeds
+               the event count
+        seed: random seed, default 0. The same count & seed always give
+              the same subsample.
+    """
+    sample = get_object_or_404(models.Sample, pk=pk)
+
+    if not sample.has_view_permission(request.user):
+        raise PermissionDenied
+
+    try:
+        subsample_count = int(request.query_params['count'])
+        seed = int(request.query_params.get('seed', 0))
+        if subsample_count < 1 or not 0 <= seed < 2 ** 32:
+            raise ValueError
+    except (KeyError, ValueError):
+        return Response(
+            data={
+                'detail': 'count must be a positive integer & seed an '
+                          'integer between 0 and 2^32 - 1'
+            },
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        return file_download_response(
+            request,
+            lambda: sample.get_subsample_path(subsample_count, seed),
+            '%d_subsample_%d_%d.npy' % (sample.id, subsample_count, seed),
+            etag=get_cache_key(sample.sha1, subsample_count, seed)
+        )
+    except ValidationError as e:
+        return Response(
+            data={'detail': e.messages[0]},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+
+@api_view(['GET'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def retrieve_preprocessed_sample(request, pk):
+    """
+    Returns the sample's events compensated & transformed as a float32
+    .npy file, with a column for every channel in FCS order. Only the
+    compensated channels are transformed. Query parameters:
+        compensation: FrozenCompensation id (required)
+        transform: 'asinh' or 'logicle' (required)
+        asinh parameter: pre_scale (default 0.003)
+        logicle parameters: t (default 262144), m (default 4.5),
+                            w (default 0.5), a (default 0)
+    """
+    sample = get_object_or_404(models.Sample, pk=pk)
+
+    if not sample.has_view_permission(request.user):
+        raise PermissionDenied
+
+    transform = request.query_params.get('transform')
+    if transform not in TRANSFORMS:
+        return Response(
+            data={'detail': 'transform must be one of: %s' % ', '.join(
+                sorted(TRANSFORMS)
+            )},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        compensation = models.FrozenCompensation.objects.get(
+            id=int(request.query_params['compensation'])
+        )
+        params = dict(
+            (name, float(request.query_params.get(name, default)))
+            for name, default in TRANSFORM_PARAMETERS[transform]
+        )
+    except (KeyError, ValueError, ObjectDoesNotExist):
+        return Response(
+            data={
+                'detail': 'compensation must be a frozen compensation id & '
+                          'transform parameters must be numbers'
+            },
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        return file_download_response(
+            request,
+            lambda: sample.get_preprocessed_path(
+                compensation,
+                transform,
+                params
+            ),
+            '%d_%s.npy' % (sample.id, transform),
+            etag=sample.get_preprocessed_key(compensation, transform, params)
+        )
+    except ValidationError as e:
+        return Response(
+            data={'detail': e.messages[0]},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def find_existing_samples(request):
+    """
+    Lets an uploader check a batch of files before sending them. Takes
+    a project ID and a list of SHA-1 hex digests, returns the digests
+    of the FCS files already in the project.
+    """
+    try:
+        project = models.Project.objects.get(id=request.data['project'])
+        sha1_list = [str(sha1).lower() for sha1 in request.data['sha1']]
+    except (KeyError, ValueError, TypeError, ObjectDoesNotExist):
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    user_sites = models.Site.objects.get_sites_user_can_add(
+        request.user,
+        project
+    )
+    if not user_sites.exists():
+        raise PermissionDenied
+
+    # query in batches to stay under database limits on query parameters
+    existing = set()
+    batch_size = 500
+    for i in range(0, len(sha1_list), batch_size):
+        existing.update(
+            models.Sample.objects.filter(
+                subject__project=project,
+                sha1__in=sha1_list[i:i + batch_size]
+            ).values_list('sha1', flat=True)
+        )
+
+    return Response({'existing': sorted(existing)})
+
+
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def find_sample_compensations(request):
+    """
+    Finds the best matching compensation for each of a list of sample IDs
+    in one request: one for the sample's site panel on its acquisition
+    date, else the nearest date, else the spillover in its FCS file.
+    Returns a list with the sample, match type ('exact', 'nearest',
+    'spill' or null), compensation ID & name and matrix CSV text. Samples
+    the user can't view are left out.
+    """
+    try:
+        sample_ids = [int(sample_id) for sample_id in request.data['samples']]
+    except (KeyError, ValueError, TypeError):
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    user_sites = models.Site.objects.get_sites_user_can_view(request.user)
+
+    # query in batches to stay under database limits on query parameters
+    matches = {}
+    batch_size = 500
+    for i in range(0, len(sample_ids), batch_size):
+        matches.update(
+            controllers.find_sample_compensations(
+                models.Sample.objects.filter(
+                    id__in=sample_ids[i:i + batch_size],
+                    site_panel__site__in=user_sites
+                ).values_list('id', 'site_panel_id', 'acquisition_date')
+            )
+        )
+
+    return Response(
+        [
+            dict(sample=sample_id, **matches[sample_id])
+            for sample_id in sample_ids if sample_id in matches
+        ]
+    )
+
+
+@api_view(['GET'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def retrieve_sample_metadata(request, pk):
+    """
+    Returns all the key/value pairs from the sample's FCS TEXT segment
+    """
+    sample = get_object_or_404(models.Sample, pk=pk)
+
+    if not sample.has_view_permission(request.user):
+        raise PermissionDenied
+
+    metadata = sample.get_fcs_metadata()
+
+    return Response(
+        [{'key': k, 'value': metadata[k]} for k in sorted(metadata)]
+    )
+
+
+@api_view(['GET'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def retrieve_sample_statistics(request, pk):
+    """
+    Returns the summary statistics for each of the sample's channels,
+    calculated by the background statistics job (empty until it completes)
+    """
+    sample = get_object_or_404(models.Sample, pk=pk)
+
+    if not sample.has_view_permission(request.user):
+        raise PermissionDenied
+
+    serializer = serializers.SampleChannelStatisticsSerializer(
+        sample.samplechannelstatistics_set.order_by('fcs_number'),
+        many=True
+    )
+
+    return Response(serializer.data)
+
+
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def create_compensations(request):
+    """
+    Import a list of compensations, each with the site_panel,
+    acquisition_date, name & matrix_text fields. Nothing is saved if any
+    are invalid, the response is then a list of errors in the same order
+    as the request (empty for the valid compensations).
+    """
+    if not isinstance(request.data, list) or \
+            not all(isinstance(d, dict) for d in request.data):
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    compensations, errors = controllers.create_compensations(
+        request.data,
+        request.user
+    )
+    if any(errors):
+        return Response(data=errors, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = serializers.CompensationSerializer(
+        compensations,
+        many=True,
+        context={'request': request}
+    )
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def extract_spill_compensations(request):
+    """
+    Create compensations from the spillover matrices in the FCS files of
+    a project's samples (for the sites the user can add to) or a site
+    panel's samples. Takes either a 'project' or a 'site_panel' ID.
+    Returns the number created & the spillovers that couldn't be used.
+    """
+    try:
+        if 'project' in request.data:
+            project = models.Project.objects.get(id=request.data['project'])
+            user_sites = models.Site.objects.get_sites_user_can_add(
+                request.user,
+                project
+            )
+            if not user_sites.exists():
+                raise PermissionDenied
+            samples = models.Sample.objects.filter(
+                subject__project=project,
+                site_panel__site__in=user_sites
+            )
+        else:
+            site_panel = models.SitePanel.objects.get(
+                id=request.data['site_panel']
+            )
+            if not site_panel.site.has_add_permission(request.user):
+                raise PermissionDenied
+            samples = models.Sample.objects.filter(site_panel=site_panel)
+    except (KeyError, ValueError, TypeError, ObjectDoesNotExist):
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    created_count, errors = controllers.extract_spill_compensations(samples)
+
+    return Response(
+        {
+            'created': created_count,
+            'errors': [
+                {
+                    'site_panel': site_panel_id,
+                    'acquisition_date': acquisition_date,
+                    'detail': message
+                }
+                for site_panel_id, acquisition_date, message in errors
+            ]
+        },
+        status=status.HTTP_201_CREATED
+    )
+
+
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, TokenAuthentication))
 @permission_classes((IsAuthenticated,))
@@ -270,11 +658,17 @@ def retrieve_compensation_as_csv(request, pk):
     if not compensation.has_view_permission(request.user):
         raise PermissionDenied
 
+    etag = compensation.get_sha1() + '-csv'
+    response = not_modified_response(request, etag)
+    if response is not None:
+        return response
+
     response = HttpResponse(
         compensation.get_compensation_as_csv(),
         content_type='text/plain')
+    response['ETag'] = quote_etag(etag)
     response['Content-Disposition'] = 'attachment; filename="%s"' \
-        % "comp_" + str(compensation.id) + '.csv'
+        % ('comp_%d.csv' % compensation.id)
     return response
 
 
@@ -306,12 +700,12 @@ def retrieve_compensation_as_numpy(request, pk):
     if not compensation.has_view_permission(request.user):
         raise PermissionDenied
 
-    response = HttpResponse(
-        compensation.compensation_file.file,
-        content_type='application/octet-stream')
-    response['Content-Disposition'] = 'attachment; filename="%s"' \
-        % "comp_" + str(compensation.id) + '.npy'
-    return response
+    return file_download_response(
+        request,
+        compensation.compensation_file.path,
+        'comp_%d.npy' % compensation.id,
+        etag=compensation.get_sha1()
+    )
 
 
 class PermissionFilter(django_filters.FilterSet):
@@ -1343,6 +1737,9 @@ class SitePanelList(LoginRequiredMixin, generics.ListCreateAPIView):
                 )
                 site_panel.save()
 
+                # parameters are saved in bulk, bypassing the signal that
+                # updates the signature on each save, it's updated once below
+                site_panel_params = []
                 for param in data['parameters']:
                     if param['parameter_type'] == 'NUL':
                         param['parameter_value_type'] = 'N'
@@ -1355,20 +1752,50 @@ class SitePanelList(LoginRequiredMixin, generics.ListCreateAPIView):
                     else:
                         param_fluoro = None
 
-                    spp = models.SitePanelParameter.objects.create(
-                        site_panel=site_panel,
-                        parameter_type=param['parameter_type'],
-                        parameter_value_type=param['parameter_value_type'],
-                        fluorochrome=param_fluoro,
-                        fcs_number=param['fcs_number'],
-                        fcs_text=param['fcs_text'],
-                        fcs_opt_text=param['fcs_opt_text']
+                    site_panel_params.append(
+                        models.SitePanelParameter(
+                            site_panel=site_panel,
+                            parameter_type=param['parameter_type'],
+                            parameter_value_type=param['parameter_value_type'],
+                            fluorochrome=param_fluoro,
+                            fcs_number=param['fcs_number'],
+                            fcs_text=param['fcs_text'],
+                            fcs_opt_text=param['fcs_opt_text']
+                        )
                     )
+                models.SitePanelParameter.objects.bulk_create(
+                    site_panel_params
+                )
+
+                # not every database returns the new primary keys, they're
+                # in the same order as the parameters
+                param_ids = site_panel.sitepanelparameter_set.order_by(
+                    'id'
+                ).values_list('id', flat=True)
+                markers = models.Marker.objects.in_bulk(
+                    set(
+                        int(marker) for param in data['parameters']
+                        for marker in param['markers']
+                    )
+                )
+                param_markers = []
+                for param_id, param in zip(param_ids, data['parameters']):
                     for marker in param['markers']:
-                        models.SitePanelParameterMarker.objects.create(
-                            site_panel_parameter=spp,
-                            marker=models.Marker.objects.get(id=marker)
+                        if int(marker) not in markers:
+                            raise models.Marker.DoesNotExist(
+                                "Marker matching query does not exist."
+                            )
+                        param_markers.append(
+                            models.SitePanelParameterMarker(
+                                site_panel_parameter_id=param_id,
+                                marker=markers[int(marker)]
+                            )
                         )
+                models.SitePanelParameterMarker.objects.bulk_create(
+                    param_markers
+                )
+
+                site_panel.update_signature()
         except Exception as e:  # catch any exception to rollback changes
             return Response(data={'detail': e.message}, status=400)
 
@@ -1401,6 +1828,48 @@ class SitePanelDetail(
         return super(SitePanelDetail, self).delete(request, *args, **kwargs)
 
 
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def find_matching_site_panels(request):
+    """
+    Takes a project ID and an FCS file in 'fcs_file', returns the project
+    site panels whose parameters match the file's channels. Only the HEADER
+    and TEXT segments are needed, so clients can send just the beginning
+    of the file.
+    """
+    try:
+        project = models.Project.objects.get(id=request.data['project'])
+        fcs_reader = read_fcs_file(request.data['fcs_file'])
+        signature = get_fcs_channel_signature(
+            get_fcs_channels(fcs_reader.metadata)
+        )
+    except (KeyError, ValueError, TypeError, ObjectDoesNotExist):
+        return Response(
+            data={'detail': 'A project and FCS file are required'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    user_sites = models.Site.objects.get_sites_user_can_view(
+        request.user,
+        project
+    )
+
+    # site panels created before signatures existed get theirs from the
+    # update_site_panel_signatures command
+    site_panels = models.SitePanel.objects.filter(
+        site__in=user_sites,
+        signature=signature
+    )
+    serializer = serializers.SitePanelSerializer(
+        site_panels,
+        many=True,
+        context={'request': request}
+    )
+
+    return Response(serializer.data)
+
+
 class MarkerList(LoginRequiredMixin, generics.ListCreateAPIView):
     """
     API endpoint representing a list of markers.
@@ -1662,7 +2131,10 @@ class StimulationDetail(
         return super(StimulationDetail, self).delete(request, *args, **kwargs)
 
 
-class CreateSample(LoginRequiredMixin, generics.CreateAPIView):
+class CreateSample(
+        LoginRequiredMixin,
+        FCSUploadMixin,
+        generics.CreateAPIView):
     """
     API endpoint for creating a new Sample.
     """
@@ -1675,31 +2147,17 @@ class CreateSample(LoginRequiredMixin, generics.CreateAPIView):
         Override create b/c we need to call Sample.clean() and DRF create
         doesn't call the model's clean method
         """
-
         site_panel = models.SitePanel.objects.get(id=request.data['site_panel'])
         site = models.Site.objects.get(id=site_panel.site_id)
         if not site.has_add_permission(request.user):
             raise PermissionDenied
 
         try:
-            with transaction.atomic():
-                sample = models.Sample(
-                    acquisition_date=datetime.datetime.strptime(
-                        request.data['acquisition_date'],
-                        "%Y-%m-%d"
-                    ).date(),
-                    subject_id=request.data['subject'],
-                    visit_id=request.data['visit'],
-                    panel_variant_id=request.data['panel_variant'],
-                    site_panel_id=request.data['site_panel'],
-                    pretreatment=request.data['pretreatment'],
-                    storage=request.data['storage'],
-                    specimen_id=request.data['specimen'],
-                    stimulation_id=request.data['stimulation'],
-                    sample_file=request.data['sample_file']
-                )
-                sample.clean()
-                sample.save()
+            sample = controllers.create_sample(
+                request.data,
+                request.data['sample_file'],
+                site_panel=site_panel
+            )
         except Exception as e:  # catch any exception to rollback changes
             return Response(data={'detail': e.message}, status=400)
 
@@ -1716,6 +2174,328 @@ class CreateSample(LoginRequiredMixin, generics.CreateAPIView):
         )
 
 
+class CreateSampleBatch(
+        LoginRequiredMixin,
+        FCSUploadMixin,
+        generics.CreateAPIView):
+    """
+    API endpoint for creating many Samples in a single request.
+
+    The POST is multipart, with a 'manifest' field containing a JSON list
+    of the Sample annotations for each file, each including the 'filename'
+    of its FCS file. The FCS files are either sent as any number of file
+    fields, or as a single tar or zip file in the 'archive' field.
+
+    Each file is created in its own transaction, the response has the
+    result for every file in the manifest. File names must be unique in
+    both the manifest & the upload, duplicates are reported per file.
+    """
+
+    model = models.Sample
+    serializer_class = serializers.SamplePOSTSerializer
+
+    def create(self, request, *args, **kwargs):
+        try:
+            manifest = json.loads(request.data['manifest'])
+            filename_counts = Counter([m['filename'] for m in manifest])
+        except (KeyError, ValueError, TypeError):
+            return Response(
+                data={'detail': 'A valid JSON manifest is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            if 'archive' in request.FILES:
+                sample_files = extract_fcs_archive(request.FILES['archive'])
+            else:
+                sample_files = {}
+                for field in request.FILES:
+                    for f in request.FILES.getlist(field):
+                        add_fcs_file(sample_files, f)
+        except Exception:
+            return Response(
+                data={'detail': 'Archive could not be read'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # resolve the site panels & check add permission once per site,
+        # invalid site panel IDs are reported per file below
+        site_panel_ids = set()
+        for annotations in manifest:
+            try:
+                site_panel_ids.add(int(annotations['site_panel']))
+            except (KeyError, ValueError, TypeError):
+                pass
+        site_panels = models.SitePanel.objects.select_related('site').in_bulk(
+            site_panel_ids
+        )
+        site_permissions = {}
+        for site_panel in site_panels.values():
+            if site_panel.site_id not in site_permissions:
+                site_permissions[site_panel.site_id] = \
+                    site_panel.site.has_add_permission(request.user)
+
+        results = []
+        for annotations in manifest:
+            result = {'filename': annotations['filename']}
+            results.append(result)
+
+            if filename_counts[annotations['filename']] > 1:
+                result['detail'] = 'Duplicate file name in manifest'
+                continue
+
+            try:
+                site_panel = site_panels[int(annotations['site_panel'])]
+            except (KeyError, ValueError, TypeError):
+                result['detail'] = 'Site panel does not exist'
+                continue
+
+            if not site_permissions[site_panel.site_id]:
+                result['detail'] = 'You do not have add permission for site'
+                continue
+
+            if annotations['filename'] not in sample_files:
+                result['detail'] = 'File not found in upload'
+                continue
+
+            if sample_files[annotations['filename']] is None:
+                result['detail'] = 'Duplicate file name in upload'
+                continue
+
+            try:
+                sample = controllers.create_sample(
+                    annotations,
+                    sample_files[annotations['filename']],
+                    site_panel=site_panel
+                )
+            except Exception as e:
+                result['detail'] = e.message
+                continue
+
+            result['sample'] = serializers.SamplePOSTSerializer(
+                sample,
+                context={'request': request}
+            ).data
+
+        # remove any files in the upload without unique annotations
+        for filename, sample_file in sample_files.items():
+            if filename_counts[filename] != 1 and sample_file is not None:
+                sample_file.close()
+
+        if all(['sample' in r for r in results]):
+            response_status = status.HTTP_201_CREATED
+        else:
+            response_status = status.HTTP_207_MULTI_STATUS
+
+        return Response(results, status=response_status)
+
+
+class SampleUploadList(LoginRequiredMixin, generics.ListCreateAPIView):
+    """
+    API endpoint for listing the requesting user's unfinished resumable
+    uploads and for starting a new one.
+    """
+
+    model = models.SampleUpload
+    serializer_class = serializers.SampleUploadSerializer
+
+    def get_queryset(self):
+        return models.SampleUpload.objects.filter(
+            user=self.request.user,
+            modified_date__gte=models.SampleUpload.get_expiry_cutoff()
+        )
+
+    def create(self, request, *args, **kwargs):
+        """
+        Override create to take the file name & size along with the Sample
+        annotations, and to verify the user can add samples to the site
+        """
+        try:
+            annotations = dict(
+                [
+                    (field, request.data[field])
+                    for field in controllers.SAMPLE_ANNOTATION_FIELDS
+                ]
+            )
+            site_panel = models.SitePanel.objects.get(
+                id=annotations['site_panel']
+            )
+            filename = os.path.basename(request.data['filename'])
+            file_size = int(request.data['file_size'])
+        except (KeyError, ValueError, TypeError, ObjectDoesNotExist):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if not site_panel.site.has_add_permission(request.user):
+            raise PermissionDenied
+
+        if file_size <= 0 or not filename:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if file_size > models.SampleUpload.get_max_file_size():
+            return Response(
+                data={
+                    'detail': 'file_size exceeds the maximum of %d bytes' %
+                    models.SampleUpload.get_max_file_size()
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        upload = models.SampleUpload(
+            user=request.user,
+            filename=filename,
+            file_size=file_size,
+            annotations=json.dumps(annotations)
+        )
+        upload.save()
+
+        serializer = self.get_serializer(upload)
+        headers = self.get_success_headers(serializer.data)
+        return Response(
+            serializer.data,
+            status=status.HTTP_201_CREATED,
+            headers=headers
+        )
+
+
+class SampleUploadDetail(LoginRequiredMixin, generics.RetrieveDestroyAPIView):
+    """
+    API endpoint for a single resumable upload. GET reports the byte ranges
+    received so far, PUT receives a chunk and DELETE abandons the upload.
+    """
+
+    model = models.SampleUpload
+    serializer_class = serializers.SampleUploadSerializer
+
+    def get_queryset(self):
+        return models.SampleUpload.objects.filter(
+            user=self.request.user,
+            modified_date__gte=models.SampleUpload.get_expiry_cutoff()
+        )
+
+    def put(self, request, *args, **kwargs):
+        """
+        The request body is the raw chunk, its position in the file given
+        by the Content-Range header, e.g. 'bytes 0-1048575/4194304'
+        """
+        upload = self.get_object()
+
+        match = re.match(
+            r'^bytes (\d+)-(\d+)/(\d+|\*)$',
+            request.META.get('HTTP_CONTENT_RANGE', '')
+        )
+        if match is None:
+            return Response(
+                data={'detail': 'Content-Range header is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if match.group(3) != '*' and int(match.group(3)) != upload.file_size:
+            return Response(
+                data={
+                    'detail': 'Content-Range total does not match the upload '
+                              'file_size'
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        start = int(match.group(1))
+        end = int(match.group(2))
+        if end < start or end >= upload.file_size:
+            return Response(
+                status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+
+        # write straight from the request stream into the staging file
+        chunk_length = end - start + 1
+        bytes_written = 0
+        stream = request.stream
+        with open(upload.staging_path, 'r+b') as staging_file:
+            staging_file.seek(start)
+            while stream is not None and bytes_written < chunk_length:
+                chunk = stream.read(
+                    min(FCS_CHUNK_SIZE, chunk_length - bytes_written)
+                )
+                if not chunk:
+                    break
+                staging_file.write(chunk)
+                bytes_written += len(chunk)
+
+        if bytes_written != chunk_length:
+            return Response(
+                data={'detail': 'Chunk length does not match Content-Range'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # chunks may arrive concurrently, so lock the row to add the range
+        with transaction.atomic():
+            upload = models.SampleUpload.objects.select_for_update().get(
+                id=upload.id
+            )
+            upload.add_received_range(start, end)
+            upload.save()
+
+        return Response(self.get_serializer(upload).data)
+
+    def patch(self, request, *args, **kwargs):
+        return Response(status=status.HTTP_501_NOT_IMPLEMENTED)
+
+
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def finalize_sample_upload(request, pk):
+    """
+    Creates the Sample from a completely received upload, running the same
+    validation as CreateSample. The staged file is moved into place.
+    """
+    upload = get_object_or_404(
+        models.SampleUpload,
+        pk=pk,
+        user=request.user,
+        modified_date__gte=models.SampleUpload.get_expiry_cutoff()
+    )
+
+    if not upload.is_complete():
+        return Response(
+            data={'detail': 'Upload is incomplete'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    annotations = json.loads(upload.annotations)
+    site_panel = get_object_or_404(
+        models.SitePanel,
+        pk=annotations['site_panel']
+    )
+    if not site_panel.site.has_add_permission(request.user):
+        raise PermissionDenied
+
+    sample_file = StagedFile(
+        open(upload.staging_path, 'rb'),
+        name=upload.filename
+    )
+    try:
+        sample = controllers.create_sample(
+            annotations,
+            sample_file,
+            site_panel=site_panel
+        )
+    except Exception as e:
+        # duplicate files get removed during validation, nothing to retry
+        if not os.path.exists(upload.staging_path):
+            upload.delete()
+        return Response(data={'detail': e.message}, status=400)
+    finally:
+        sample_file.close()
+
+    upload.delete()
+
+    serializer = serializers.SamplePOSTSerializer(
+        sample,
+        context={'request': request}
+    )
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
 class SampleFilter(django_filters.FilterSet):
     panel = django_filters.ModelMultipleChoiceFilter(
         queryset=models.PanelTemplate.objects.all(),
@@ -1776,7 +2556,7 @@ class SampleList(LoginRequiredMixin, generics.ListAPIView):
         queryset = models.Sample.objects.filter(
             site_panel__site__in=user_sites)
 
-        return queryset
+        return models.Sample.annotate_compensation_exists(queryset)
 
 
 class SampleDetail(
@@ -1882,15 +2662,6 @@ class CompensationList(LoginRequiredMixin, generics.ListCreateAPIView):
         Override create to verify user has permission to add data to the site
         & call the Compensation model's clean method
         """
-        matrix_text = request.data['matrix_text'].splitlines(False)
-        if not len(matrix_text) > 1:
-            raise ValidationError("Too few rows.")
-
-        # first row should be headers matching the PnN value (fcs_text field)
-        # may be tab or comma delimited
-        # (spaces can't be delimiters b/c they are allowed in the PnN value)
-        pnn_list = re.split('\t|,\s*', matrix_text[0])
-
         try:
             site_panel_candidate = models.SitePanel.objects.get(
                 id=request.data['site_panel']
@@ -1899,15 +2670,10 @@ class CompensationList(LoginRequiredMixin, generics.ListCreateAPIView):
             if not site_panel_candidate.site.has_add_permission(request.user):
                 raise PermissionDenied
 
-            is_match = controllers.matches_site_panel_colors(
-                pnn_list,
-                site_panel_candidate
-            )
-            if not is_match:
-                raise Exception("Compensation header doesn't match site panel")
-
+            # the matrix header is checked against the site panel's
+            # fluoro parameters by clean()
             comp = models.Compensation(
-                site_panel_id=request.data['site_panel'],
+                site_panel=site_panel_candidate,
                 acquisition_date=datetime.datetime.strptime(
                     request.data['acquisition_date'],
                     "%Y-%m-%d"
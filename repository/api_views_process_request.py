@@ -15,10 +15,13 @@ from django.core.exceptions import PermissionDenied, ObjectDoesNotExist, \
     ValidationError
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
+from django.conf import settings
 from django.core.files import File
 
 import numpy as np
 import datetime
+import json
+import os
 from tempfile import TemporaryFile
 from string import join
 import hashlib
@@ -26,7 +29,8 @@ import hashlib
 from repository import models
 from repository import serializers
 from repository.api_utils import LoginRequiredMixin, PermissionRequiredMixin, \
-    AdminRequiredMixin
+    AdminRequiredMixin, file_download_response, tar_download_response
+from repository.utils import get_file_sha1
 
 
 @api_view(['GET'])
@@ -38,12 +42,13 @@ def retrieve_sample_cluster_events(request, pk):
     if not sample_cluster.has_view_permission(request.user):
         raise PermissionDenied
 
-    response = HttpResponse(
-        sample_cluster.events.file,
-        content_type='application/octet-stream')
-    response['Content-Disposition'] = 'attachment; filename=%s' \
-        % "sc_" + str(sample_cluster.id) + '.csv'
-    return response
+    return file_download_response(
+        request,
+        sample_cluster.events.path,
+        'sc_%d.csv' % sample_cluster.id,
+        compress=True,
+        etag=sample_cluster.get_events_sha1()
+    )
 
 
 class SubprocessCategoryFilter(django_filters.FilterSet):
@@ -338,37 +343,271 @@ class SampleCollectionMemberList(
 
     def create(self, request, *args, **kwargs):
         """
-        Override create to get serializer w/ many=True.
-
-        This API handles a POST containing a list of sample collection members
-        to reduce the HTTP chatter.
+        Override create to take a list of members, to reduce the HTTP
+        chatter. Each member has a sample_collection, a sample & either the
+        compensation matrix text or a compensation_id (a Compensation to
+        freeze). Matrices are frozen & members created with a handful of
+        queries, however many members there are. Nothing is created if
+        any member is invalid, the response is then a list of errors in
+        the same order as the request (empty for the valid members).
         """
         data = request.data
 
-        if not isinstance(data, list):
+        if not isinstance(data, list) or \
+                not all(isinstance(d, dict) for d in data):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        # check the comp matrix text, see if one already exists and use
-        # that FrozenCompensation id, if not create a new one
+        def get_ids(key):
+            ids = set()
+            for d in data:
+                try:
+                    ids.add(int(d[key]))
+                except (KeyError, TypeError, ValueError):
+                    pass
+            return ids
+
+        collections = models.SampleCollection.objects.in_bulk(
+            get_ids('sample_collection')
+        )
+        sample_ids = set(
+            models.Sample.objects.filter(
+                id__in=get_ids('sample')
+            ).values_list('id', flat=True)
+        )
+        compensations = models.Compensation.objects.select_related(
+            'site_panel__site__project'
+        ).in_bulk(get_ids('compensation_id'))
+        existing_members = set(
+            models.SampleCollectionMember.objects.filter(
+                sample_collection__in=collections.keys(),
+                sample__in=sample_ids
+            ).values_list('sample_collection_id', 'sample_id')
+        )
+
+        members = []
+        matrix_texts = []
+        compensation_texts = {}
+        errors = []
         for d in data:
             try:
-                # find any matching matrices by SHA-1
-                sha1 = hashlib.sha1(d['compensation']).hexdigest()
-                comp = models.FrozenCompensation.objects.get(sha1=sha1)
-            except ObjectDoesNotExist:
-                comp = models.FrozenCompensation(matrix_text=d['compensation'])
-                comp.save()
+                collection_id = int(d['sample_collection'])
+                sample_id = int(d['sample'])
+                if collection_id not in collections:
+                    raise ValidationError("Invalid sample_collection")
+                if sample_id not in sample_ids:
+                    raise ValidationError("Invalid sample")
+            except (KeyError, TypeError, ValueError):
+                errors.append(
+                    {'detail': 'sample_collection & sample are required'}
+                )
+                continue
+            except ValidationError as e:
+                errors.append({'detail': e.messages[0]})
+                continue
 
-            d['compensation'] = comp.id
+            if (collection_id, sample_id) in existing_members:
+                errors.append(
+                    {'detail': 'Sample is already in the sample collection'}
+                )
+                continue
+
+            if 'compensation_id' in d:
+                try:
+                    compensation = compensations.get(int(d['compensation_id']))
+                except (TypeError, ValueError):
+                    compensation = None
+                if compensation is None or \
+                        not compensation.has_view_permission(request.user):
+                    errors.append({'detail': 'Invalid compensation_id'})
+                    continue
+                if compensation.id not in compensation_texts:
+                    compensation_texts[compensation.id] = \
+                        compensation.get_compensation_as_csv().getvalue()
+                matrix_text = compensation_texts[compensation.id]
+            elif isinstance(d.get('compensation'), basestring):
+                matrix_text = d['compensation']
+            else:
+                errors.append(
+                    {'detail': 'compensation or compensation_id is required'}
+                )
+                continue
 
-        serializer = self.get_serializer(data=data, many=True)
-        if serializer.is_valid():
-            serializer.save()
-            headers = self.get_success_headers(serializer.data)
-            return Response(serializer.data, status=status.HTTP_201_CREATED,
-                            headers=headers)
+            existing_members.add((collection_id, sample_id))
+            members.append(
+                models.SampleCollectionMember(
+                    sample_collection_id=collection_id,
+                    sample_id=sample_id
+                )
+            )
+            matrix_texts.append(matrix_text)
+            errors.append({})
+
+        if any(errors):
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            # check the comp matrix text, see if one already exists and use
+            # that FrozenCompensation id, if not create a new one
+            frozen_ids = models.FrozenCompensation.freeze(matrix_texts)
+            for member, matrix_text in zip(members, matrix_texts):
+                member.compensation_id = frozen_ids[
+                    hashlib.sha1(matrix_text).hexdigest()
+                ]
+
+            models.SampleCollectionMember.objects.bulk_create(members)
+
+        # not every database returns the new primary keys
+        new_members = set(
+            (member.sample_collection_id, member.sample_id)
+            for member in members
+        )
+        members = models.SampleCollectionMember.objects.select_related(
+            'sample'
+        ).filter(
+            sample_collection__in=set(c for c, s in new_members),
+            sample__in=set(s for c, s in new_members)
+        ).order_by('id')
+        serializer = self.get_serializer(
+            [
+                member for member in members
+                if (member.sample_collection_id, member.sample_id)
+                in new_members
+            ],
+            many=True
+        )
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET'])
+@authentication_classes((SessionAuthentication, TokenAuthentication))
+@permission_classes((IsAuthenticated,))
+def retrieve_sample_collection_archive(request, pk):
+    """
+    Returns a tar archive of everything needed to process a sample
+    collection, streamed as it is generated:
+        manifest.json: the members, w/ their sample's annotations & the
+                       archive paths of its FCS file & compensation
+        samples/: an FCS file per member sample, the clean versions if
+                  the 'clean' query parameter is 'true'
+        compensations/: the frozen compensation matrix text files
+
+    Clean files are generated one after another before the archive starts,
+    so clean archives are limited to
+    SAMPLE_COLLECTION_CLEAN_ARCHIVE_MAX_SAMPLES samples.
+    """
+    collection = get_object_or_404(models.SampleCollection, pk=pk)
+
+    if not collection.has_view_permission(request.user):
+        raise PermissionDenied
+
+    clean = request.query_params.get('clean', '').lower() == 'true'
+
+    members = collection.samplecollectionmember_set.select_related(
+        'sample',
+        'sample__subject',
+        'sample__visit',
+        'sample__specimen',
+        'sample__stimulation',
+        'compensation'
+    ).order_by('id')
+
+    manifest = []
+    sample_entries = []
+    compensation_entries = {}
+    for member in members:
+        compensation_name = 'compensations/%d.txt' % member.compensation_id
+        compensation_entries[compensation_name] = \
+            member.compensation.matrix_text
+
+        member_manifest = {
+            'id': member.id,
+            'sample': member.sample_id,
+            'compensation': member.compensation_id,
+            'compensation_file': compensation_name
+        }
+        manifest.append(member_manifest)
+
+        sample = member.sample
+        if sample is None:
+            # the sample has been deleted since the collection was created
+            continue
+
+        if clean:
+            sample_name = 'samples/%d_clean.fcs' % sample.id
+            sample_path = sample.get_clean_fcs_path
+        else:
+            sample_name = 'samples/%d.fcs' % sample.id
+            sample_path = lambda s=sample: s.sample_file.path
+        sample_entries.append((sample_name, sample_path))
+
+        member_manifest.update(
+            {
+                'sample_file': sample_name,
+                'original_filename': sample.original_filename,
+                'sha1': sample.sha1,
+                'event_count': sample.event_count,
+                'subject': sample.subject_id,
+                'subject_code': sample.subject.subject_code,
+                'visit': sample.visit_id,
+                'visit_name': sample.visit.visit_type_name,
+                'specimen': sample.specimen_id,
+                'specimen_name': sample.specimen.specimen_name,
+                'stimulation': sample.stimulation_id,
+                'stimulation_name': sample.stimulation.stimulation_name,
+                'pretreatment': sample.pretreatment,
+                'storage': sample.storage,
+                'site_panel': sample.site_panel_id,
+                'acquisition_date': sample.acquisition_date.isoformat()
+            }
+        )
+
+    max_clean_samples = getattr(
+        settings,
+        'SAMPLE_COLLECTION_CLEAN_ARCHIVE_MAX_SAMPLES',
+        50
+    )
+    if clean and len(sample_entries) > max_clean_samples:
+        return Response(
+            data={
+                'detail': 'Clean archives are limited to %d samples' %
+                max_clean_samples
+            },
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    # find (or generate) every file before the response starts, a failure
+    # while streaming would leave a truncated archive after a 200 response
+    try:
+        for sample_name, sample_path in sample_entries:
+            os.stat(sample_path())
+    except ValidationError as e:
+        return Response(
+            data={'detail': '%s: %s' % (sample_name, e.messages[0])},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    except (OSError, IOError):
+        return Response(
+            data={'detail': '%s: file could not be read' % sample_name},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+    entries = [
+        (
+            'manifest.json',
+            json.dumps(
+                {'sample_collection': collection.id, 'members': manifest},
+                indent=2
+            )
+        )
+    ]
+    entries.extend(sorted(compensation_entries.items()))
+    entries.extend(sample_entries)
+
+    return tar_download_response(
+        entries,
+        'sample_collection_%d.tar' % collection.id
+    )
 
 
 class SampleCollectionList(LoginRequiredMixin, generics.ListCreateAPIView):
@@ -1069,6 +1308,7 @@ class SampleClusterList(
                     fmt='%s',
                     delimiter=','
                 )
+                sample_cluster.events_sha1 = get_file_sha1(events_file)
                 sample_cluster.events.save(
                     join([str(sample.id), 'csv'], '.'),
                     File(events_file),
@@ -0,0 +1,232 @@
+"""
+An on-disk cache for files derived from samples (e.g. clean FCS files).
+Entries are content-addressed, the key is a hash of everything the file
+is generated from, so a changed input simply means a new key and the
+stale entry ages out. The least recently used entries are evicted when
+the cache grows past DERIVED_FILE_CACHE_SIZE bytes. Finding the entries
+means walking the whole cache, so that's only done every
+DERIVED_FILE_CACHE_EVICT_INTERVAL seconds (by any process), or sooner
+once a process has written a tenth of the cache size.
+
+The cache lives in MEDIA_ROOT by default so cached files can be served
+by the front-end server like any other stored file.
+"""
+
+from django.conf import settings
+
+import errno
+import hashlib
+import os
+import tempfile
+import time
+
+# bytes written to the cache by this process since it last evicted
+_written_size = 0
+
+
+def get_cache_root():
+    return getattr(
+        settings,
+        'DERIVED_FILE_CACHE_DIR',
+        os.path.join(settings.MEDIA_ROOT, 'ReFlow-data', 'cache')
+    )
+
+
+def get_cache_key(*values):
+    """ Returns a hex digest identifying the given strings, in order """
+    cache_key = hashlib.sha1()
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        cache_key.update(str(value))
+        cache_key.update('\x1e')
+
+    return cache_key.hexdigest()
+
+
+def get_cache_path(category, key, extension):
+    """
+    Entries are grouped in sub-directories by category & the first 2
+    characters of the key, to keep directories small
+    """
+    return os.path.join(
+        get_cache_root(),
+        category,
+        key[:2],
+        key + extension
+    )
+
+
+def find_cached_file(category, key, extension):
+    """ Returns the path of a cached file, or None if it isn't cached """
+    path = get_cache_path(category, key, extension)
+
+    try:
+        # mark as recently used for eviction, via the access time so the
+        # modification time (i.e. Last-Modified) stays put
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        # not cached, or evicted in the meantime
+        return None
+
+    return path
+
+
+def _create_temp_file(path):
+    """
+    Returns an open temporary file & its path, in the directory of the
+    cache entry path. Temporary files are named so they're skipped by
+    eviction.
+    """
+    cache_dir = os.path.dirname(path)
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created by a concurrent request
+            pass
+
+    temp_fd, temp_path = tempfile.mkstemp(
+        dir=cache_dir,
+        prefix='.',
+        suffix='.tmp'
+    )
+
+    return os.fdopen(temp_fd, 'w+b'), temp_path
+
+
+def _evict(written_size):
+    """
+    Evict entries if it's due, after writing an entry of written_size
+    bytes. The last eviction time is the modification time of a marker
+    file in the cache root, shared by every process using the cache.
+    """
+    global _written_size
+    _written_size += written_size
+
+    size_limit = getattr(settings, 'DERIVED_FILE_CACHE_SIZE', 10 * 1024 ** 3)
+    marker_path = os.path.join(get_cache_root(), '.evicted')
+    try:
+        evicted_time = os.stat(marker_path).st_mtime
+    except OSError:
+        evicted_time = 0
+
+    if time.time() - evicted_time < getattr(
+            settings,
+            'DERIVED_FILE_CACHE_EVICT_INTERVAL',
+            300
+    ) and _written_size < size_limit / 10:
+        return
+
+    # mark first, so other processes don't start evicting too
+    _written_size = 0
+    with open(marker_path, 'a'):
+        os.utime(marker_path, None)
+
+    evict_cached_files(size_limit)
+
+
+def get_cached_file(category, key, extension, generate):
+    """
+    Returns the path of a cached file, first creating it if necessary by
+    calling generate with a file object to write to. The new file is only
+    moved into place once complete, so concurrent requests never see a
+    partial file (at worst both generate it).
+    """
+    path = find_cached_file(category, key, extension)
+    if path is not None:
+        return path
+
+    path = get_cache_path(category, key, extension)
+    temp_file, temp_path = _create_temp_file(path)
+    try:
+        generate(temp_file)
+        written_size = temp_file.tell()
+        temp_file.close()
+        os.rename(temp_path, path)
+    except:
+        temp_file.close()
+        os.unlink(temp_path)
+        raise
+
+    _evict(written_size)
+
+    return path
+
+
+def open_generated_file(get_path):
+    """
+    Returns the file at the path returned by get_path (e.g. a function
+    returning a cache entry via get_cached_file), opened for reading. If
+    the file is evicted by another process before it's opened, get_path is
+    called again so the file is generated again.
+    """
+    try:
+        return open(get_path(), 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    return open(get_path(), 'rb')
+
+
+def iter_cached_stream(category, key, extension, chunks):
+    """
+    Yields the chunks of a generated file (e.g. while they are sent in a
+    response) while also saving them as a cache entry. The entry is only
+    moved into place if every chunk is consumed, a partially consumed
+    stream (e.g. the client disconnected) leaves nothing in the cache.
+    """
+    path = get_cache_path(category, key, extension)
+    temp_file, temp_path = _create_temp_file(path)
+
+    complete = False
+    written_size = 0
+    try:
+        for chunk in chunks:
+            temp_file.write(chunk)
+            written_size += len(chunk)
+            yield chunk
+        complete = True
+    finally:
+        temp_file.close()
+        if complete:
+            os.rename(temp_path, path)
+        else:
+            os.unlink(temp_path)
+
+    _evict(written_size)
+
+
+def evict_cached_files(size_limit):
+    """
+    Delete the least recently used cache entries until the cache is no
+    larger than size_limit bytes. Returns the number of bytes freed.
+    """
+    entries = []
+    total_size = 0
+    for dir_path, dir_names, file_names in os.walk(get_cache_root()):
+        for file_name in file_names:
+            if file_name.startswith('.'):
+                # an entry still being generated
+                continue
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+            total_size += stat.st_size
+
+    freed_size = 0
+    entries.sort()
+    for atime, size, path in entries:
+        if total_size - freed_size <= size_limit:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        freed_size += size
+
+    return freed_size
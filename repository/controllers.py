@@ -1,7 +1,452 @@
-from django.core.exceptions import ObjectDoesNotExist
-
-from models import Project, PanelTemplate, Site, Marker, Fluorochrome
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied, \
+    ValidationError
+from django.db import transaction
+
+from models import Project, PanelTemplate, Site, Marker, Fluorochrome, \
+    Sample, SampleMetadata, SitePanel, Compensation
+from utils import parse_compensation_matrix, parse_fcs_spill, \
+    format_compensation_csv, get_file_sha1
+from jobs import enqueue_sample_jobs
 from collections import Counter
+import bisect
+import datetime
+import io
+
+import numpy as np
+
+# annotation fields required to create a Sample, in addition to the file
+SAMPLE_ANNOTATION_FIELDS = (
+    'acquisition_date',
+    'subject',
+    'visit',
+    'panel_variant',
+    'site_panel',
+    'pretreatment',
+    'storage',
+    'specimen',
+    'stimulation'
+)
+
+
+def create_sample(data, sample_file, site_panel=None):
+    """
+    Create, validate and save a new Sample from the annotation fields in
+    data (see SAMPLE_ANNOTATION_FIELDS) and the given FCS file. Everything
+    is done in a transaction, any exception means nothing was saved.
+    Background jobs (e.g. statistics) are queued for the new sample, heavy
+    work on the events is left to the job runner.
+
+    An already fetched site_panel can be given to avoid re-querying it
+    when creating many samples for the same site panel.
+    """
+    with transaction.atomic():
+        sample = Sample(
+            acquisition_date=datetime.datetime.strptime(
+                data['acquisition_date'],
+                "%Y-%m-%d"
+            ).date(),
+            subject_id=data['subject'],
+            visit_id=data['visit'],
+            panel_variant_id=data['panel_variant'],
+            site_panel_id=data['site_panel'],
+            pretreatment=data['pretreatment'],
+            storage=data['storage'],
+            specimen_id=data['specimen'],
+            stimulation_id=data['stimulation'],
+            sample_file=sample_file
+        )
+        if site_panel is not None:
+            sample.site_panel = site_panel
+
+        sample.clean()
+        sample.save()
+        enqueue_sample_jobs([sample])
+
+    return sample
+
+
+def _bulk_create_compensations(compensations, np_arrays):
+    """
+    Save the compensation files & create the compensations in one query,
+    deleting the files again if that fails
+    """
+    try:
+        for compensation, np_array in zip(compensations, np_arrays):
+            compensation.set_compensation_array(np_array)
+
+        with transaction.atomic():
+            Compensation.objects.bulk_create(compensations)
+    except:
+        for compensation in compensations:
+            if compensation.compensation_file:
+                compensation.compensation_file.delete(save=False)
+        raise
+
+
+def create_compensations(compensation_data, user):
+    """
+    Validate and save a list of compensations, each a dict with the
+    site_panel, acquisition_date, name & matrix_text fields. The site
+    panels, their parameters and existing names are fetched once for the
+    whole list, and the compensations are created in one query.
+
+    Returns a list of the new compensations & a list of errors (a dict per
+    item, empty for valid ones). Nothing is saved unless all are valid.
+    Raises PermissionDenied if the user can't add to any of the sites.
+    """
+    site_panel_ids = set()
+    for data in compensation_data:
+        try:
+            site_panel_ids.add(int(data['site_panel']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    site_panels = SitePanel.objects.select_related(
+        'site'
+    ).prefetch_related(
+        'sitepanelparameter_set'
+    ).in_bulk(site_panel_ids)
+
+    for site in set(site_panel.site for site_panel in site_panels.values()):
+        if not site.has_add_permission(user):
+            raise PermissionDenied
+
+    # compensation names must be unique within a site
+    site_names = set(
+        Compensation.objects.filter(
+            site_panel__site__in=set(
+                site_panel.site_id for site_panel in site_panels.values()
+            ),
+            name__in=set(
+                data.get('name') for data in compensation_data
+                if isinstance(data.get('name'), basestring)
+            )
+        ).values_list('site_panel__site_id', 'name')
+    )
+
+    compensations = []
+    np_arrays = []
+    errors = []
+    for data in compensation_data:
+        try:
+            try:
+                site_panel = site_panels[int(data['site_panel'])]
+                acquisition_date = datetime.datetime.strptime(
+                    data['acquisition_date'],
+                    "%Y-%m-%d"
+                ).date()
+                name = data['name']
+                matrix_text = data['matrix_text']
+                if not isinstance(name, basestring) or \
+                        not isinstance(matrix_text, basestring):
+                    raise TypeError
+            except (KeyError, TypeError, ValueError):
+                raise ValidationError(
+                    "A valid site_panel, acquisition_date (YYYY-MM-DD), "
+                    "name & matrix_text are required"
+                )
+
+            if (site_panel.site_id, name) in site_names:
+                raise ValidationError(
+                    "Compensation with this name already exists in this site."
+                )
+
+            np_array = parse_compensation_matrix(
+                matrix_text,
+                site_panel.get_compensation_channels()
+            )
+        except ValidationError as e:
+            errors.append({'detail': e.messages[0]})
+            continue
+
+        site_names.add((site_panel.site_id, name))
+        compensations.append(
+            Compensation(
+                site_panel=site_panel,
+                acquisition_date=acquisition_date,
+                name=name,
+                matrix_text=matrix_text
+            )
+        )
+        np_arrays.append(np_array)
+        errors.append({})
+
+    if any(errors):
+        return [], errors
+
+    _bulk_create_compensations(compensations, np_arrays)
+
+    # not every database returns the new primary keys
+    compensation_ids = dict(
+        Compensation.objects.filter(
+            compensation_file__in=[
+                compensation.compensation_file.name
+                for compensation in compensations
+            ]
+        ).values_list('compensation_file', 'id')
+    )
+    for compensation in compensations:
+        compensation.id = compensation_ids[compensation.compensation_file.name]
+
+    return compensations, errors
+
+
+def get_sample_spills(sample_ids, batch_size=500):
+    """
+    Returns a dict of the spillover matrix value ($SPILLOVER, or $SPILL
+    from older files) by sample id, for those of the given samples with
+    one. Values too long for a SampleMetadata row are read from the
+    samples' complete metadata.
+    """
+    sample_ids = list(sample_ids)
+    spills = {}
+    for i in range(0, len(sample_ids), batch_size):
+        # ordered so spillover takes precedence over spill
+        spills.update(
+            SampleMetadata.objects.filter(
+                sample_id__in=sample_ids[i:i + batch_size],
+                key__in=('spill', 'spillover')
+            ).order_by('key').values_list('sample_id', 'value')
+        )
+
+    missing_ids = [
+        sample_id for sample_id in sample_ids if sample_id not in spills
+    ]
+    for i in range(0, len(missing_ids), batch_size):
+        for sample in Sample.objects.filter(
+                id__in=missing_ids[i:i + batch_size],
+                fcs_metadata__isnull=False
+        ).only('id', 'fcs_metadata'):
+            metadata = sample.get_fcs_metadata()
+            spill = metadata.get('spillover', metadata.get('spill'))
+            if spill:
+                spills[sample.id] = spill
+
+    return spills
+
+
+def parse_spill_compensation(spill, site_panel):
+    """
+    Parse a spillover matrix value from an FCS file as a compensation for
+    the site panel, returning the matrix text & its array (see
+    parse_compensation_matrix). Raises ValidationError if the value is
+    invalid or its channels don't match the site panel's fluoro parameters.
+    """
+    try:
+        names, matrix = parse_fcs_spill(spill)
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+    matrix_text = '\n'.join(
+        [','.join(names)] +
+        [','.join([repr(value) for value in row]) for row in matrix]
+    )
+    np_array = parse_compensation_matrix(
+        matrix_text,
+        site_panel.get_compensation_channels()
+    )
+
+    return matrix_text, np_array
+
+
+def extract_spill_compensations(samples, batch_size=500):
+    """
+    Create Compensations from the spillover matrices ($SPILL/$SPILLOVER)
+    in the FCS files of a Sample queryset. Identical spillover values are
+    parsed once, and a compensation is created for each distinct matrix
+    per site panel & acquisition date, skipping those already saved.
+    Compensations are created batch_size at a time, each batch in a
+    transaction.
+
+    Returns the number created & a list of (site panel id, acquisition
+    date, error message) for spillovers that couldn't be used (e.g. their
+    channels don't match the site panel's fluoro parameters).
+    """
+    sample_rows = samples.values_list(
+        'id',
+        'site_panel_id',
+        'acquisition_date'
+    )
+    sample_spills = get_sample_spills(
+        [sample_id for sample_id, s, d in sample_rows],
+        batch_size
+    )
+    spills = set(
+        (site_panel_id, acquisition_date, sample_spills[sample_id])
+        for sample_id, site_panel_id, acquisition_date in sample_rows
+        if sample_id in sample_spills
+    )
+    site_panels = SitePanel.objects.select_related(
+        'site'
+    ).prefetch_related(
+        'sitepanelparameter_set'
+    ).in_bulk(set(site_panel_id for site_panel_id, d, v in spills))
+
+    parsed_spills = {}
+    matrices = {}
+    errors = []
+    for site_panel_id, acquisition_date, spill in sorted(spills):
+        if (site_panel_id, spill) not in parsed_spills:
+            try:
+                matrix_text, np_array = parse_spill_compensation(
+                    spill,
+                    site_panels[site_panel_id]
+                )
+            except ValidationError as e:
+                parsed_spills[(site_panel_id, spill)] = e
+            else:
+                np_array_file = io.BytesIO()
+                np.save(np_array_file, np_array)
+                parsed_spills[(site_panel_id, spill)] = (
+                    matrix_text,
+                    np_array,
+                    get_file_sha1(np_array_file)
+                )
+
+        parsed_spill = parsed_spills[(site_panel_id, spill)]
+        if isinstance(parsed_spill, ValidationError):
+            errors.append(
+                (site_panel_id, acquisition_date, parsed_spill.messages[0])
+            )
+            continue
+
+        matrix_text, np_array, sha1 = parsed_spill
+        matrices[(site_panel_id, acquisition_date, sha1)] = \
+            (matrix_text, np_array)
+
+    # compensations saved before their SHA-1 was stored aren't matched
+    existing = set(
+        Compensation.objects.filter(
+            site_panel_id__in=site_panels.keys(),
+            sha1__in=set(sha1 for s, d, sha1 in matrices)
+        ).values_list('site_panel_id', 'acquisition_date', 'sha1')
+    )
+    new_matrices = sorted(set(matrices) - existing)
+
+    for i in range(0, len(new_matrices), batch_size):
+        compensations = []
+        np_arrays = []
+        for site_panel_id, acquisition_date, sha1 in \
+                new_matrices[i:i + batch_size]:
+            matrix_text, np_array = \
+                matrices[(site_panel_id, acquisition_date, sha1)]
+            compensations.append(
+                Compensation(
+                    site_panel=site_panels[site_panel_id],
+                    acquisition_date=acquisition_date,
+                    name='Spillover %d %s %s' % (
+                        site_panel_id,
+                        acquisition_date.isoformat(),
+                        sha1[:8]
+                    ),
+                    matrix_text=matrix_text
+                )
+            )
+            np_arrays.append(np_array)
+
+        _bulk_create_compensations(compensations, np_arrays)
+
+    return len(new_matrices), errors
+
+
+def find_sample_compensations(samples):
+    """
+    Find the best compensation for each of a list of samples, given as
+    (id, site_panel_id, acquisition_date) tuples. In order of preference:
+        exact: a compensation for the site panel on the acquisition date
+        nearest: the site panel's compensation nearest the acquisition
+                 date (the earlier one on a tie)
+        spill: the spillover matrix in the sample's FCS file, if valid
+               for the site panel's fluoro parameters
+    The compensations & spillover values are fetched with a query each.
+
+    Returns a dict, keyed by sample id, of dicts with the match type, the
+    compensation id & name (None for spill matches) and the matrix as CSV
+    text (see format_compensation_csv). Samples without any match have
+    None for every value.
+    """
+    site_panel_ids = set(site_panel_id for i, site_panel_id, d in samples)
+
+    site_panel_dates = {}
+    compensations = {}
+    for compensation in Compensation.objects.filter(
+            site_panel_id__in=site_panel_ids
+    ).order_by('site_panel_id', 'acquisition_date', 'id'):
+        dates = site_panel_dates.setdefault(
+            compensation.site_panel_id,
+            ([], [])
+        )
+        if not dates[0] or dates[0][-1] != compensation.acquisition_date:
+            dates[0].append(compensation.acquisition_date)
+            dates[1].append(compensation)
+        compensations[compensation.id] = compensation
+
+    matches = {}
+    unmatched = []
+    for sample_id, site_panel_id, acquisition_date in samples:
+        dates, date_compensations = site_panel_dates.get(
+            site_panel_id,
+            ([], [])
+        )
+        i = bisect.bisect_left(dates, acquisition_date)
+        if i < len(dates) and dates[i] == acquisition_date:
+            matches[sample_id] = ('exact', date_compensations[i])
+        elif dates:
+            # the nearest is either side of the insertion point
+            nearest = [j for j in (i - 1, i) if 0 <= j < len(dates)]
+            j = min(
+                nearest,
+                key=lambda k: abs((dates[k] - acquisition_date).days)
+            )
+            matches[sample_id] = ('nearest', date_compensations[j])
+        else:
+            unmatched.append((sample_id, site_panel_id))
+
+    spills = get_sample_spills([sample_id for sample_id, s in unmatched])
+    site_panels = SitePanel.objects.prefetch_related(
+        'sitepanelparameter_set'
+    ).in_bulk(set(s for i, s in unmatched if i in spills))
+
+    results = {}
+    csv_cache = {}
+    spill_cache = {}
+    for sample_id, site_panel_id, acquisition_date in samples:
+        result = {
+            'match': None,
+            'compensation': None,
+            'compensation_name': None,
+            'matrix': None
+        }
+
+        if sample_id in matches:
+            match, compensation = matches[sample_id]
+            if compensation.id not in csv_cache:
+                csv_cache[compensation.id] = \
+                    compensation.get_compensation_as_csv().getvalue()
+            result.update(
+                match=match,
+                compensation=compensation.id,
+                compensation_name=compensation.name,
+                matrix=csv_cache[compensation.id]
+            )
+        elif sample_id in spills:
+            spill_key = (site_panel_id, spills[sample_id])
+            if spill_key not in spill_cache:
+                try:
+                    matrix_text, np_array = parse_spill_compensation(
+                        spills[sample_id],
+                        site_panels[site_panel_id]
+                    )
+                    spill_cache[spill_key] = format_compensation_csv(np_array)
+                except ValidationError:
+                    # invalid, or channels don't match the site panel
+                    spill_cache[spill_key] = None
+
+            if spill_cache[spill_key] is not None:
+                result.update(match='spill', matrix=spill_cache[spill_key])
+
+        results[sample_id] = result
+
+    return results
 
 
 def validate_panel_template_request(data, user):
@@ -391,23 +836,3 @@ def validate_site_panel_request(data, user):
     if len(param_errors) > 0:
         errors['parameters'] = param_errors
     return errors
-
-
-def matches_site_panel_colors(pnn_list, site_panel):
-    """
-    Returns true or false depending on whether the given pnn_list matches
-    the fluorescent parameters of the given site_panel
-
-    :param pnn_list:
-    :param site_panel:
-    :return: boolean
-    """
-    panel_text_set = set(
-        site_panel.sitepanelparameter_set.all().exclude(
-            parameter_type__in=['FSC', 'SSC', 'TIM', 'NUL']
-        ).values_list('fcs_text', flat=True)
-    )
-    if len(panel_text_set.symmetric_difference(pnn_list)) == 0:
-        return True
-
-    return False
@@ -0,0 +1,432 @@
+"""
+Background jobs run after a Sample is created. Jobs are SampleJob rows,
+claimed and run by the process_sample_jobs management command. Each job
+type in SAMPLE_JOB_TYPE_CHOICES has a handler registered here, taking the
+Sample as its only argument.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from collections import defaultdict
+import datetime
+
+import numpy as np
+
+from repository.models import Sample, SampleJob, SampleChannelStatistics, \
+    SAMPLE_JOB_TYPE_CHOICES
+
+SAMPLE_JOB_HANDLERS = {}
+
+# job types that aren't run until the sample's job of another type is
+# complete, statistics are calculated from the event store
+SAMPLE_JOB_DEPENDENCIES = {
+    'statistics': 'event_store'
+}
+
+# events read at a time when calculating statistics
+STATISTICS_CHUNK_SIZE = 65536
+# medians are found by narrowing the value range with histograms of this
+# many bins, until at most MEDIAN_SORT_LIMIT values are left to sort
+MEDIAN_HISTOGRAM_BINS = 4096
+MEDIAN_SORT_LIMIT = 65536
+
+
+def sample_job_handler(job_type):
+    """ Register the decorated function as the handler for job_type """
+    def register(handler):
+        SAMPLE_JOB_HANDLERS[job_type] = handler
+        return handler
+
+    return register
+
+
+def iter_sample_event_chunks(sample, chunk_size=STATISTICS_CHUNK_SIZE):
+    """
+    Returns an iterator of the sample's raw events as 2-D float64 arrays of
+    at most chunk_size events, one column per channel in FCS channel order.
+    Read from the event store once it's been built.
+    """
+    metadata = sample.get_fcs_metadata()
+    fcs_numbers = range(1, int(metadata['par']) + 1)
+
+    return (
+        chunk.astype(np.float64) for chunk in sample.iter_events(
+            fcs_numbers,
+            0,
+            int(metadata['tot']),
+            chunk_size
+        )
+    )
+
+
+def get_channel_summaries(chunks):
+    """
+    Returns the event count and the per-channel minimum, maximum, mean &
+    standard deviation of an iterable of 2-D event chunks, in one pass.
+    The chunk means & squared deviations are combined pairwise (Chan et
+    al.), which is as accurate as computing them over all the events.
+    """
+    count = 0
+    minimum = maximum = mean = squared_deviations = None
+
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+
+        chunk_mean = chunk.mean(axis=0)
+        chunk_squared_deviations = ((chunk - chunk_mean) ** 2).sum(axis=0)
+
+        if count == 0:
+            minimum = chunk.min(axis=0)
+            maximum = chunk.max(axis=0)
+            mean = chunk_mean
+            squared_deviations = chunk_squared_deviations
+        else:
+            minimum = np.minimum(minimum, chunk.min(axis=0))
+            maximum = np.maximum(maximum, chunk.max(axis=0))
+            total = count + len(chunk)
+            delta = chunk_mean - mean
+            mean = mean + delta * len(chunk) / total
+            squared_deviations = squared_deviations + \
+                chunk_squared_deviations + \
+                delta ** 2 * count * len(chunk) / total
+        count += len(chunk)
+
+    if count == 0:
+        return 0, None, None, None, None
+
+    return count, minimum, maximum, mean, np.sqrt(squared_deviations / count)
+
+
+def _sort_rank(columns, rank):
+    """
+    Returns the rank'th smallest of the values in the list of columns.
+    """
+    return np.sort(np.concatenate(columns))[rank]
+
+
+def _select_ranks(iter_chunks, targets, count, minimum, maximum):
+    """
+    Returns a dict of the value of each (channel, rank) target, i.e. the
+    rank'th smallest value of the channel, without holding the channels in
+    memory. Each pass over the chunks narrows every target's value range to
+    the histogram bin holding its rank, until few enough values are left
+    in the range to sort them, or they're all equal.
+    """
+    # the value range [low, high) of each target, closed if closed_high,
+    # the number of the channel's values below it & the number within it
+    ranges = dict(
+        (target, (minimum[target[0]], maximum[target[0]], True, 0, count))
+        for target in targets
+    )
+    values = {}
+
+    while len(values) < len(targets):
+        active = [target for target in targets if target not in values]
+        edges = {}
+        counts = {}
+        selected = {}
+        range_minimums = {}
+        range_maximums = {}
+        for target in active:
+            if ranges[target][4] <= MEDIAN_SORT_LIMIT:
+                selected[target] = []
+            else:
+                # edges can repeat in a range only a few floats wide, the
+                # last bin holds the values equal to high
+                edges[target] = np.unique(
+                    np.linspace(
+                        ranges[target][0],
+                        ranges[target][1],
+                        MEDIAN_HISTOGRAM_BINS + 1
+                    )
+                )
+                counts[target] = np.zeros(
+                    len(edges[target]),
+                    dtype=np.int64
+                )
+
+        for chunk in iter_chunks():
+            for target in active:
+                low, high, closed_high = ranges[target][:3]
+                column = chunk[:, target[0]]
+                if closed_high:
+                    column = column[(column >= low) & (column <= high)]
+                else:
+                    column = column[(column >= low) & (column < high)]
+                if not len(column):
+                    continue
+
+                if target in selected:
+                    selected[target].append(column)
+                    continue
+
+                range_minimums[target] = min(
+                    range_minimums.get(target, np.inf),
+                    column.min()
+                )
+                range_maximums[target] = max(
+                    range_maximums.get(target, -np.inf),
+                    column.max()
+                )
+                bins = np.searchsorted(edges[target], column, side='right')
+                counts[target] += np.bincount(
+                    bins - 1,
+                    minlength=len(edges[target])
+                )
+
+        for target in active:
+            low, high, closed_high, below, range_count = ranges[target]
+            rank = target[1] - below
+
+            if target in selected:
+                values[target] = _sort_rank(selected[target], rank)
+                continue
+            if range_minimums[target] == range_maximums[target]:
+                # every value in the range is the same
+                values[target] = range_minimums[target]
+                continue
+
+            cumulative_counts = np.cumsum(counts[target])
+            i = np.searchsorted(cumulative_counts, rank, side='right')
+            if counts[target][i] == range_count:
+                # every value fell in one bin, narrow the range to the
+                # values seen so both ends land in different bins
+                ranges[target] = (
+                    range_minimums[target],
+                    range_maximums[target],
+                    True,
+                    below,
+                    range_count
+                )
+            elif i == len(edges[target]) - 1:
+                values[target] = high
+            else:
+                if i > 0:
+                    below += cumulative_counts[i - 1]
+                ranges[target] = (
+                    edges[target][i],
+                    edges[target][i + 1],
+                    False,
+                    below,
+                    counts[target][i]
+                )
+
+    return values
+
+
+def get_channel_medians(iter_chunks, count, minimum, maximum):
+    """
+    Returns the exact median of each channel. iter_chunks is a function
+    returning a new iterator of the event chunks for each pass, count &
+    the channel minimums & maximums are from get_channel_summaries.
+    """
+    ranks = [(count - 1) // 2, count // 2]
+    targets = [
+        (channel, rank)
+        for channel in range(len(minimum))
+        for rank in sorted(set(ranks))
+    ]
+    values = _select_ranks(iter_chunks, targets, count, minimum, maximum)
+
+    return [
+        (values[(channel, ranks[0])] + values[(channel, ranks[1])]) / 2.0
+        for channel in range(len(minimum))
+    ]
+
+
+@sample_job_handler('event_store')
+def build_event_store(sample):
+    """ Build the memory mappable copy of the sample's events """
+    sample.write_event_store()
+
+
+@sample_job_handler('statistics')
+def calculate_sample_statistics(sample):
+    """
+    Save the event count & per-channel summary statistics, computed over
+    chunks of events so memory use doesn't depend on the event count
+    """
+    count, minimums, maximums, means, stds = get_channel_summaries(
+        iter_sample_event_chunks(sample)
+    )
+
+    statistics = []
+    if count:
+        medians = get_channel_medians(
+            lambda: iter_sample_event_chunks(sample),
+            count,
+            minimums,
+            maximums
+        )
+        statistics = [
+            SampleChannelStatistics(
+                sample=sample,
+                fcs_number=i + 1,
+                minimum=minimum,
+                maximum=maximum,
+                mean=mean,
+                median=median,
+                std=std
+            )
+            for i, (minimum, maximum, mean, median, std) in enumerate(
+                zip(minimums, maximums, means, medians, stds)
+            )
+        ]
+
+    with transaction.atomic():
+        SampleChannelStatistics.objects.filter(sample=sample).delete()
+        SampleChannelStatistics.objects.bulk_create(statistics)
+        Sample.objects.filter(id=sample.id).update(event_count=count)
+
+
+def enqueue_sample_jobs(samples):
+    """
+    Create a pending job of every type for a list of new samples. Call this
+    within the transaction creating the samples, so the jobs only become
+    visible to the job runner once the samples are committed.
+    """
+    SampleJob.objects.bulk_create(
+        [
+            SampleJob(sample=sample, job_type=job_type)
+            for sample in samples
+            for job_type, job_name in SAMPLE_JOB_TYPE_CHOICES
+        ]
+    )
+    for sample in samples:
+        sample.processing_status = 'Pending'
+    Sample.objects.filter(
+        id__in=[sample.id for sample in samples]
+    ).update(processing_status='Pending')
+
+
+def update_processing_statuses(sample_ids, batch_size=500):
+    """
+    Set the processing_status of many samples from their jobs, as
+    Sample.update_processing_status does, with a few queries per batch
+    """
+    sample_ids = list(sample_ids)
+    for i in range(0, len(sample_ids), batch_size):
+        job_statuses = defaultdict(set)
+        for sample_id, job_status in SampleJob.objects.filter(
+                sample_id__in=sample_ids[i:i + batch_size]
+        ).values_list('sample_id', 'status'):
+            job_statuses[sample_id].add(job_status)
+
+        status_sample_ids = defaultdict(list)
+        for sample_id, statuses in job_statuses.items():
+            status_sample_ids[
+                Sample.get_processing_status(statuses)
+            ].append(sample_id)
+
+        for processing_status, ids in status_sample_ids.items():
+            Sample.objects.filter(id__in=ids).update(
+                processing_status=processing_status
+            )
+
+
+def get_runnable_sample_jobs():
+    """
+    Returns the pending jobs whose sample has no incomplete job they
+    depend on (see SAMPLE_JOB_DEPENDENCIES)
+    """
+    jobs = SampleJob.objects.filter(status='Pending')
+    for job_type, dependency in SAMPLE_JOB_DEPENDENCIES.items():
+        jobs = jobs.exclude(
+            job_type=job_type,
+            sample_id__in=SampleJob.objects.filter(
+                job_type=dependency
+            ).exclude(
+                status='Complete'
+            ).values('sample_id')
+        )
+
+    return jobs
+
+
+def claim_sample_job():
+    """
+    Claim the oldest runnable pending job, returning None if there aren't
+    any. The status update only succeeds for one runner, so several
+    runners can safely share the queue.
+    """
+    while True:
+        job = get_runnable_sample_jobs().order_by(
+            'created_date',
+            'id'
+        ).first()
+
+        if job is None:
+            return None
+
+        claimed = SampleJob.objects.filter(
+            id=job.id,
+            status='Pending'
+        ).update(
+            status='Working',
+            start_date=datetime.datetime.now(),
+            attempts=F('attempts') + 1
+        )
+
+        if claimed:
+            job.refresh_from_db()
+            job.sample.update_processing_status()
+            return job
+
+
+def get_max_job_attempts():
+    return getattr(settings, 'SAMPLE_JOB_MAX_ATTEMPTS', 3)
+
+
+def run_sample_job(job):
+    """
+    Run a claimed job, recording the outcome on the job & its sample. A
+    failed job is returned to the queue until it has been attempted
+    SAMPLE_JOB_MAX_ATTEMPTS times, keeping the last error as its message.
+    """
+    try:
+        SAMPLE_JOB_HANDLERS[job.job_type](job.sample)
+    except Exception as e:
+        job.status_message = (u'%s' % e)[:256]
+        if job.attempts < get_max_job_attempts():
+            job.status = 'Pending'
+            job.start_date = None
+            job.completion_date = None
+        else:
+            job.status = 'Error'
+            job.completion_date = datetime.datetime.now()
+    else:
+        job.status = 'Complete'
+        job.status_message = None
+        job.completion_date = datetime.datetime.now()
+
+    job.save()
+    job.sample.update_processing_status()
+
+    return job
+
+
+def reset_stale_sample_jobs(started_before):
+    """
+    Return jobs left 'Working' by a runner that died (started before the
+    given datetime) to the queue, returning the number of jobs reset. Jobs
+    that have used up their attempts (e.g. crashing the runner each time)
+    are set to 'Error' instead.
+    """
+    stale_jobs = SampleJob.objects.filter(
+        status='Working',
+        start_date__lt=started_before
+    )
+    sample_ids = list(stale_jobs.values_list('sample_id', flat=True))
+
+    stale_jobs.filter(attempts__gte=get_max_job_attempts()).update(
+        status='Error',
+        status_message='Job did not finish',
+        completion_date=datetime.datetime.now()
+    )
+    reset_count = stale_jobs.update(status='Pending', start_date=None)
+    update_processing_statuses(sample_ids)
+
+    return reset_count
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from repository.jobs import update_processing_statuses
+from repository.models import Sample, SampleJob
+
+
+class Command(BaseCommand):
+    help = (
+        'Queue event_store jobs for samples uploaded before event stores '
+        'existed. The stores are built by process_sample_jobs.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Queue every sample, including those with an event store'
+        )
+
+    def handle(self, *args, **options):
+        samples = Sample.objects.all()
+        if not options['rebuild']:
+            samples = samples.filter(
+                Q(event_store__isnull=True) | Q(event_store='')
+            )
+
+        with transaction.atomic():
+            jobs = SampleJob.objects.filter(
+                job_type='event_store',
+                sample__in=samples
+            ).exclude(
+                status__in=('Pending', 'Working')
+            )
+            sample_ids = list(jobs.values_list('sample_id', flat=True))
+            requeued_count = jobs.update(
+                status='Pending',
+                status_message=None,
+                attempts=0,
+                start_date=None,
+                completion_date=None
+            )
+            new_jobs = [
+                SampleJob(sample_id=sample_id, job_type='event_store')
+                for sample_id in samples.exclude(
+                    samplejob__job_type='event_store'
+                ).values_list('id', flat=True)
+            ]
+            SampleJob.objects.bulk_create(new_jobs)
+
+            sample_ids.extend(job.sample_id for job in new_jobs)
+            update_processing_statuses(sample_ids)
+
+        self.stdout.write(
+            'Queued %d event store job(s)' % (requeued_count + len(new_jobs))
+        )
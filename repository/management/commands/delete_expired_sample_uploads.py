@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from repository.models import SampleUpload
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete resumable sample uploads inactive for longer than '
+        'SAMPLE_UPLOAD_EXPIRY_HOURS, along with their staging files'
+    )
+
+    def handle(self, *args, **options):
+        uploads = SampleUpload.objects.filter(
+            modified_date__lt=SampleUpload.get_expiry_cutoff()
+        )
+
+        # deleted one by one so the post_delete signal removes each file
+        deleted_count = 0
+        for upload in uploads:
+            upload.delete()
+            deleted_count += 1
+
+        self.stdout.write('Deleted %d expired upload(s)' % deleted_count)
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from repository.controllers import extract_spill_compensations
+from repository.models import Sample
+
+
+class Command(BaseCommand):
+    help = (
+        'Create compensations from the spillover matrices embedded in the '
+        'FCS files of a project or site panel'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int)
+        parser.add_argument('--site-panel', type=int)
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of compensations saved per transaction'
+        )
+
+    def handle(self, *args, **options):
+        if options['project'] is not None:
+            samples = Sample.objects.filter(
+                subject__project_id=options['project']
+            )
+        elif options['site_panel'] is not None:
+            samples = Sample.objects.filter(
+                site_panel_id=options['site_panel']
+            )
+        else:
+            raise CommandError('Either --project or --site-panel is required')
+
+        created_count, errors = extract_spill_compensations(
+            samples,
+            options['batch_size']
+        )
+
+        for site_panel_id, acquisition_date, message in errors:
+            self.stderr.write(
+                'Site panel %d, %s: %s' % (
+                    site_panel_id,
+                    acquisition_date.isoformat(),
+                    message
+                )
+            )
+
+        self.stdout.write(
+            'Created %d compensation(s), %d error(s)' %
+            (created_count, len(errors))
+        )
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+
+import datetime
+import time
+
+from repository.jobs import claim_sample_job, run_sample_job, \
+    reset_stale_sample_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run pending background jobs for samples (e.g. statistics)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once there are no pending jobs instead of polling'
+        )
+        parser.add_argument(
+            '--sleep',
+            type=int,
+            default=10,
+            help='Seconds to wait between polls when the queue is empty'
+        )
+        parser.add_argument(
+            '--stale-minutes',
+            type=int,
+            default=None,
+            help='Re-queue jobs that have been working for this long'
+        )
+
+    def handle(self, *args, **options):
+        if options['stale_minutes'] is not None:
+            reset_count = reset_stale_sample_jobs(
+                datetime.datetime.now() - datetime.timedelta(
+                    minutes=options['stale_minutes']
+                )
+            )
+            self.stdout.write('Re-queued %d stale job(s)' % reset_count)
+
+        while True:
+            job = claim_sample_job()
+
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            job = run_sample_job(job)
+            self.stdout.write(
+                'Sample %d %s job: %s' % (
+                    job.sample_id,
+                    job.job_type,
+                    job.status
+                )
+            )
@@ -0,0 +1,306 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+import csv
+import datetime
+import multiprocessing
+import os
+import shutil
+
+from repository.controllers import SAMPLE_ANNOTATION_FIELDS
+from repository.jobs import enqueue_sample_jobs
+from repository.models import Sample, SampleMetadata, Subject, VisitType, \
+    SitePanel, PanelVariant, Specimen, Stimulation, fcs_file_path
+from repository.utils import read_fcs_file, get_fcs_channels, \
+    get_fcs_channel_signature, get_fcs_event_count
+
+
+def read_fcs_path(path):
+    """
+    Hash, parse & verify an FCS file in a worker process. Returns a dict
+    of what registration needs, with 'error' set if the file is invalid.
+    """
+    result = {'path': path, 'error': None}
+
+    try:
+        with open(path, 'rb') as fcs_file:
+            fcs_reader = read_fcs_file(fcs_file)
+    except (IOError, OSError) as e:
+        result['error'] = str(e)
+        return result
+
+    if fcs_reader.error is not None:
+        result['error'] = fcs_reader.error
+        return result
+
+    try:
+        if not fcs_reader.metadata.get('par', '').isdigit():
+            raise ValidationError("No parameters found in FCS file")
+        result['event_count'] = get_fcs_event_count(fcs_reader)
+    except ValidationError as e:
+        result['error'] = e.messages[0]
+        return result
+
+    result['sha1'] = fcs_reader.sha1
+    result['metadata'] = fcs_reader.metadata
+
+    return result
+
+
+class Command(BaseCommand):
+    help = (
+        'Register FCS files already on the server as Samples, without '
+        'uploading them. The CSV manifest needs a filename column (relative '
+        'to the directory) and a column for each Sample annotation field: '
+        + ', '.join(SAMPLE_ANNOTATION_FIELDS)
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('manifest')
+        parser.add_argument(
+            '--move',
+            action='store_true',
+            help='Move files into MEDIA_ROOT instead of hard linking them'
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help='Number of processes used to hash & validate files'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of samples saved per transaction'
+        )
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+
+        try:
+            with open(options['manifest'], 'rb') as manifest_file:
+                rows = list(csv.DictReader(manifest_file))
+        except IOError as e:
+            raise CommandError(str(e))
+
+        missing_columns = set(('filename',) + SAMPLE_ANNOTATION_FIELDS) - \
+            set(rows[0].keys() if rows else [])
+        if missing_columns:
+            raise CommandError(
+                'Manifest is missing columns: %s' %
+                ', '.join(sorted(missing_columns))
+            )
+
+        self.errors = []
+        self.load_related_objects(rows)
+
+        paths = [os.path.join(directory, row['filename']) for row in rows]
+        if options['processes'] > 1:
+            # workers must not inherit open database connections
+            connections.close_all()
+            pool = multiprocessing.Pool(options['processes'])
+            try:
+                file_results = pool.map(read_fcs_path, paths, chunksize=8)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            file_results = [read_fcs_path(path) for path in paths]
+
+        samples = []
+        # the same file may be registered once per project
+        manifest_sha1s = set()
+        for row, file_result in zip(rows, file_results):
+            try:
+                if file_result['error'] is not None:
+                    raise ValidationError(file_result['error'])
+                sample = self.build_sample(row, file_result)
+                project_sha1 = (sample.subject.project_id, sample.sha1)
+                if project_sha1 in manifest_sha1s:
+                    raise ValidationError("File is a duplicate in manifest")
+            except ValidationError as e:
+                self.errors.append((row['filename'], e.messages[0]))
+                continue
+
+            manifest_sha1s.add(project_sha1)
+            samples.append((sample, file_result['path']))
+
+        samples = self.exclude_existing_samples(samples)
+
+        batch_size = options['batch_size']
+        registered_count = 0
+        for i in range(0, len(samples), batch_size):
+            registered_count += self.register_batch(
+                samples[i:i + batch_size],
+                options['move']
+            )
+
+        for filename, message in self.errors:
+            self.stderr.write('%s: %s' % (filename, message))
+
+        self.stdout.write(
+            'Registered %d sample(s), %d error(s)' %
+            (registered_count, len(self.errors))
+        )
+
+    def load_related_objects(self, rows):
+        """ Fetch every object referenced by the manifest up front """
+        def load(model, field, **kwargs):
+            ids = set(
+                int(row[field]) for row in rows if row[field].isdigit()
+            )
+            return model.objects.filter(id__in=ids, **kwargs).in_bulk()
+
+        self.subjects = load(Subject, 'subject')
+        self.visits = load(VisitType, 'visit')
+        self.site_panels = dict(
+            (site_panel.id, site_panel)
+            for site_panel in SitePanel.objects.select_related('site').filter(
+                id__in=set(
+                    int(row['site_panel']) for row in rows
+                    if row['site_panel'].isdigit()
+                )
+            )
+        )
+        self.panel_variants = load(PanelVariant, 'panel_variant')
+        self.specimens = load(Specimen, 'specimen')
+        self.stimulations = load(Stimulation, 'stimulation')
+
+        for site_panel in self.site_panels.values():
+            if site_panel.signature is None:
+                site_panel.update_signature()
+
+    def build_sample(self, row, file_result):
+        """
+        Returns an unsaved Sample for a manifest row, doing the same checks
+        as Sample.clean but against the pre-fetched objects
+        """
+        def get_related(objects, field):
+            try:
+                return objects[int(row[field])]
+            except (KeyError, ValueError):
+                raise ValidationError("Invalid %s: %s" % (field, row[field]))
+
+        try:
+            acquisition_date = datetime.datetime.strptime(
+                row['acquisition_date'],
+                "%Y-%m-%d"
+            ).date()
+        except ValueError:
+            raise ValidationError("acquisition_date must be YYYY-MM-DD")
+
+        sample = Sample(
+            acquisition_date=acquisition_date,
+            subject=get_related(self.subjects, 'subject'),
+            visit=get_related(self.visits, 'visit'),
+            panel_variant=get_related(self.panel_variants, 'panel_variant'),
+            site_panel=get_related(self.site_panels, 'site_panel'),
+            pretreatment=row['pretreatment'],
+            storage=row['storage'],
+            specimen=get_related(self.specimens, 'specimen'),
+            stimulation=get_related(self.stimulations, 'stimulation'),
+            original_filename=os.path.basename(row['filename']),
+            sha1=file_result['sha1'],
+            event_count=file_result['event_count'],
+            upload_date=datetime.datetime.today()
+        )
+
+        if sample.subject.project_id != sample.site_panel.site.project_id:
+            raise ValidationError(
+                "Subject and Site Panel must belong to the same project"
+            )
+        if sample.subject.project_id != sample.visit.project_id:
+            raise ValidationError(
+                "Subject and Visit must belong to the same project"
+            )
+
+        fcs_channels = get_fcs_channels(file_result['metadata'])
+        if get_fcs_channel_signature(fcs_channels) != \
+                sample.site_panel.signature:
+            sample._compare_site_panel_channels(fcs_channels)
+
+        sample.set_fcs_metadata(file_result['metadata'])
+
+        return sample
+
+    def exclude_existing_samples(self, samples):
+        """ Drop samples whose file already exists in their project """
+        existing = set(
+            Sample.objects.filter(
+                sha1__in=[sample.sha1 for sample, path in samples]
+            ).values_list('subject__project_id', 'sha1')
+        )
+
+        new_samples = []
+        for sample, path in samples:
+            if (sample.subject.project_id, sample.sha1) in existing:
+                self.errors.append(
+                    (
+                        sample.original_filename,
+                        "This FCS file already exists in this Project."
+                    )
+                )
+            else:
+                new_samples.append((sample, path))
+
+        return new_samples
+
+    def register_batch(self, samples, move):
+        """
+        Link (or move) a batch of files into place & save their samples,
+        undoing the file operations if saving fails
+        """
+        placed = []
+        try:
+            for sample, path in samples:
+                name = default_storage.get_available_name(
+                    fcs_file_path(sample, sample.original_filename)
+                )
+                destination = os.path.join(settings.MEDIA_ROOT, name)
+                destination_dir = os.path.dirname(destination)
+                if not os.path.exists(destination_dir):
+                    os.makedirs(destination_dir)
+
+                if move:
+                    shutil.move(path, destination)
+                else:
+                    os.link(path, destination)
+                placed.append((path, destination))
+                sample.sample_file.name = name
+
+            with transaction.atomic():
+                Sample.objects.bulk_create([sample for sample, path in samples])
+
+                # not every database returns the new primary keys
+                sample_ids = dict(
+                    Sample.objects.filter(
+                        sha1__in=[sample.sha1 for sample, path in samples]
+                    ).values_list('sample_file', 'id')
+                )
+                for sample, path in samples:
+                    sample.id = sample_ids[sample.sample_file.name]
+
+                SampleMetadata.objects.bulk_create(
+                    [
+                        sample_metadata
+                        for sample, path in samples
+                        for sample_metadata in sample.build_sample_metadata()
+                    ]
+                )
+                enqueue_sample_jobs([sample for sample, path in samples])
+        except Exception as e:
+            for path, destination in placed:
+                if move:
+                    shutil.move(destination, path)
+                else:
+                    os.unlink(destination)
+            for sample, path in samples:
+                self.errors.append((sample.original_filename, str(e)))
+            return 0
+
+        return len(samples)
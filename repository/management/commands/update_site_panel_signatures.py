@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from repository.models import SitePanel
+
+
+class Command(BaseCommand):
+    help = (
+        'Compute the channel signatures of site panels created before '
+        'signatures existed, needed to match FCS files to site panels'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Recompute every site panel, including those with one'
+        )
+
+    def handle(self, *args, **options):
+        site_panels = SitePanel.objects.all()
+        if not options['all']:
+            site_panels = site_panels.filter(signature=None)
+
+        updated_count = 0
+        for site_panel in site_panels.only('id'):
+            site_panel.update_signature()
+            updated_count += 1
+
+        self.stdout.write('Updated %d site panel signature(s)' % updated_count)
@@ -1,6 +1,7 @@
 from string import join
 import hashlib
-import io
+import json
+import zlib
 import datetime
 from tempfile import TemporaryFile
 from cStringIO import StringIO
@@ -12,6 +13,7 @@ from django.core.exceptions import \
     ObjectDoesNotExist, \
     MultipleObjectsReturned
 from django.core.files import File
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.dispatch import receiver
@@ -19,10 +21,15 @@ from guardian.shortcuts import \
     get_perms, get_objects_for_user, get_users_with_perms
 from rest_framework.authtoken.models import Token
 
-import flowio
 import numpy as np
 
-from utils import parse_fcs_text
+from cache import get_cache_key, get_cached_file, open_generated_file
+from transforms import compensate, TRANSFORMS
+from utils import read_fcs_file, merge_byte_ranges, get_fcs_channels, \
+    get_fcs_channel_signature, get_fcs_event_count, parse_fcs_header, \
+    write_spliced_fcs, get_fcs_event_dtype, get_fcs_channel_bitmask, \
+    get_subsample_indices, get_file_sha1, write_npy_chunks, \
+    parse_compensation_matrix, format_compensation_csv, FCS_HEADER_SIZE
 
 
 class ProtectedModel(models.Model):
@@ -123,6 +130,28 @@ STATUS_CHOICES = (
     ('Complete', 'Complete'),
 )
 
+# version of the clean FCS files generated for samples, increment when
+# the generated file changes so previously cached files aren't used
+CLEAN_FCS_VERSION = 2
+
+# background jobs run for every new sample, see repository/jobs.py for
+# the jobs each type waits for
+SAMPLE_JOB_TYPE_CHOICES = (
+    ('event_store', 'Columnar event store'),
+    ('statistics', 'Event count & channel statistics'),
+)
+
+# FCS TEXT keywords (lowercase, w/o '$') saved as individual SampleMetadata
+# rows so they can be queried, the full TEXT segment is saved on the Sample
+INDEXED_METADATA_KEYS = (
+    'cyt',
+    'tot',
+    'par',
+    'date',
+    'spill',
+    'spillover'
+)
+
 
 ##########################
 # Project related models #
@@ -652,6 +681,15 @@ class SitePanel(ProtectedModel):
         null=True,
         blank=True,
         help_text="A short description of the site panel")
+    # SHA-1 of the ordered (fcs_number, PnN, PnS) parameter values, kept
+    # current by the SitePanelParameter signal receivers below, or by an
+    # update_signature call after saving parameters in bulk
+    signature = models.CharField(
+        null=True,
+        blank=True,
+        editable=False,
+        db_index=True,
+        max_length=40)
 
     def _get_name(self):
         """
@@ -678,6 +716,34 @@ class SitePanel(ProtectedModel):
             return True
         return False
 
+    def get_channels(self):
+        """
+        Returns a list of (fcs_number, PnN, PnS) tuples for the parameters
+        """
+        return list(
+            self.sitepanelparameter_set.values_list(
+                'fcs_number',
+                'fcs_text',
+                'fcs_opt_text'
+            )
+        )
+
+    def get_compensation_channels(self):
+        """
+        Returns a dict of the fcs_number for each fluoro parameter's PnN,
+        null, scatter and time don't get compensated. Uses any prefetched
+        parameters.
+        """
+        return dict(
+            (param.fcs_text, param.fcs_number)
+            for param in self.sitepanelparameter_set.all()
+            if param.parameter_type not in ['FSC', 'SSC', 'TIM', 'NUL']
+        )
+
+    def update_signature(self):
+        self.signature = get_fcs_channel_signature(self.get_channels())
+        SitePanel.objects.filter(id=self.id).update(signature=self.signature)
+
     def save(self, *args, **kwargs):
         # Get count of site panels for the panel template / site combo
         # to figure out the implementation number
@@ -762,6 +828,17 @@ class SitePanelParameter(ProtectedModel):
         )
 
 
+# noinspection PyUnusedLocal
+@receiver(models.signals.post_save, sender=SitePanelParameter)
+@receiver(models.signals.post_delete, sender=SitePanelParameter)
+def update_site_panel_signature(sender, instance, *args, **kwargs):
+    try:
+        instance.site_panel.update_signature()
+    except ObjectDoesNotExist:
+        # site panel itself is being deleted
+        pass
+
+
 class SitePanelParameterMarker(models.Model):
     site_panel_parameter = models.ForeignKey(SitePanelParameter)
     marker = models.ForeignKey(Marker)
@@ -897,6 +974,16 @@ class Compensation(ProtectedModel):
         null=False,
         blank=False
     )
+    # SHA-1 of the numpy compensation_file
+    sha1 = models.CharField(
+        null=True,
+        blank=True,
+        editable=False,
+        max_length=40)
+
+    class Meta:
+        # compensations are matched to samples by site panel & date
+        index_together = (('site_panel', 'acquisition_date'),)
 
     def has_view_permission(self, user):
         if self.site_panel.site.project.has_view_permission(user):
@@ -910,21 +997,25 @@ class Compensation(ProtectedModel):
             return True
         return False
 
-    def get_compensation_as_csv(self):
-        csv_string = StringIO()
-        compensation_array = np.load(self.compensation_file.file)
+    def get_sha1(self):
+        """
+        Returns the SHA-1 of the compensation_file, calculating & saving it
+        first for compensations created before it was stored
+        """
+        if self.sha1 is None:
+            self.compensation_file.open('rb')
+            self.sha1 = get_file_sha1(self.compensation_file)
+            self.compensation_file.close()
+            Compensation.objects.filter(id=self.id).update(sha1=self.sha1)
 
-        header = ','.join(["%d" % n for n in compensation_array[0]])
-        csv_string.write(header + '\n')
+        return self.sha1
 
-        np.savetxt(
-            csv_string,
-            compensation_array[1:, :],
-            fmt='%f',
-            delimiter=','
-        )
-        csv_string.seek(0)
-        return csv_string
+    def get_compensation_as_csv(self):
+        self.compensation_file.open('rb')
+        compensation_array = np.load(self.compensation_file)
+        self.compensation_file.close()
+
+        return StringIO(format_compensation_csv(compensation_array))
 
     def clean(self):
         """
@@ -946,73 +1037,21 @@ class Compensation(ProtectedModel):
             raise ValidationError(
                 "Compensation with this name already exists in this site.")
 
-        # get site panel parameter fcs_text, but just for the fluoro params
-        # null, scatter and time don't get compensated
-        params = SitePanelParameter.objects.filter(
-            site_panel_id=self.site_panel_id).exclude(
-                parameter_type__in=['FSC', 'SSC', 'TIM', 'NUL'])
-
-        # parse the matrix text and validate the number of params match
-        # the number of fluoro params in the site panel and that the matrix
-        # values are numbers (can be exp notation)
-        matrix_text = self.matrix_text.splitlines(False)
-        if not len(matrix_text) > 1:
-            raise ValidationError("Too few rows.")
-
-        # first row should be headers matching the PnN value (fcs_text field)
-        # may be tab or comma delimited
-        # (spaces can't be delimiters b/c they are allowed in the PnN value)
-        headers = re.split('\t|,\s*', matrix_text[0])
-
-        missing_fields = list()
-        for p in params:
-            if p.fcs_text not in headers:
-                missing_fields.append(p.fcs_text)
-
-        if len(missing_fields) > 0:
-            raise ValidationError(
-                "Missing fields: %s" % ", ".join(missing_fields))
-
-        if len(headers) > params.count():
-            raise ValidationError("Too many parameters: " + ",".join(headers))
-
-        # the header of matrix text adds a row
-        if len(matrix_text) > params.count() + 1:
-            raise ValidationError("Too many rows")
-        elif len(matrix_text) < params.count() + 1:
-            raise ValidationError("Too few rows")
-
-        # we need to store the channel number in the first row of the numpy
-        # array, more reliable to identify parameters than some concatenation
-        # of parameter attributes
-        channel_header = list()
-        for h in headers:
-            for p in params:
-                if p.fcs_text == h:
-                    channel_header.append(p.fcs_number)
-
-        np_array = np.array(channel_header)
-        np_width = np_array.shape[0]
-
-        # convert the matrix text to numpy array and
-        for line in matrix_text[1:]:
-            line_values = re.split('\t|,', line)
-            for i, value in enumerate(line_values):
-                try:
-                    line_values[i] = float(line_values[i])
-                except ValueError:
-                    self._errors["matrix_text"] = \
-                        "%s is an invalid matrix value" % line_values[i]
-            if len(line_values) > np_width:
-                raise ValidationError("Too many values in line: %s" % line)
-            elif len(line_values) < np_width:
-                raise ValidationError("Too few values in line: %s" % line)
-            else:
-                np_array = np.vstack([np_array, line_values])
+        self.set_compensation_array(
+            parse_compensation_matrix(
+                self.matrix_text,
+                self.site_panel.get_compensation_channels()
+            )
+        )
 
-        # save numpy array in the self.compensation_file field
+    def set_compensation_array(self, np_array):
+        """
+        Save the parsed compensation (see parse_compensation_matrix) in
+        the compensation_file field, without saving the model
+        """
         np_array_file = TemporaryFile()
         np.save(np_array_file, np_array)
+        self.sha1 = get_file_sha1(np_array_file)
 
         self.compensation_file.save(
             self.name,
@@ -1044,6 +1083,21 @@ def fcs_file_path(instance, filename):
     return upload_dir
 
 
+def event_store_path(instance, filename):
+    project_id = instance.subject.project_id
+    site_id = instance.site_panel.site_id
+
+    upload_dir = join([
+        'ReFlow-data',
+        str(project_id),
+        'events',
+        str(site_id),
+        str(filename)],
+        "/")
+
+    return upload_dir
+
+
 class Sample(ProtectedModel):
     subject = models.ForeignKey(
         Subject,
@@ -1096,6 +1150,7 @@ class Sample(ProtectedModel):
         null=False,
         blank=False,
         editable=False,
+        db_index=True,
         max_length=40)
     upload_date = models.DateTimeField(
         editable=False,
@@ -1106,12 +1161,44 @@ class Sample(ProtectedModel):
         blank=False,
         default=False
     )
+    # zlib compressed JSON of the complete FCS TEXT segment
+    fcs_metadata = models.BinaryField(
+        null=True,
+        editable=False
+    )
+    # $TOT, verified against the DATA segment size on upload
+    event_count = models.IntegerField(
+        null=True,
+        blank=True,
+        editable=False
+    )
+    # float32 .npy matrix of the events, a row per event & a column per
+    # channel in FCS order, built by the 'event_store' job
+    event_store = models.FileField(
+        upload_to=event_store_path,
+        null=True,
+        blank=True,
+        editable=False,
+        max_length=256)
+    # status of the background jobs for this sample, null for samples
+    # uploaded before the job queue existed
+    processing_status = models.CharField(
+        max_length=32,
+        null=True,
+        blank=True,
+        editable=False,
+        choices=STATUS_CHOICES
+    )
 
     def _has_compensation(self):
         """
         Returns the True if a compensation matches the sample's site panel &
-        acquisition date
+        acquisition date. Uses the compensation_exists annotation if the
+        sample was fetched with one (see annotate_compensation_exists).
         """
+        if hasattr(self, 'compensation_exists'):
+            return self.compensation_exists
+
         comps = Compensation.objects.filter(
             site_panel=self.site_panel,
             acquisition_date=self.acquisition_date
@@ -1121,6 +1208,21 @@ class Sample(ProtectedModel):
 
     has_compensation = property(_has_compensation)
 
+    @staticmethod
+    def annotate_compensation_exists(queryset):
+        """
+        Annotate a Sample queryset with compensation_exists, so
+        has_compensation doesn't need a query per sample
+        """
+        return queryset.annotate(
+            compensation_exists=models.Exists(
+                Compensation.objects.filter(
+                    site_panel=models.OuterRef('site_panel'),
+                    acquisition_date=models.OuterRef('acquisition_date')
+                )
+            )
+        )
+
     def has_view_permission(self, user):
 
         if self.subject.project.has_view_permission(user):
@@ -1141,25 +1243,285 @@ class Sample(ProtectedModel):
 
         return False
 
-    def get_clean_fcs(self):
-        channel_names = []
-        fluoro_channel_names = []  # used for spill later on
+    def get_fcs_metadata(self):
+        """
+        Returns a dictionary of all the FCS TEXT segment key/value pairs.
+        Keys are lowercase w/o the leading '$'.
+        """
+        if self.fcs_metadata is None:
+            # sample predates the compact metadata store
+            return dict(
+                self.samplemetadata_set.values_list('key', 'value')
+            )
 
-        extra = {}
-        extra_non_standard = {}
+        return json.loads(zlib.decompress(bytes(self.fcs_metadata)))
 
-        flow_data = flowio.FlowData(
-            io.BytesIO(self.sample_file.read())
+    @staticmethod
+    def get_processing_status(job_statuses):
+        """
+        Returns the processing_status for a set of job statuses: Error if
+        any failed, Complete once all are complete, Working if any have
+        started
+        """
+        if 'Error' in job_statuses:
+            return 'Error'
+        elif job_statuses == {'Complete'}:
+            return 'Complete'
+        elif job_statuses == {'Pending'}:
+            return 'Pending'
+
+        return 'Working'
+
+    def update_processing_status(self):
+        """ Set processing_status from the sample's jobs """
+        job_statuses = set(
+            self.samplejob_set.values_list('status', flat=True)
+        )
+        if not job_statuses:
+            return
+
+        self.processing_status = Sample.get_processing_status(job_statuses)
+
+        Sample.objects.filter(id=self.id).update(
+            processing_status=self.processing_status
         )
 
-        params = self.site_panel.sitepanelparameter_set.order_by('fcs_number')
+    def get_data_offsets(self):
+        """
+        Returns the inclusive (start, end) byte offsets of the DATA segment
+        in the sample's FCS file
+        """
+        self.sample_file.open('rb')
+        try:
+            header = parse_fcs_header(self.sample_file.read(FCS_HEADER_SIZE))
+        finally:
+            self.sample_file.close()
+
+        # the HEADER offsets take precedence over the TEXT, unless 0
+        metadata = self.get_fcs_metadata()
+        data_start = header['data_start'] or int(metadata['begindata'])
+        data_end = header['data_end'] or int(metadata['enddata'])
+
+        # some cytometers write $ENDDATA one past the last byte of the file
+        data_end = min(data_end, self.sample_file.size - 1)
+
+        return data_start, data_end
+
+    def iter_events(self, fcs_numbers, start, stop, chunk_size=65536):
+        """
+        Returns an iterator of the events from index start up to stop,
+        for the given channels (in the order given), as 2-D float32 arrays
+        of at most chunk_size events. The DATA segment is memory mapped, so
+        only the requested events are read from disk. Raises
+        ValidationError up front if the DATA can't be mapped.
+        """
+        events, get_columns = self._map_events(fcs_numbers)
+
+        def iter_chunks():
+            for chunk_start in range(start, stop, chunk_size):
+                yield get_columns(
+                    events[chunk_start:min(stop, chunk_start + chunk_size)]
+                )
+
+        return iter_chunks()
+
+    def _map_events(self, fcs_numbers):
+        """
+        Memory map the events, returning the mapped array of events and a
+        function converting a selection of its rows to a 2-D float32 array
+        of the given channels. The event store is used if it's been built,
+        otherwise the DATA segment of the FCS file.
+        """
+        if self.event_store:
+            events = np.load(self.event_store.path, mmap_mode='r')
+            columns = [n - 1 for n in fcs_numbers]
+
+            def get_store_columns(rows):
+                return rows[:, columns]
+
+            return events, get_store_columns
+
+        metadata = self.get_fcs_metadata()
+        data_start, data_end = self.get_data_offsets()
+        try:
+            events = np.memmap(
+                self.sample_file.path,
+                dtype=get_fcs_event_dtype(metadata),
+                mode='r',
+                offset=data_start,
+                shape=(int(metadata['tot']),)
+            )
+        except ValueError:
+            # numpy refuses to map past the end of the file
+            raise ValidationError(
+                "FCS file is truncated, the DATA segment ends past the file end"
+            )
+        bitmasks = [
+            get_fcs_channel_bitmask(metadata, n) for n in fcs_numbers
+        ]
+
+        def get_columns(rows):
+            columns = np.empty((len(rows), len(fcs_numbers)), dtype=np.float32)
+            for i, n in enumerate(fcs_numbers):
+                if bitmasks[i] is None:
+                    columns[:, i] = rows['p%d' % n]
+                else:
+                    columns[:, i] = rows['p%d' % n] & bitmasks[i]
+
+            return columns
+
+        return events, get_columns
+
+    def write_event_store(self, chunk_size=65536):
+        """
+        Build the event store from the FCS DATA segment, replacing any
+        previous one, so later reads of the events don't need to decode
+        the FCS file. The store can be memory mapped with
+        np.load(path, mmap_mode='r').
+        """
+        fcs_numbers = range(1, int(self.get_fcs_metadata()['par']) + 1)
+        events, get_columns = self._map_events(fcs_numbers)
+
+        store_file = TemporaryFile()
+        write_npy_chunks(
+            store_file,
+            (len(events), len(fcs_numbers)),
+            (
+                get_columns(events[chunk_start:chunk_start + chunk_size])
+                for chunk_start in range(0, len(events), chunk_size)
+            )
+        )
+        store_file.seek(0)
+
+        if self.event_store:
+            self.event_store.delete(save=False)
+        self.event_store.save(
+            '%d.npy' % self.id,
+            File(store_file),
+            save=False
+        )
+        store_file.close()
+        Sample.objects.filter(id=self.id).update(
+            event_store=self.event_store.name
+        )
+
+    def get_subsample_path(self, subsample_count, seed):
+        """
+        Returns the path of a cached .npy file holding a random subsample
+        of the sample's events, generating it if necessary. The array is
+        float64 with the original event index in the 1st column, followed
+        by every channel in FCS order. The same count & seed always give
+        the same subsample.
+        """
+        def write_subsample(subsample_file):
+            metadata = self.get_fcs_metadata()
+            fcs_numbers = range(1, int(metadata['par']) + 1)
+            events, get_columns = self._map_events(fcs_numbers)
+            indices = get_subsample_indices(
+                len(events),
+                subsample_count,
+                seed
+            )
+
+            subsample = np.empty(
+                (len(indices), len(fcs_numbers) + 1),
+                dtype=np.float64
+            )
+            subsample[:, 0] = indices
+            subsample[:, 1:] = get_columns(events[indices])
+
+            np.save(subsample_file, subsample)
+
+        return get_cached_file(
+            'subsample',
+            get_cache_key(self.sha1, subsample_count, seed),
+            '.npy',
+            write_subsample
+        )
+
+    def get_preprocessed_path(self, frozen_compensation, transform, params,
+                              chunk_size=65536):
+        """
+        Returns the path of a cached float32 .npy file of the sample's
+        events (every channel, in FCS order) compensated with the given
+        FrozenCompensation, then with the named transform (see TRANSFORMS)
+        applied to the compensated channels. The file is generated if
+        necessary, keyed by the sample, compensation & transform params.
+        """
+        par = int(self.get_fcs_metadata()['par'])
+        comp_fcs_numbers, spill = frozen_compensation.get_matrix()
+        if not set(comp_fcs_numbers) <= set(range(1, par + 1)):
+            raise ValidationError(
+                "Compensation channels don't match the sample's channels"
+            )
+        comp_columns = [n - 1 for n in comp_fcs_numbers]
+        try:
+            TRANSFORMS[transform](np.zeros(1), **params)
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+        def preprocess(chunk):
+            chunk = compensate(chunk.astype(np.float64), comp_columns, spill)
+            chunk[:, comp_columns] = TRANSFORMS[transform](
+                chunk[:, comp_columns],
+                **params
+            )
+
+            return chunk
+
+        def write_preprocessed(preprocessed_file):
+            events, get_columns = self._map_events(range(1, par + 1))
+            write_npy_chunks(
+                preprocessed_file,
+                (len(events), par),
+                (
+                    preprocess(
+                        get_columns(
+                            events[chunk_start:chunk_start + chunk_size]
+                        )
+                    )
+                    for chunk_start in range(0, len(events), chunk_size)
+                )
+            )
+
+        return get_cached_file(
+            'preprocessed',
+            self.get_preprocessed_key(frozen_compensation, transform, params),
+            '.npy',
+            write_preprocessed
+        )
+
+    def get_preprocessed_key(self, frozen_compensation, transform, params):
+        """ Identifies the content of a preprocessed events file """
+        return get_cache_key(
+            self.sha1,
+            frozen_compensation.sha1,
+            transform,
+            sorted(params.items())
+        )
+
+    def get_clean_channels(self):
+        """
+        Returns a list of (fcs_number, channel name, parameter type) tuples
+        for the site panel parameters in channel order. Clean channel names
+        are built from the markers, fluorochrome & parameter type.
+        """
+        params = self.site_panel.sitepanelparameter_set.select_related(
+            'fluorochrome'
+        ).prefetch_related(
+            models.Prefetch(
+                'sitepanelparametermarker_set',
+                queryset=SitePanelParameterMarker.objects.select_related(
+                    'marker'
+                ).order_by('marker__marker_abbreviation')
+            )
+        ).order_by('fcs_number')
+
+        channels = []
         for param in params:
             name_components = []
-            markers = param.sitepanelparametermarker_set.order_by(
-                'marker__marker_abbreviation'
-            )
 
-            for m in markers:
+            for m in param.sitepanelparametermarker_set.all():
                 name_components.append(m.marker.marker_abbreviation)
 
             if param.fluorochrome is not None:
@@ -1181,15 +1543,53 @@ class Sample(ProtectedModel):
             else:
                 channel_string = " ".join(name_components)
 
-            channel_names.append(channel_string)
-            if param.parameter_type == 'FLR':
-                fluoro_channel_names.append(channel_string)
+            channels.append(
+                (param.fcs_number, channel_string, param.parameter_type)
+            )
 
-            # add PnDISPLAY key/value if present in original metadata
-            p_display_str = 'P%dDISPLAY' % (param.fcs_number)
+        return channels
 
-            if p_display_str.lower() in flow_data.text:
-                extra_non_standard[p_display_str] = flow_data.text[p_display_str.lower()]
+    def get_clean_fcs_key(self):
+        """
+        Returns the cache key of the sample's clean FCS file, derived from
+        the original file & the clean channel names, so any change to the
+        site panel, markers or fluorochromes results in a new key
+        """
+        key_values = [CLEAN_FCS_VERSION, self.sha1]
+        for channel in self.get_clean_channels():
+            key_values.extend(channel)
+
+        return get_cache_key(*key_values)
+
+    def get_clean_fcs_path(self):
+        """
+        Returns the path of the sample's clean FCS file, generating it
+        if it isn't already cached
+        """
+        return get_cached_file(
+            'clean_fcs',
+            self.get_clean_fcs_key(),
+            '.fcs',
+            self.write_clean_fcs
+        )
+
+    def get_clean_fcs(self):
+        return open_generated_file(self.get_clean_fcs_path)
+
+    def write_clean_fcs(self, clean_file):
+        """
+        Write the clean version of the sample's FCS file: a new HEADER &
+        TEXT segment with the clean channel names, followed by the DATA
+        segment copied unchanged from the original file. Events are never
+        decoded, so this runs at disk speed with constant memory.
+        """
+        metadata = self.get_fcs_metadata()
+        channels = self.get_clean_channels()
+        fluoro_channel_names = [
+            channel_string
+            for fcs_number, channel_string, param_type in channels
+            if param_type == 'FLR'
+        ]  # used for spill later on
 
         # get compensation matrix from the FCS metadata $SPILL or $SPILLOVER
         # keys if available. If found, we need to replace the header values
@@ -1197,15 +1597,11 @@ class Sample(ProtectedModel):
         # $PnN values.
         # Note: ReFlow saves all metadata keys without '$' and in lowercase.
         new_spill_string = None
-        orig_spill = SampleMetadata.objects.filter(
-            key__in=['spill', 'spillover'],
-            sample=self
-        )
-        if orig_spill.count() > 0:
+        orig_spill = metadata.get('spillover', metadata.get('spill'))
+        if orig_spill is not None:
             # noinspection PyBroadException
             try:
-                # we'll take the first spill we find
-                orig_spill_list = orig_spill[0].value.split(",")
+                orig_spill_list = orig_spill.split(",")
 
                 # 1st value is the number of compensated fluorescence channels
                 param_count = int(orig_spill_list[0])
@@ -1218,49 +1614,64 @@ class Sample(ProtectedModel):
                 # continue. It's not a required FCS metadata field.
                 new_spill_string = None
 
-        cytometer = SampleMetadata.objects.filter(
-            key='cyt',
-            sample=self
-        )
+        # the DATA segment is copied as is, so the keywords describing its
+        # layout are copied from the original TEXT
+        keywords = [
+            ('$BEGINANALYSIS', '0'),
+            ('$BEGINSTEXT', '0'),
+            ('$BYTEORD', metadata['byteord']),
+            ('$DATATYPE', metadata['datatype']),
+            ('$ENDANALYSIS', '0'),
+            ('$ENDSTEXT', '0'),
+            ('$MODE', metadata.get('mode', 'L')),
+            ('$NEXTDATA', '0'),
+            ('$PAR', metadata['par']),
+            ('$TOT', metadata['tot']),
+            ('$SPILLOVER', new_spill_string or ''),
+            ('$CYT', metadata.get('cyt', '')),
+            ('$DATE', metadata.get('date', '')),
+            ('$TIMESTEP', metadata.get('timestep', '')),
+            ('$BTIM', metadata.get('btim', '')),
+            ('$ETIM', metadata.get('etim', ''))
+        ]
+
+        for fcs_number, channel_string, param_type in channels:
+            keywords.extend(
+                [
+                    ('$P%dB' % fcs_number, metadata['p%db' % fcs_number]),
+                    (
+                        '$P%dE' % fcs_number,
+                        metadata.get('p%de' % fcs_number, '0,0')
+                    ),
+                    (
+                        '$P%dG' % fcs_number,
+                        metadata.get('p%dg' % fcs_number, '')
+                    ),
+                    ('$P%dR' % fcs_number, metadata['p%dr' % fcs_number]),
+                    ('$P%dN' % fcs_number, channel_string),
+                    # add PnDISPLAY key/value if present in original metadata
+                    (
+                        'P%dDISPLAY' % fcs_number,
+                        metadata.get('p%ddisplay' % fcs_number, '')
+                    )
+                ]
+            )
 
-        if cytometer.count() > 0:
-            cyt_value = cytometer[0].value
-        else:
-            cyt_value = None
+        keywords.append(('THRESHOLD', metadata.get('threshold', '')))
 
-        if 'date' in flow_data.text:
-            acq_date = flow_data.text['date']
-        else:
-            acq_date = None
-
-        if 'timestep' in flow_data.text:
-            extra['TIMESTEP'] = flow_data.text['timestep']
-
-        if 'btim' in flow_data.text:
-            extra['BTIM'] = flow_data.text['btim']
-
-        if 'etim' in flow_data.text:
-            extra['ETIM'] = flow_data.text['etim']
-
-        if 'threshold' in flow_data.text:
-            extra_non_standard['THRESHOLD'] = flow_data.text['threshold']
-
-        clean_file = TemporaryFile()
-        flowio.create_fcs(
-            flow_data.events,
-            channel_names,
-            clean_file,
-            spill=new_spill_string,
-            cyt=cyt_value,
-            date=acq_date,
-            extra=extra,
-            extra_non_standard=extra_non_standard
-        )
-        flow_data = None
-        self.sample_file.close()
-        clean_file.seek(0)
+        data_start, data_end = self.get_data_offsets()
 
-        return clean_file
+        self.sample_file.open('rb')
+        try:
+            write_spliced_fcs(
+                clean_file,
+                keywords,
+                self.sample_file,
+                data_start,
+                data_end
+            )
+        finally:
+            self.sample_file.close()
 
     def clean(self):
         """
@@ -1270,6 +1681,7 @@ class Sample(ProtectedModel):
             - Verify visit_type and site belong to the subject project
             - Save  original file name, since it may already exist on our side.
             - Save SHA-1 hash and check for duplicate FCS files in this project.
+            - Verify the DATA segment is complete and save the event count.
         """
 
         try:
@@ -1288,38 +1700,24 @@ class Sample(ProtectedModel):
                 "FCS file is required"
             )
 
-        try:
-            # get text section of FCS file for saving metadata later
-            self.sample_file.seek(10)
-            text_start = int(self.sample_file.read(8))
-            self.sample_file.seek(18)
-            text_end = int(self.sample_file.read(8))
-
-            self.sample_file.seek(text_start)
-            text = self.sample_file.read(text_end - text_start + 1)
+        # The FCSUploadHandler hashes and parses the file while it is being
+        # uploaded, otherwise (e.g. a file already on the server) we make
+        # our own single pass through the file to do the same
+        fcs_reader = getattr(self.sample_file.file, 'fcs_reader', None)
+        if fcs_reader is None:
+            try:
+                fcs_reader = read_fcs_file(self.sample_file)
+            except:
+                raise ValidationError(
+                    "Failed to create checksum for uploaded file"
+                )
 
-            self.sample_metadata_dict = parse_fcs_text(text)
-            text = None
-        except:
+        if fcs_reader.error is not None:
             raise ValidationError(
                 "The file uploaded does not appear to be an FCS file"
             )
 
-        try:
-            # calculate SHA-1 in 64KB chunks to avoid excessive memory use
-            buffer_size = 65536
-            file_hash = hashlib.sha1()
-            self.sample_file.seek(0)
-
-            while True:
-                chunk = self.sample_file.read(buffer_size)
-                if not chunk:
-                    break
-                file_hash.update(chunk)
-        except:
-            raise ValidationError(
-                "Failed to create checksum for uploaded file"
-            )
+        self.sample_metadata_dict = fcs_reader.metadata
 
         # Verify subject project is the same as the site and
         # visit project (if either site or visit is specified)
@@ -1343,17 +1741,18 @@ class Sample(ProtectedModel):
         # need to allow that case
         if self.id:
             # existing sample
-            if self.sha1 != file_hash.hexdigest():
+            if self.sha1 != fcs_reader.sha1:
                 raise ValidationError(
                     "You cannot replace an existing FCS file."
                 )
         else:
-            self.sha1 = file_hash.hexdigest()
+            self.sha1 = fcs_reader.sha1
 
-        other_sha_values_in_project = Sample.objects.filter(
-            subject__project=self.subject.project).exclude(
-                id=self.id).values_list('sha1', flat=True)
-        if self.sha1 in other_sha_values_in_project:
+        duplicates = Sample.objects.filter(
+            sha1=self.sha1,
+            subject__project_id=self.subject.project_id).exclude(
+                id=self.id)
+        if duplicates.exists():
             if hasattr(self.sample_file.file, 'temporary_file_path'):
                 temp_file_path = self.sample_file.file.temporary_file_path()
                 os.unlink(temp_file_path)
@@ -1370,84 +1769,104 @@ class Sample(ProtectedModel):
         else:
             raise ValidationError("No parameters found in FCS file")
 
-        # Get our parameter numbers from all the PnN matches
-        sample_params = {}  # parameter_number: PnN text
-        for key in self.sample_metadata_dict:
-            matches = re.search('^P(\d+)([N,S])$', key, flags=re.IGNORECASE)
-            if matches:
-                channel_number = matches.group(1)
-                n_or_s = str.lower(matches.group(2))
-                if channel_number not in sample_params:
-                    sample_params[channel_number] = {}
-                sample_params[channel_number][n_or_s] = \
-                    self.sample_metadata_dict[key]
-
-        # Now check parameters against the chosen site panel
-        # First, simply check the counts
-        panel_params = self.site_panel.sitepanelparameter_set.all()
-        if len(sample_params) != panel_params.count():
+        self.event_count = get_fcs_event_count(fcs_reader)
+
+        # Compare the file's channels to the chosen site panel, matching
+        # signatures means every PnN & PnS matches
+        fcs_channels = get_fcs_channels(self.sample_metadata_dict)
+        if get_fcs_channel_signature(fcs_channels) != \
+                self.site_panel.signature:
+            self._compare_site_panel_channels(fcs_channels)
+
+    def _compare_site_panel_channels(self, fcs_channels):
+        """
+        Compare the file's channels to the site panel parameters one by one,
+        raising ValidationError describing the first mismatch found
+        """
+        panel_params = dict(
+            [
+                (p.fcs_number, p)
+                for p in self.site_panel.sitepanelparameter_set.all()
+            ]
+        )
+        if len(fcs_channels) != len(panel_params):
             raise ValidationError(
                 "FCS parameter count does not match chosen site panel")
-        for channel_number in sample_params.keys():
-            try:
-                panel_param = panel_params.get(fcs_number=channel_number)
-            except ObjectDoesNotExist:
+        for channel_number, pnn, pns in fcs_channels:
+            if channel_number not in panel_params:
                 raise ValidationError(
                     "Channel number '%s' not found in chosen site panel" %
                     str(channel_number))
-            except MultipleObjectsReturned:
-                raise ValidationError(
-                    "Multiple channels found in chosen site panel " +
-                    "for channel number '%s'" % str(channel_number))
+            panel_param = panel_params[channel_number]
 
             # Compare PnN field, this field is required so error if not found
-            if 'n' in sample_params[channel_number]:
-                if sample_params[channel_number]['n'] != panel_param.fcs_text:
-                    raise ValidationError(
-                        "FCS PnN text for channel '%s' does not match panel"
-                        % str(channel_number))
-            else:
+            if pnn is None:
                 raise ValidationError(
                     "Required FCS field PnN not found in file for channel '%s'"
                     % str(channel_number))
+            if pnn != panel_param.fcs_text:
+                raise ValidationError(
+                    "FCS PnN text for channel '%s' does not match panel"
+                    % str(channel_number))
 
             # Compare PnS field, not required but if panel version exists
             # and file version doesn't we'll still error
-            if 's' in sample_params[channel_number]:
-                if sample_params[channel_number]['s'] != \
-                        panel_param.fcs_opt_text:
-                    raise ValidationError(
-                        "FCS PnS text for channel '%s' does not match panel"
-                        % str(channel_number))
-            else:
-                # file doesn't have PnS field, so panel param must be
-                # empty string
-                if panel_param.fcs_opt_text != '':
-                    raise ValidationError(
-                        "FCS PnS text for channel '%s' does not match panel"
-                        % str(channel_number))
+            if (pns or '') != (panel_param.fcs_opt_text or ''):
+                raise ValidationError(
+                    "FCS PnS text for channel '%s' does not match panel"
+                    % str(channel_number))
+
+        # everything matched, so the site panel's signature is missing
+        # (created before signatures existed) or stale
+        self.site_panel.update_signature()
 
     def save(self, *args, **kwargs):
-        """ Populate upload date on save """
+        """
+        Populate upload date & compact metadata on save, the indexed
+        metadata keys are saved in a single bulk insert
+        """
         if not self.id:
             self.upload_date = datetime.datetime.today()
             new_sample = True
         else:
             new_sample = False
 
-        super(Sample, self).save(*args, **kwargs)
-
         # save metadata if it's a new sample, otherwise save was called to
         # edit a sample and there won't be any sample_metadata_dict
         if new_sample:
-            for k, v in self.sample_metadata_dict.items():
-                try:
-                    SampleMetadata(
-                        sample=self,
-                        key=k,
-                        value=v.decode('utf-8', 'ignore')).save()
-                except Exception, e:
-                    print e
+            self.set_fcs_metadata(self.sample_metadata_dict)
+
+        super(Sample, self).save(*args, **kwargs)
+
+        if new_sample:
+            SampleMetadata.objects.bulk_create(self.build_sample_metadata())
+
+    def set_fcs_metadata(self, metadata):
+        """
+        Set the compact store of the complete TEXT segment from the raw
+        metadata dictionary parsed from the FCS file
+        """
+        metadata = dict(
+            (k, v.decode('utf-8', 'ignore')) for k, v in metadata.items()
+        )
+        self.fcs_metadata = zlib.compress(
+            json.dumps(metadata, separators=(',', ':'))
+        )
+
+    def build_sample_metadata(self):
+        """
+        Returns unsaved SampleMetadata for the INDEXED_METADATA_KEYS found
+        in the sample's metadata, ready for a bulk insert
+        """
+        metadata = self.get_fcs_metadata()
+        max_length = SampleMetadata._meta.get_field('value').max_length
+
+        return [
+            SampleMetadata(sample=self, key=k, value=metadata[k])
+            for k in INDEXED_METADATA_KEYS
+            # values too long for a row are still in fcs_metadata
+            if k in metadata and len(metadata[k]) <= max_length
+        ]
 
     def __unicode__(self):
         return u'Project: %s, Subject: %s, Sample File: %s' % (
@@ -1460,17 +1879,177 @@ class Sample(ProtectedModel):
 @receiver(models.signals.post_delete, sender=Sample)
 def delete_sample_file(sender, instance, *args, **kwargs):
     instance.sample_file.delete(save=False)
+    if instance.event_store:
+        instance.event_store.delete(save=False)
+
+
+class SampleJob(models.Model):
+    """
+    A background job for a Sample (see SAMPLE_JOB_TYPE_CHOICES), run by
+    the process_sample_jobs management command so heavy work on the FCS
+    events stays out of the upload request.
+    """
+    sample = models.ForeignKey(Sample)
+    job_type = models.CharField(
+        max_length=32,
+        null=False,
+        blank=False,
+        choices=SAMPLE_JOB_TYPE_CHOICES)
+    status = models.CharField(
+        max_length=32,
+        null=False,
+        blank=False,
+        default='Pending',
+        choices=STATUS_CHOICES)
+    status_message = models.CharField(
+        max_length=256,
+        null=True,
+        blank=True)
+    attempts = models.IntegerField(null=False, blank=False, default=0)
+    created_date = models.DateTimeField(
+        editable=False,
+        auto_now_add=True)
+    start_date = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False)
+    completion_date = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False)
+
+    class Meta:
+        unique_together = (('sample', 'job_type'),)
+        index_together = (('status', 'created_date'),)
+
+    def __unicode__(self):
+        return u'%s: %s (%s)' % (self.sample_id, self.job_type, self.status)
+
+
+class SampleChannelStatistics(models.Model):
+    """
+    Summary statistics of the raw event values for one channel of a Sample
+    """
+    sample = models.ForeignKey(Sample)
+    fcs_number = models.IntegerField(null=False, blank=False)
+    minimum = models.FloatField(null=False, blank=False)
+    maximum = models.FloatField(null=False, blank=False)
+    mean = models.FloatField(null=False, blank=False)
+    median = models.FloatField(null=False, blank=False)
+    std = models.FloatField(null=False, blank=False)
+
+    class Meta:
+        unique_together = (('sample', 'fcs_number'),)
+
+    def has_view_permission(self, user):
+        return self.sample.has_view_permission(user)
+
+    def __unicode__(self):
+        return u'%s: channel %d' % (self.sample_id, self.fcs_number)
+
+
+class SampleUpload(models.Model):
+    """
+    A resumable, chunked upload of a single FCS file. Chunks are written
+    directly to a staging file, and the byte ranges received so far are
+    tracked so a client can resume after a dropped connection. Once every
+    byte has arrived the upload is finalized into a Sample.
+    """
+    user = models.ForeignKey(User, null=False, blank=False, editable=False)
+    filename = models.CharField(
+        null=False,
+        blank=False,
+        max_length=256)
+    file_size = models.BigIntegerField(null=False, blank=False)
+    # JSON of the Sample annotation fields, see SAMPLE_ANNOTATION_FIELDS
+    annotations = models.TextField(null=False, blank=False)
+    # JSON list of the received, inclusive [start, end] byte ranges
+    received_ranges = models.TextField(
+        null=False,
+        blank=False,
+        editable=False,
+        default='[]')
+    created_date = models.DateTimeField(
+        editable=False,
+        auto_now_add=True)
+    # last time a chunk was received, uploads expire after a period of
+    # inactivity (see get_expiry_cutoff)
+    modified_date = models.DateTimeField(
+        editable=False,
+        auto_now=True,
+        db_index=True)
+
+    @staticmethod
+    def get_max_file_size():
+        return getattr(settings, 'SAMPLE_UPLOAD_MAX_SIZE', 20 * 1024 ** 3)
+
+    @staticmethod
+    def get_expiry_cutoff():
+        """
+        Returns the datetime before which inactive uploads are expired,
+        per the SAMPLE_UPLOAD_EXPIRY_HOURS setting
+        """
+        return datetime.datetime.now() - datetime.timedelta(
+            hours=getattr(settings, 'SAMPLE_UPLOAD_EXPIRY_HOURS', 48)
+        )
+
+    def _get_staging_path(self):
+        return os.path.join(
+            settings.MEDIA_ROOT,
+            'ReFlow-data',
+            'uploads',
+            '%d.part' % self.id
+        )
+
+    staging_path = property(_get_staging_path)
+
+    def get_received_ranges(self):
+        return json.loads(self.received_ranges)
+
+    def add_received_range(self, start, end):
+        self.received_ranges = json.dumps(
+            merge_byte_ranges(self.get_received_ranges() + [[start, end]])
+        )
+
+    def is_complete(self):
+        return self.get_received_ranges() == [[0, self.file_size - 1]]
+
+    def save(self, *args, **kwargs):
+        """ Create the empty staging file for new uploads """
+        new_upload = self.id is None
+
+        super(SampleUpload, self).save(*args, **kwargs)
+
+        if new_upload:
+            staging_dir = os.path.dirname(self.staging_path)
+            if not os.path.exists(staging_dir):
+                os.makedirs(staging_dir)
+            with open(self.staging_path, 'wb') as staging_file:
+                staging_file.truncate(self.file_size)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.user.username, self.filename)
+
+
+# noinspection PyUnusedLocal
+@receiver(models.signals.post_delete, sender=SampleUpload)
+def delete_staging_file(sender, instance, *args, **kwargs):
+    if os.path.exists(instance.staging_path):
+        os.unlink(instance.staging_path)
 
 
 class SampleMetadata(ProtectedModel):
     """
-    Key-value pairs for the metadata found in FCS samples
+    Key-value pairs for the commonly queried metadata found in FCS samples
+    (see INDEXED_METADATA_KEYS). The full TEXT segment is in
+    Sample.fcs_metadata
     """
     sample = models.ForeignKey(Sample)
     key = models.CharField(
         unique=False,
         null=False,
         blank=False,
+        db_index=True,
         max_length=256
     )
     value = models.CharField(
@@ -1530,6 +2109,65 @@ class FrozenCompensation(models.Model):
         self.sha1 = hashlib.sha1(self.matrix_text).hexdigest()
         super(FrozenCompensation, self).save(*args, **kwargs)
 
+    @staticmethod
+    def freeze(matrix_texts):
+        """
+        Returns a dict of the FrozenCompensation id for each SHA-1 of the
+        given matrix texts, creating those not frozen yet. Uses a query to
+        find the existing ones & one to create the rest.
+        """
+        matrix_texts = dict(
+            (hashlib.sha1(matrix_text).hexdigest(), matrix_text)
+            for matrix_text in matrix_texts
+        )
+
+        frozen_ids = dict(
+            FrozenCompensation.objects.filter(
+                sha1__in=matrix_texts.keys()
+            ).values_list('sha1', 'id')
+        )
+        new_sha1s = set(matrix_texts) - set(frozen_ids)
+
+        if new_sha1s:
+            FrozenCompensation.objects.bulk_create(
+                [
+                    FrozenCompensation(
+                        matrix_text=matrix_texts[sha1],
+                        sha1=sha1
+                    )
+                    for sha1 in new_sha1s
+                ]
+            )
+            # not every database returns the new primary keys
+            frozen_ids.update(
+                FrozenCompensation.objects.filter(
+                    sha1__in=new_sha1s
+                ).values_list('sha1', 'id')
+            )
+
+        return frozen_ids
+
+    def get_matrix(self):
+        """
+        Returns the channel numbers from the header row & the spillover
+        matrix as a square numpy array. Rows may be comma or tab delimited.
+        """
+        rows = [
+            re.split('\t|,', line.strip())
+            for line in self.matrix_text.splitlines()
+            if line.strip()
+        ]
+        if not rows or len(rows) != len(rows[0]) + 1 or \
+                any(len(row) != len(rows[0]) for row in rows):
+            raise ValidationError("Compensation matrix must be square")
+
+        try:
+            rows = np.array(rows, dtype=np.float64)
+        except ValueError:
+            raise ValidationError("Compensation matrix must be numeric")
+
+        return [int(n) for n in rows[0]], rows[1:]
+
 
 class SampleCollectionMember(ProtectedModel):
     """
@@ -1853,6 +2491,12 @@ class SampleCluster(ProtectedModel):
         max_digits=5,
         decimal_places=2
     )
+    # SHA-1 of the events file
+    events_sha1 = models.CharField(
+        null=True,
+        blank=True,
+        editable=False,
+        max_length=40)
 
     def _get_weight(self):
         """
@@ -1865,6 +2509,21 @@ class SampleCluster(ProtectedModel):
 
     weight = property(_get_weight)
 
+    def get_events_sha1(self):
+        """
+        Returns the SHA-1 of the events file, calculating & saving it
+        first for sample clusters created before it was stored
+        """
+        if self.events_sha1 is None:
+            self.events.open('rb')
+            self.events_sha1 = get_file_sha1(self.events)
+            self.events.close()
+            SampleCluster.objects.filter(id=self.id).update(
+                events_sha1=self.events_sha1
+            )
+
+        return self.events_sha1
+
     def has_view_permission(self, user):
         if self.cluster.has_view_permission(user):
             return True
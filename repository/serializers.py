@@ -525,9 +525,26 @@ class SampleSerializer(serializers.ModelSerializer):
             'exclude',
             'has_compensation',
             'sha1',
+            'event_count',
+            'processing_status',
         )
         read_only_fields = (
-            'original_filename', 'sha1', 'site_panel'
+            'original_filename', 'sha1', 'site_panel', 'event_count',
+            'processing_status'
+        )
+
+
+class SampleChannelStatisticsSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = SampleChannelStatistics
+        fields = (
+            'fcs_number',
+            'minimum',
+            'maximum',
+            'mean',
+            'median',
+            'std'
         )
 
 
@@ -544,6 +561,28 @@ class SamplePOSTSerializer(serializers.ModelSerializer):
         read_only_fields = ('original_filename', 'sha1')
 
 
+class SampleUploadSerializer(serializers.ModelSerializer):
+    url = serializers.HyperlinkedIdentityField(view_name='sample-upload-detail')
+    received_ranges = serializers.ListField(
+        source='get_received_ranges',
+        read_only=True
+    )
+    complete = serializers.BooleanField(source='is_complete', read_only=True)
+
+    class Meta:
+        model = SampleUpload
+        fields = (
+            'id',
+            'url',
+            'filename',
+            'file_size',
+            'received_ranges',
+            'complete',
+            'created_date',
+            'modified_date'
+        )
+
+
 class SampleMetadataSerializer(serializers.ModelSerializer):
     class Meta:
         model = SampleMetadata
@@ -0,0 +1,106 @@
+"""
+Benchmarks parse_fcs_text against the previous regex based parser on
+synthetic TEXT segments of various sizes. Run from the project root:
+
+    python repository/tests/benchmark_fcs_text.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from repository.utils import parse_fcs_text
+
+
+def regex_parse_fcs_text(text):
+    """the previous regex based parser, kept here for comparison"""
+    delimiter = text[0]
+
+    if delimiter == r'|':
+        delimiter = '\|'
+    elif delimiter == r'\a'[0]:
+        delimiter = '\\\\'
+
+    tmp = text[1:-1].replace('$', '')
+    regex = re.compile('(?<=[^%s])%s(?!%s)' % (
+        delimiter, delimiter, delimiter))
+    tmp = regex.split(tmp)
+    return dict(
+        zip(
+            [x.lower().replace(
+                delimiter + delimiter, delimiter) for x in tmp[::2]],
+            [x.replace(delimiter + delimiter, delimiter) for x in tmp[1::2]]
+        )
+    )
+
+
+def build_text(parameter_count, delimiter='/', escaped=False):
+    """build a TEXT segment resembling a cytometer's, w/ spillover"""
+    fields = [
+        ('$BEGINANALYSIS', '0'),
+        ('$ENDANALYSIS', '0'),
+        ('$BYTEORD', '4,3,2,1'),
+        ('$DATATYPE', 'F'),
+        ('$MODE', 'L'),
+        ('$NEXTDATA', '0'),
+        ('$TOT', '100000'),
+        ('$PAR', str(parameter_count)),
+        ('$CYT', 'LSRFortessa'),
+        ('$DATE', '18-OCT-2016'),
+        ('CREATOR', 'BD FACSDiva Software Version 8.0'),
+    ]
+    if escaped:
+        fields.append(('EXPERIMENT NAME', 'Panel 1%s2' % (delimiter * 2)))
+
+    for n in range(1, parameter_count + 1):
+        fields.extend([
+            ('$P%dN' % n, 'FL%d-A' % n),
+            ('$P%dS' % n, 'CD%d' % n),
+            ('$P%dB' % n, '32'),
+            ('$P%dE' % n, '0,0'),
+            ('$P%dR' % n, '262144'),
+            ('P%dDISPLAY' % n, 'LOG'),
+            ('P%dBS' % n, '-1'),
+            ('P%dMS' % n, '0'),
+        ])
+
+    spill = [str(parameter_count)]
+    spill.extend(['FL%d-A' % n for n in range(1, parameter_count + 1)])
+    spill.extend(['0.0125'] * parameter_count * parameter_count)
+    fields.append(('SPILL', ','.join(spill)))
+
+    return delimiter + delimiter.join(
+        [delimiter.join(field) for field in fields]
+    ) + delimiter
+
+
+def main():
+    print('%10s %8s %12s %12s %8s' % (
+        'parameters', 'escaped', 'regex (ms)', 'split (ms)', 'speedup'))
+
+    for parameter_count in (10, 25, 50, 100, 200):
+        for escaped in (False, True):
+            text = build_text(parameter_count, escaped=escaped)
+            number = max(10, 2000 // parameter_count)
+
+            regex_time = min(timeit.repeat(
+                lambda: regex_parse_fcs_text(text), number=number, repeat=3
+            )) / number
+            split_time = min(timeit.repeat(
+                lambda: parse_fcs_text(text), number=number, repeat=3
+            )) / number
+
+            print('%10d %8s %12.3f %12.3f %7.1fx' % (
+                parameter_count,
+                escaped,
+                regex_time * 1000,
+                split_time * 1000,
+                regex_time / split_time
+            ))
+
+
+if __name__ == '__main__':
+    main()
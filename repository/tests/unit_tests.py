@@ -2,16 +2,47 @@
 This file contains unit tests for the repository Django app.
 """
 
+from cStringIO import StringIO
+import csv
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import zlib
+
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.conf.global_settings import FILE_UPLOAD_TEMP_DIR
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.middleware.csrf import get_token
 
 from guardian.shortcuts import assign_perm
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+import numpy as np
 
 from repository.models import *
+from repository import api_views
+from repository import api_views_process_request
+from repository import controllers
+from repository import jobs
 from repository.tests import constants
+from repository.utils import parse_fcs_text, get_fcs_channels, \
+    get_fcs_channel_signature, read_fcs_file, write_spliced_fcs, \
+    get_fcs_event_count, get_fcs_event_dtype, get_file_sha1, \
+    get_subsample_indices, FCSStreamReader
+from repository.transforms import logicle
+from repository import cache
+from repository.cache import find_cached_file
+from repository.api_utils import iter_tar
 
 
 def testSetup():
@@ -19,6 +50,37 @@ def testSetup():
     User.objects.create_user('tester', password='tester', email=None)
 
 
+def build_fcs_content(events, channel_names, extra_data_bytes=0,
+                      extra_keywords=()):
+    """
+    Returns the content of a list mode FCS file with float32 events, the
+    DATA segment padded with extra_data_bytes
+    """
+    keywords = list(extra_keywords) + [
+        ('$BYTEORD', '1,2,3,4'),
+        ('$DATATYPE', 'F'),
+        ('$MODE', 'L'),
+        ('$NEXTDATA', '0'),
+        ('$PAR', str(len(channel_names))),
+        ('$TOT', str(len(events)))
+    ]
+    for i, name in enumerate(channel_names, 1):
+        keywords.extend(
+            [
+                ('$P%dB' % i, '32'),
+                ('$P%dE' % i, '0,0'),
+                ('$P%dN' % i, name),
+                ('$P%dR' % i, '262144')
+            ]
+        )
+
+    data = np.asarray(events, dtype='<f4').tostring() + '\0' * extra_data_bytes
+    fcs_file = StringIO()
+    write_spliced_fcs(fcs_file, keywords, StringIO(data), 0, len(data) - 1)
+
+    return fcs_file.getvalue()
+
+
 @override_settings(MEDIA_ROOT=FILE_UPLOAD_TEMP_DIR)
 class ModelsUnitTestCase(TestCase):
 
@@ -182,3 +244,2499 @@ class FormsUnitTestCase(TestCase):
         duplicate_form = MarkerForm(data=duplicate_form_data)
         self.assertEqual(duplicate_form.is_valid(), False)
 
+
+
+class UtilsUnitTestCase(TestCase):
+
+    def test_parse_fcs_text(self):
+        """
+        Keys are lowercase without the leading '$', doubled delimiters are
+        escaped delimiters within a key or value
+        """
+        metadata = parse_fcs_text(
+            '|$PAR|2|$P1N|FSC||A|$P2S|CD3$|GUID|a||b||c|'
+        )
+
+        self.assertEqual(
+            metadata,
+            {'par': '2', 'p1n': 'FSC|A', 'p2s': 'CD3$', 'guid': 'a|b|c'}
+        )
+
+    def test_fcs_channel_signature(self):
+        """
+        FCS file channels & site panel parameters with the same PnN & PnS
+        values have the same signature
+        """
+        metadata = {
+            'par': '3',
+            'p1n': 'FSC-A',
+            'p2n': 'SSC-A',
+            'p3n': 'FITC-A',
+            'p3s': 'CD3'
+        }
+        panel_channels = [
+            (3, u'FITC-A', u'CD3'),
+            (1, u'FSC-A', None),
+            (2, u'SSC-A', u'')
+        ]
+
+        self.assertEqual(
+            get_fcs_channel_signature(get_fcs_channels(metadata)),
+            get_fcs_channel_signature(panel_channels)
+        )
+
+        panel_channels[0] = (3, u'FITC-A', u'CD4')
+        self.assertNotEqual(
+            get_fcs_channel_signature(get_fcs_channels(metadata)),
+            get_fcs_channel_signature(panel_channels)
+        )
+
+    def test_logicle(self):
+        """
+        Logicle maps 0 to the scale position of the linear region (w / m
+        for a = 0), the top of the data range to 1 & is symmetric about 0
+        """
+        scale = logicle(
+            np.array([0.0, 262144.0, -1000.0, 1000.0]),
+            t=262144.0,
+            m=4.5,
+            w=0.5,
+            a=0.0
+        )
+
+        self.assertAlmostEqual(scale[0], 0.5 / 4.5)
+        self.assertAlmostEqual(scale[1], 1.0)
+        self.assertAlmostEqual(scale[2] + scale[3], 2 * scale[0])
+
+    def test_fcs_stream_reader(self):
+        """
+        Chunks of any size give the same SHA-1, TEXT (merged with the
+        supplemental TEXT) & DATA offsets
+        """
+        channel_names = ['FSC-A', 'SSC-A']
+        events = np.arange(20, dtype=np.float32).reshape(10, 2)
+        stext = '/CUSTOM/1/$P1N/OTHER/'
+
+        def build_content(stext_start, stext_end):
+            return build_fcs_content(
+                events,
+                channel_names,
+                extra_keywords=[
+                    ('$BEGINSTEXT', '%05d' % stext_start),
+                    ('$ENDSTEXT', '%05d' % stext_end)
+                ]
+            )
+
+        content_size = len(build_content(0, 0))
+        content = build_content(
+            content_size,
+            content_size + len(stext) - 1
+        ) + stext
+
+        for chunk_size in (1, 13, len(content)):
+            fcs_reader = FCSStreamReader()
+            for i in range(0, len(content), chunk_size):
+                fcs_reader.update(content[i:i + chunk_size])
+            fcs_reader.finish()
+
+            self.assertIsNone(fcs_reader.error)
+            self.assertEqual(
+                fcs_reader.sha1,
+                hashlib.sha1(content).hexdigest()
+            )
+            self.assertEqual(fcs_reader.size, len(content))
+            self.assertEqual(fcs_reader.metadata['p1n'], 'FSC-A')
+            self.assertEqual(fcs_reader.metadata['custom'], '1')
+            self.assertEqual(
+                content[fcs_reader.data_start:fcs_reader.data_end + 1],
+                events.astype('<f4').tostring()
+            )
+
+        for content in ('not an FCS file' * 10, content[:200]):
+            fcs_reader = FCSStreamReader()
+            fcs_reader.update(content)
+            fcs_reader.finish()
+            self.assertIsNotNone(fcs_reader.error)
+
+    def test_fcs_event_count_enddata_past_file_end(self):
+        """
+        A DATA segment one byte longer than the events, whose $ENDDATA is
+        one past the end of the file, is accepted
+        """
+        events = np.arange(30, dtype=np.float32).reshape(10, 3)
+        content = build_fcs_content(
+            events,
+            ['FSC-A', 'SSC-A', 'FITC-A'],
+            extra_data_bytes=1
+        )
+
+        fcs_reader = read_fcs_file(StringIO(content[:-1]))
+
+        self.assertEqual(fcs_reader.data_end, fcs_reader.size)
+        self.assertEqual(get_fcs_event_count(fcs_reader), 10)
+
+    def test_fcs_event_count_truncated(self):
+        """ A file missing part of its events is rejected """
+        events = np.arange(30, dtype=np.float32).reshape(10, 3)
+        content = build_fcs_content(events, ['FSC-A', 'SSC-A', 'FITC-A'])
+
+        self.assertEqual(
+            get_fcs_event_count(read_fcs_file(StringIO(content))),
+            10
+        )
+        self.assertRaises(
+            ValidationError,
+            get_fcs_event_count,
+            read_fcs_file(StringIO(content[:-4]))
+        )
+
+
+    def test_fcs_event_dtype_invalid_byte_order(self):
+        """ A non-numeric or unordered BYTEORD is a validation error """
+        metadata = {'par': '1', 'datatype': 'F', 'p1b': '32'}
+
+        metadata['byteord'] = '4,3,2,1'
+        self.assertEqual(
+            get_fcs_event_dtype(metadata),
+            np.dtype([('p1', '>f4')])
+        )
+
+        for byte_order in ('1,2,x,4', '', '2,1,3,4'):
+            metadata['byteord'] = byte_order
+            self.assertRaises(ValidationError, get_fcs_event_dtype, metadata)
+
+
+    def test_subsample_indices(self):
+        """
+        Indices are sorted, unique & the same for the same seed, whether
+        they're a small or large fraction of the events
+        """
+        for event_count, subsample_count in ((1000, 10), (1000, 500)):
+            indices = get_subsample_indices(event_count, subsample_count, 1)
+
+            self.assertEqual(len(indices), subsample_count)
+            self.assertEqual(len(np.unique(indices)), subsample_count)
+            self.assertTrue(np.all(np.diff(indices) > 0))
+            self.assertTrue(0 <= indices[0] and indices[-1] < event_count)
+            np.testing.assert_array_equal(
+                get_subsample_indices(event_count, subsample_count, 1),
+                indices
+            )
+            self.assertFalse(
+                np.array_equal(
+                    get_subsample_indices(event_count, subsample_count, 2),
+                    indices
+                )
+            )
+
+        np.testing.assert_array_equal(
+            get_subsample_indices(10, 20, 1),
+            np.arange(10)
+        )
+
+    def test_iter_tar(self):
+        """
+        Unicode content is UTF-8 encoded & file entries are read from the
+        path returned by their callable
+        """
+        with tempfile.NamedTemporaryFile() as entry_file:
+            entry_file.write('x' * 1000)
+            entry_file.flush()
+
+            archive = tarfile.open(
+                fileobj=StringIO(
+                    ''.join(
+                        iter_tar(
+                            [
+                                (u'a.txt', u'caf\xe9'),
+                                ('b.bin', lambda: entry_file.name)
+                            ]
+                        )
+                    )
+                )
+            )
+
+            self.assertEqual(archive.getnames(), ['a.txt', 'b.bin'])
+            self.assertEqual(
+                archive.extractfile('a.txt').read(),
+                u'caf\xe9'.encode('utf-8')
+            )
+            self.assertEqual(archive.extractfile('b.bin').read(), 'x' * 1000)
+
+
+@override_settings(
+    DERIVED_FILE_CACHE_SIZE=1000,
+    DERIVED_FILE_CACHE_EVICT_INTERVAL=3600
+)
+class CacheUnitTestCase(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_settings = self.settings(
+            DERIVED_FILE_CACHE_DIR=self.cache_dir
+        )
+        self.cache_settings.enable()
+        cache._written_size = 0
+        self.generated = []
+
+    def tearDown(self):
+        self.cache_settings.disable()
+        shutil.rmtree(self.cache_dir)
+
+    def get_cached_file(self, key, content):
+        def generate(cache_file):
+            self.generated.append(key)
+            cache_file.write(content)
+
+        return cache.get_cached_file('test', key, '.txt', generate)
+
+    def test_evict_cached_files(self):
+        """
+        The cache is only walked for eviction once the interval has passed
+        or a tenth of the size has been written, least recently used
+        entries are evicted first
+        """
+        paths = [
+            self.get_cached_file('key_%d' % i, 'x' * 20) for i in range(4)
+        ]
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+        find_cached_file('test', 'key_0', '.txt')
+        for i, path in enumerate(paths):
+            os.utime(path, (i if i else 10, os.stat(path).st_mtime))
+
+        # evicted recently & not much written since
+        cache._written_size = 0
+        with self.settings(DERIVED_FILE_CACHE_SIZE=45):
+            self.get_cached_file('key_4', 'x')
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+        self.assertEqual(cache.evict_cached_files(45), 40)
+        self.assertEqual(
+            [os.path.exists(path) for path in paths],
+            [True, False, False, True]
+        )
+
+        with self.settings(DERIVED_FILE_CACHE_SIZE=30):
+            self.get_cached_file('key_5', 'x' * 20)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_open_generated_file_evicted(self):
+        """ An entry evicted before it's opened is generated again """
+        def get_path():
+            path = self.get_cached_file('key', 'content')
+            if len(self.generated) == 1:
+                os.unlink(path)
+            return path
+
+        with cache.open_generated_file(get_path) as cache_file:
+            self.assertEqual(cache_file.read(), 'content')
+        self.assertEqual(self.generated, ['key', 'key'])
+
+
+class SampleUnitTestCase(TestCase):
+    """
+    Base test case with a project & site panel (FSC-A, SSC-A, FITC-A)
+    ready for uploading samples
+    """
+
+    channel_names = ['FSC-A', 'SSC-A', 'FITC-A']
+
+    def setUp(self):
+        # sample files & the files derived from them go in a temporary
+        # directory removed after each test
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = self.settings(
+            MEDIA_ROOT=self.media_root,
+            DERIVED_FILE_CACHE_DIR=os.path.join(self.media_root, 'cache')
+        )
+        self.media_settings.enable()
+
+        testSetup()
+        self.test_user = User.objects.get(username='tester')
+        self.factory = APIRequestFactory()
+
+        self.project = Project.objects.create(project_name='Project S')
+        for permission in (
+                'view_project_data',
+                'add_project_data',
+                'modify_project_data',
+                'submit_process_requests'):
+            assign_perm(permission, self.test_user, self.project)
+
+        self.site = Site.objects.create(project=self.project, site_name='S1')
+        self.panel_template = PanelTemplate.objects.create(
+            project=self.project,
+            panel_name='Panel S'
+        )
+        self.panel_variant = PanelVariant.objects.create(
+            panel_template=self.panel_template,
+            staining_type='FULL',
+            name=''
+        )
+        self.site_panel = self.create_site_panel()
+
+        self.sample_data = {
+            'acquisition_date': '2016-01-01',
+            'subject': Subject.objects.create(
+                project=self.project,
+                subject_code='S001'
+            ).id,
+            'visit': VisitType.objects.create(
+                project=self.project,
+                visit_type_name='Visit S'
+            ).id,
+            'panel_variant': self.panel_variant.id,
+            'site_panel': self.site_panel.id,
+            'pretreatment': 'Ex vivo',
+            'storage': 'Fresh',
+            'specimen': Specimen.objects.create(
+                specimen_name='Specimen S',
+                specimen_description='Specimen S'
+            ).id,
+            'stimulation': Stimulation.objects.create(
+                project=self.project,
+                stimulation_name='Stimulation S'
+            ).id
+        }
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def create_site_panel(self, panel_template=None, site=None):
+        """ Returns a new site panel, FSC-A & SSC-A are scatter channels """
+        site_panel = SitePanel.objects.create(
+            panel_template=panel_template or self.panel_template,
+            site=site or self.site
+        )
+        for fcs_number, (fcs_text, parameter_type) in enumerate(
+                zip(self.channel_names, ('FSC', 'SSC', 'FLR')), 1):
+            SitePanelParameter.objects.create(
+                site_panel=site_panel,
+                parameter_type=parameter_type,
+                parameter_value_type='A',
+                fcs_text=fcs_text,
+                fcs_number=fcs_number
+            )
+
+        return site_panel
+
+    def build_events(self, event_count=100, seed=0):
+        return np.random.RandomState(seed).uniform(
+            0,
+            1000,
+            size=(event_count, len(self.channel_names))
+        ).astype(np.float32)
+
+    def build_fcs_file(self, events, filename='test.fcs', **kwargs):
+        return SimpleUploadedFile(
+            filename,
+            build_fcs_content(events, self.channel_names, **kwargs)
+        )
+
+    def create_sample(self, events, filename='test.fcs', **kwargs):
+        return controllers.create_sample(
+            self.sample_data,
+            self.build_fcs_file(events, filename, **kwargs)
+        )
+
+
+class SampleUploadUnitTestCase(SampleUnitTestCase):
+
+    def test_create_sample_session_authentication(self):
+        """
+        The FCS upload handler is installed before SessionAuthentication's
+        CSRF check parses the POST data, and parses the uploaded file
+        """
+        factory = APIRequestFactory(enforce_csrf_checks=True)
+        data = dict(self.sample_data)
+        data['sample_file'] = self.build_fcs_file(self.build_events())
+        request = factory.post(
+            '/api/repository/samples/add/',
+            data,
+            format='multipart'
+        )
+        request.META['HTTP_X_CSRFTOKEN'] = get_token(request)
+        request.user = self.test_user
+
+        response = api_views.CreateSample.as_view()(request)
+
+        self.assertEqual(response.status_code, 201)
+        sample = Sample.objects.get(id=response.data['id'])
+        self.assertEqual(sample.event_count, 100)
+        fcs_reader = request.upload_handlers[0].fcs_reader
+        self.assertEqual(fcs_reader.sha1, sample.sha1)
+
+
+    def test_create_sample_truncated(self):
+        """
+        Files whose DATA segment is shorter than $TOT events are rejected,
+        the event count of complete files is stored
+        """
+        content = build_fcs_content(self.build_events(), self.channel_names)
+
+        with self.assertRaises(ValidationError):
+            controllers.create_sample(
+                self.sample_data,
+                SimpleUploadedFile('test.fcs', content[:-4])
+            )
+        self.assertFalse(Sample.objects.exists())
+
+        sample = controllers.create_sample(
+            self.sample_data,
+            SimpleUploadedFile('test.fcs', content)
+        )
+        self.assertEqual(Sample.objects.get(id=sample.id).event_count, 100)
+
+
+class SampleMetadataUnitTestCase(SampleUnitTestCase):
+
+    def get_metadata_response(self, sample, user=None):
+        request = self.factory.get(
+            '/api/repository/samples/%d/metadata/' % sample.id
+        )
+        force_authenticate(request, user=user or self.test_user)
+
+        return api_views.retrieve_sample_metadata(request, pk=sample.id)
+
+    def test_sample_metadata(self):
+        """
+        Only the indexed keys get SampleMetadata rows, every key is in the
+        sample's compact store & returned by the metadata endpoint
+        """
+        sample = self.create_sample(
+            self.build_events(),
+            extra_keywords=[('$CYT', 'Cytometer'), ('CUSTOM', 'x')]
+        )
+
+        self.assertEqual(
+            dict(sample.samplemetadata_set.values_list('key', 'value')),
+            {'cyt': 'Cytometer', 'tot': '100', 'par': '3'}
+        )
+        metadata = Sample.objects.get(id=sample.id).get_fcs_metadata()
+        self.assertEqual(metadata['custom'], 'x')
+        self.assertEqual(metadata['p3n'], 'FITC-A')
+
+        response = self.get_metadata_response(sample)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.data,
+            [{'key': k, 'value': metadata[k]} for k in sorted(metadata)]
+        )
+
+        other_user = User.objects.create_user('other', password='other')
+        response = self.get_metadata_response(sample, other_user)
+        self.assertEqual(response.status_code, 403)
+
+    def test_sample_metadata_without_store(self):
+        """ Samples without the compact store use their SampleMetadata """
+        sample = self.create_sample(self.build_events())
+        Sample.objects.filter(id=sample.id).update(fcs_metadata=None)
+
+        self.assertEqual(
+            Sample.objects.get(id=sample.id).get_fcs_metadata(),
+            {'tot': '100', 'par': '3'}
+        )
+
+
+class SampleDuplicateUnitTestCase(SampleUnitTestCase):
+
+    def find_existing(self, data, user=None):
+        request = self.factory.post(
+            '/api/repository/samples/existing/',
+            data,
+            format='json'
+        )
+        force_authenticate(request, user=user or self.test_user)
+
+        return api_views.find_existing_samples(request)
+
+    def test_find_existing_samples(self):
+        """
+        Digests of files already in the project are returned, in any case
+        """
+        sample = self.create_sample(self.build_events())
+        other_sha1 = hashlib.sha1('other').hexdigest()
+
+        response = self.find_existing(
+            {
+                'project': self.project.id,
+                'sha1': [sample.sha1.upper(), other_sha1]
+            }
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'existing': [sample.sha1]})
+
+        other_project = Project.objects.create(project_name='Project T')
+        assign_perm('add_project_data', self.test_user, other_project)
+        Site.objects.create(project=other_project, site_name='T1')
+        response = self.find_existing(
+            {'project': other_project.id, 'sha1': [sample.sha1]}
+        )
+        self.assertEqual(response.data, {'existing': []})
+
+        for data in ({'project': self.project.id}, {'sha1': []}):
+            self.assertEqual(self.find_existing(data).status_code, 400)
+
+        other_user = User.objects.create_user('other', password='other')
+        response = self.find_existing(
+            {'project': self.project.id, 'sha1': []},
+            other_user
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_duplicate_sample(self):
+        """ A file can't be uploaded twice to the same project """
+        self.create_sample(self.build_events())
+
+        with self.assertRaises(ValidationError):
+            self.create_sample(self.build_events(), 'copy.fcs')
+        self.assertEqual(Sample.objects.count(), 1)
+
+
+class SampleBatchUploadUnitTestCase(SampleUnitTestCase):
+
+    def post_batch(self, manifest, files):
+        data = dict(files)
+        data['manifest'] = json.dumps(manifest)
+        request = self.factory.post(
+            '/api/repository/samples/add_batch/',
+            data,
+            format='multipart'
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views.CreateSampleBatch.as_view()(request)
+
+    def build_sample_file(self, seed, filename):
+        return self.build_fcs_file(self.build_events(seed=seed), filename)
+
+    def build_manifest_item(self, filename, **kwargs):
+        annotations = dict(self.sample_data, filename=filename)
+        annotations.update(kwargs)
+
+        return annotations
+
+    def test_batch_upload_files(self):
+        """ Every file in the manifest is created from its own file field """
+        response = self.post_batch(
+            [self.build_manifest_item(f) for f in ('a.fcs', 'b.fcs')],
+            {
+                'file1': self.build_sample_file(1, 'a.fcs'),
+                'file2': self.build_sample_file(2, 'b.fcs')
+            }
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            [result['filename'] for result in response.data],
+            ['a.fcs', 'b.fcs']
+        )
+        self.assertEqual(
+            sorted(Sample.objects.values_list('original_filename', flat=True)),
+            [u'a.fcs', u'b.fcs']
+        )
+
+    def test_batch_upload_archive(self):
+        """ The files may be sent as a single tar archive """
+        archive_file = StringIO()
+        archive = tarfile.open(fileobj=archive_file, mode='w:gz')
+        for seed, filename in enumerate(('a.fcs', 'b.fcs')):
+            content = build_fcs_content(
+                self.build_events(seed=seed),
+                self.channel_names
+            )
+            member = tarfile.TarInfo(filename)
+            member.size = len(content)
+            archive.addfile(member, StringIO(content))
+        archive.close()
+
+        response = self.post_batch(
+            [self.build_manifest_item(f) for f in ('a.fcs', 'b.fcs')],
+            {
+                'archive': SimpleUploadedFile(
+                    'samples.tar.gz',
+                    archive_file.getvalue()
+                )
+            }
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Sample.objects.count(), 2)
+
+    def test_batch_upload_errors(self):
+        """
+        Invalid items get an error in their result, without affecting the
+        rest of the batch
+        """
+        response = self.post_batch(
+            [
+                self.build_manifest_item('a.fcs'),
+                self.build_manifest_item('b.fcs', site_panel='x'),
+                self.build_manifest_item('c.fcs', site_panel=-1),
+                self.build_manifest_item('missing.fcs'),
+                self.build_manifest_item('d.fcs')
+            ],
+            {
+                'file1': self.build_sample_file(1, 'a.fcs'),
+                'file2': self.build_sample_file(2, 'b.fcs'),
+                'file3': self.build_sample_file(3, 'c.fcs'),
+                # duplicate of a.fcs
+                'file4': self.build_sample_file(1, 'd.fcs')
+            }
+        )
+
+        self.assertEqual(response.status_code, 207)
+        self.assertIn('sample', response.data[0])
+        for result in response.data[1:]:
+            self.assertNotIn('sample', result)
+            self.assertIn('detail', result)
+        self.assertEqual(
+            response.data[1]['detail'],
+            'Site panel does not exist'
+        )
+        self.assertEqual(
+            response.data[3]['detail'],
+            'File not found in upload'
+        )
+        self.assertEqual(Sample.objects.count(), 1)
+
+    def test_batch_upload_duplicate_names(self):
+        """
+        File names found more than once in the archive or in the manifest
+        are ambiguous, their items get an error instead of a sample
+        """
+        archive_file = StringIO()
+        archive = zipfile.ZipFile(archive_file, 'w')
+        members = ('siteA/001.fcs', 'siteB/001.fcs', 'a.fcs', 'b.fcs')
+        for seed, filename in enumerate(members):
+            archive.writestr(
+                filename,
+                build_fcs_content(
+                    self.build_events(seed=seed),
+                    self.channel_names
+                )
+            )
+        archive.close()
+
+        response = self.post_batch(
+            [
+                self.build_manifest_item(f)
+                for f in ('001.fcs', 'a.fcs', 'a.fcs', 'b.fcs')
+            ],
+            {
+                'archive': SimpleUploadedFile(
+                    'samples.zip',
+                    archive_file.getvalue()
+                )
+            }
+        )
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(
+            [result.get('detail') for result in response.data],
+            [
+                'Duplicate file name in upload',
+                'Duplicate file name in manifest',
+                'Duplicate file name in manifest',
+                None
+            ]
+        )
+        self.assertEqual(
+            list(Sample.objects.values_list('original_filename', flat=True)),
+            [u'b.fcs']
+        )
+
+    def test_batch_upload_invalid_manifest(self):
+        """ The manifest must be a JSON list of annotations """
+        response = self.post_batch('not a list', {})
+        self.assertEqual(response.status_code, 400)
+
+        request = self.factory.post(
+            '/api/repository/samples/add_batch/',
+            {'manifest': '[{'},
+            format='multipart'
+        )
+        force_authenticate(request, user=self.test_user)
+        response = api_views.CreateSampleBatch.as_view()(request)
+        self.assertEqual(response.status_code, 400)
+
+
+class SampleEventsUnitTestCase(SampleUnitTestCase):
+
+    def get_events_response(self, sample, **query_params):
+        request = self.factory.get(
+            '/api/repository/samples/%d/events/' % sample.id,
+            query_params
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views.retrieve_sample_events(request, pk=sample.id)
+
+    def read_events(self, response):
+        self.assertEqual(response.status_code, 200)
+
+        return np.load(StringIO(''.join(response.streaming_content)))
+
+    def test_events(self):
+        """
+        Events are returned for the requested channels, in the requested
+        order, & event range
+        """
+        events = self.build_events()
+        sample = self.create_sample(events)
+
+        response = self.get_events_response(sample)
+        np.testing.assert_array_equal(self.read_events(response), events)
+
+        response = self.get_events_response(
+            sample,
+            channels='3,1',
+            start=10,
+            stop=20
+        )
+        etag = response['ETag']
+        subset = self.read_events(response)
+        self.assertEqual(subset.dtype, np.float32)
+        np.testing.assert_array_equal(subset, events[10:20, [2, 0]])
+
+        response = self.get_events_response(sample, start=90, stop=1000)
+        np.testing.assert_array_equal(
+            self.read_events(response),
+            events[90:]
+        )
+
+        request = self.factory.get(
+            '/api/repository/samples/%d/events/' % sample.id,
+            {'channels': '3,1', 'start': 10, 'stop': 20},
+            HTTP_IF_NONE_MATCH=etag
+        )
+        force_authenticate(request, user=self.test_user)
+        response = api_views.retrieve_sample_events(request, pk=sample.id)
+        self.assertEqual(response.status_code, 304)
+
+    def test_events_invalid_parameters(self):
+        """ Unknown channels & invalid event ranges are a bad request """
+        sample = self.create_sample(self.build_events())
+
+        for query_params in (
+                {'channels': '1,4'},
+                {'channels': 'FSC-A'},
+                {'start': 'x'},
+                {'start': -1},
+                {'start': 20, 'stop': 10}):
+            response = self.get_events_response(sample, **query_params)
+            self.assertEqual(response.status_code, 400)
+
+    def get_subsample_response(self, sample, **query_params):
+        request = self.factory.get(
+            '/api/repository/samples/%d/subsample/' % sample.id,
+            query_params
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views.retrieve_sample_subsample(request, pk=sample.id)
+
+    def test_subsample(self):
+        """
+        A subsample is the events at its indices, the same for the same
+        seed & cached
+        """
+        events = self.build_events()
+        sample = self.create_sample(events)
+
+        subsample = self.read_events(
+            self.get_subsample_response(sample, count=10, seed=1)
+        )
+        self.assertEqual(subsample.shape, (10, 4))
+        indices = subsample[:, 0].astype(np.int64)
+        np.testing.assert_array_equal(
+            subsample[:, 1:],
+            events[indices]
+        )
+        np.testing.assert_array_equal(
+            np.load(sample.get_subsample_path(10, 1)),
+            subsample
+        )
+
+        np.testing.assert_array_equal(
+            self.read_events(
+                self.get_subsample_response(sample, count=10, seed=1)
+            ),
+            subsample
+        )
+        self.assertFalse(
+            np.array_equal(
+                self.read_events(
+                    self.get_subsample_response(sample, count=10, seed=2)
+                ),
+                subsample
+            )
+        )
+        np.testing.assert_array_equal(
+            self.read_events(
+                self.get_subsample_response(sample, count=1000)
+            )[:, 1:],
+            events
+        )
+
+        for query_params in (
+                {},
+                {'count': 0},
+                {'count': 'x'},
+                {'count': 10, 'seed': -1}):
+            response = self.get_subsample_response(sample, **query_params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_event_store(self):
+        """
+        Events read from the event store match those decoded from the FCS
+        file, & a rebuilt store replaces the old one
+        """
+        events = self.build_events(1000)
+        sample = self.create_sample(events)
+
+        def read_events(fcs_numbers, start, stop):
+            return np.vstack(
+                list(sample.iter_events(fcs_numbers, start, stop, 64))
+            )
+
+        fcs_events = read_events([3, 1], 10, 900)
+        sample.write_event_store()
+        store_path = sample.event_store.path
+
+        np.testing.assert_array_equal(np.load(store_path), events)
+        np.testing.assert_array_equal(
+            read_events([3, 1], 10, 900),
+            fcs_events
+        )
+        self.assertEqual(
+            Sample.objects.get(id=sample.id).event_store.name,
+            sample.event_store.name
+        )
+
+        store_files = os.listdir(os.path.dirname(store_path))
+        sample.write_event_store()
+        self.assertEqual(
+            os.listdir(os.path.dirname(store_path)),
+            store_files
+        )
+        np.testing.assert_array_equal(np.load(sample.event_store.path), events)
+
+        store_path = sample.event_store.path
+        sample.delete()
+        self.assertFalse(os.path.exists(store_path))
+
+    def get_preprocessed_response(self, sample, **query_params):
+        request = self.factory.get(
+            '/api/repository/samples/%d/preprocessed/' % sample.id,
+            query_params
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views.retrieve_preprocessed_sample(request, pk=sample.id)
+
+    def test_preprocessed(self):
+        """
+        The compensated channels are compensated & transformed, the rest
+        are left as is
+        """
+        events = self.build_events()
+        sample = self.create_sample(events)
+        compensation = FrozenCompensation.objects.create(
+            matrix_text='2,3\n1,0.1\n0.2,1'
+        )
+        compensated = np.dot(
+            events[:, 1:].astype(np.float64),
+            np.linalg.inv([[1, 0.1], [0.2, 1]])
+        )
+
+        response = self.get_preprocessed_response(
+            sample,
+            compensation=compensation.id,
+            transform='asinh',
+            pre_scale=0.01
+        )
+        etag = response['ETag']
+        preprocessed = self.read_events(response)
+        self.assertEqual(preprocessed.dtype, np.float32)
+        np.testing.assert_allclose(
+            preprocessed,
+            np.column_stack([events[:, 0], np.arcsinh(compensated * 0.01)]),
+            rtol=1e-5
+        )
+
+        response = self.get_preprocessed_response(
+            sample,
+            compensation=compensation.id,
+            transform='logicle'
+        )
+        self.assertNotEqual(response['ETag'], etag)
+        np.testing.assert_allclose(
+            self.read_events(response)[:, 1:],
+            logicle(compensated, t=262144.0, m=4.5, w=0.5, a=0.0),
+            rtol=1e-5
+        )
+
+        request = self.factory.get(
+            '/api/repository/samples/%d/preprocessed/' % sample.id,
+            {
+                'compensation': compensation.id,
+                'transform': 'asinh',
+                'pre_scale': 0.01
+            },
+            HTTP_IF_NONE_MATCH=etag
+        )
+        force_authenticate(request, user=self.test_user)
+        response = api_views.retrieve_preprocessed_sample(
+            request,
+            pk=sample.id
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_preprocessed_invalid_parameters(self):
+        """
+        Invalid transforms, parameters & compensations are a bad request
+        """
+        sample = self.create_sample(self.build_events())
+        compensation_id = FrozenCompensation.objects.create(
+            matrix_text='3\n1'
+        ).id
+
+        for query_params in (
+                {'compensation': compensation_id},
+                {'compensation': compensation_id, 'transform': 'log'},
+                {'transform': 'asinh'},
+                {'compensation': 0, 'transform': 'asinh'},
+                {
+                    'compensation': compensation_id,
+                    'transform': 'asinh',
+                    'pre_scale': 0
+                },
+                {
+                    'compensation': compensation_id,
+                    'transform': 'logicle',
+                    'w': 'x'
+                },
+                {
+                    'compensation': FrozenCompensation.objects.create(
+                        matrix_text='4\n1'
+                    ).id,
+                    'transform': 'asinh'
+                },
+                {
+                    'compensation': FrozenCompensation.objects.create(
+                        matrix_text='2,3\n1'
+                    ).id,
+                    'transform': 'asinh'
+                }):
+            response = self.get_preprocessed_response(sample, **query_params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_events_truncated_file(self):
+        """
+        Events of a sample whose file is shorter than its DATA segment are
+        a bad request, not a server error
+        """
+        sample = self.create_sample(self.build_events())
+        with open(sample.sample_file.path, 'r+b') as sample_file:
+            sample_file.truncate(sample.get_data_offsets()[0] + 100)
+
+        response = self.get_events_response(sample)
+
+        self.assertEqual(response.status_code, 400)
+
+
+class SampleDownloadUnitTestCase(SampleUnitTestCase):
+
+    def get_clean_response(self, sample, **headers):
+        request = self.factory.get(
+            '/api/repository/samples/%d/download_clean/' % sample.id,
+            **headers
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views.retrieve_clean_sample(request, pk=sample.id)
+
+    def test_clean_sample_not_modified(self):
+        """
+        A conditional request with the clean file's ETag gets a 304 without
+        the clean file being generated
+        """
+        sample = self.create_sample(self.build_events())
+        response = self.get_clean_response(sample)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        os.remove(sample.get_clean_fcs_path())
+        response = self.get_clean_response(sample, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertIsNone(
+            find_cached_file('clean_fcs', sample.get_clean_fcs_key(), '.fcs')
+        )
+
+        response = self.get_clean_response(
+            sample,
+            HTTP_IF_NONE_MATCH='"%s"' % ('0' * 40)
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+    def get_sample_response(self, sample, **headers):
+        request = self.factory.get(
+            '/api/repository/samples/%d/fcs/' % sample.id,
+            **headers
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views.retrieve_sample_as_pk(request, pk=sample.id)
+
+    def read_response(self, response):
+        return ''.join(response.streaming_content)
+
+    def test_sample_range_requests(self):
+        """
+        Single byte ranges get a partial response, multiple or malformed
+        ranges the whole file & unsatisfiable ranges a 416
+        """
+        sample = self.create_sample(self.build_events())
+        with open(sample.sample_file.path, 'rb') as sample_file:
+            content = sample_file.read()
+        size = len(content)
+
+        response = self.get_sample_response(sample)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(size))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['ETag'], '"%s"' % sample.sha1)
+        self.assertEqual(self.read_response(response), content)
+
+        for range_header, start, end in (
+                ('bytes=10-19', 10, 19),
+                ('bytes=%d-' % (size - 5), size - 5, size - 1),
+                ('bytes=-5', size - 5, size - 1),
+                ('bytes=0-%d' % (size * 2), 0, size - 1)):
+            response = self.get_sample_response(
+                sample,
+                HTTP_RANGE=range_header
+            )
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(
+                response['Content-Range'],
+                'bytes %d-%d/%d' % (start, end, size)
+            )
+            self.assertEqual(
+                self.read_response(response),
+                content[start:end + 1]
+            )
+
+        for range_header in ('bytes=0-1,5-6', 'lines=0-1'):
+            response = self.get_sample_response(
+                sample,
+                HTTP_RANGE=range_header
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.read_response(response), content)
+
+        response = self.get_sample_response(
+            sample,
+            HTTP_RANGE='bytes=%d-' % size
+        )
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % size)
+
+        # a partial copy of another version of the file
+        response = self.get_sample_response(
+            sample,
+            HTTP_RANGE='bytes=10-19',
+            HTTP_IF_RANGE='"%s"' % ('0' * 40)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.read_response(response), content)
+
+        response = self.get_sample_response(
+            sample,
+            HTTP_RANGE='bytes=10-19',
+            HTTP_IF_RANGE='"%s"' % sample.sha1
+        )
+        self.assertEqual(response.status_code, 206)
+        self.read_response(response)
+
+
+    def test_clean_fcs_cached(self):
+        """
+        The clean file is generated once, & again under a new key when the
+        channel names change
+        """
+        sample = self.create_sample(self.build_events())
+        path = sample.get_clean_fcs_path()
+        with open(path, 'wb') as clean_file:
+            clean_file.write('cached')
+
+        self.assertEqual(sample.get_clean_fcs_path(), path)
+        with sample.get_clean_fcs() as clean_file:
+            self.assertEqual(clean_file.read(), 'cached')
+
+        SitePanelParameterMarker.objects.create(
+            site_panel_parameter=self.site_panel.sitepanelparameter_set.get(
+                fcs_number=3
+            ),
+            marker=Marker.objects.create(
+                project=self.project,
+                marker_abbreviation='CD3'
+            )
+        )
+        new_path = sample.get_clean_fcs_path()
+        self.assertNotEqual(new_path, path)
+        with open(new_path, 'rb') as clean_file:
+            self.assertIsNone(read_fcs_file(clean_file).error)
+
+
+    def test_clean_fcs_content(self):
+        """
+        The clean file has the clean channel names (also in the spillover,
+        which takes precedence over $SPILL) & the original DATA segment
+        """
+        sample = self.create_sample(
+            self.build_events(),
+            extra_keywords=[
+                ('$SPILL', '1,FITC-A,0.9'),
+                ('$SPILLOVER', '1,FITC-A,0.5')
+            ]
+        )
+        fitc_parameter = self.site_panel.sitepanelparameter_set.get(
+            fcs_number=3
+        )
+        fitc_parameter.fluorochrome = Fluorochrome.objects.create(
+            project=self.project,
+            fluorochrome_abbreviation='FITC'
+        )
+        fitc_parameter.save()
+        SitePanelParameterMarker.objects.create(
+            site_panel_parameter=fitc_parameter,
+            marker=Marker.objects.create(
+                project=self.project,
+                marker_abbreviation='CD3'
+            )
+        )
+
+        with sample.get_clean_fcs() as clean_file:
+            clean_reader = read_fcs_file(clean_file)
+            clean_file.seek(clean_reader.data_start)
+            clean_data = clean_file.read()
+        with open(sample.sample_file.path, 'rb') as sample_file:
+            sample_reader = read_fcs_file(sample_file)
+            sample_file.seek(sample_reader.data_start)
+            sample_data = sample_file.read(
+                sample_reader.data_end - sample_reader.data_start + 1
+            )
+
+        self.assertIsNone(clean_reader.error)
+        self.assertEqual(
+            [clean_reader.metadata['p%dn' % i] for i in (1, 2, 3)],
+            ['FSC-A', 'SSC-A', 'CD3 FITC FLR-A']
+        )
+        self.assertEqual(
+            clean_reader.metadata['spillover'],
+            '1,CD3 FITC FLR-A,0.5'
+        )
+        self.assertEqual(get_fcs_event_count(clean_reader), 100)
+        self.assertEqual(clean_data, sample_data)
+
+
+    def get_original_response(self, sample, **headers):
+        request = self.factory.get(
+            '/api/repository/samples/%d/fcs_original/' % sample.id,
+            **headers
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views.retrieve_sample(request, pk=sample.id)
+
+    def test_sample_compression(self):
+        """
+        Downloads are compressed with an accepted encoding, on the fly the
+        first time & from the cache after that
+        """
+        sample = self.create_sample(self.build_events())
+        with open(sample.sample_file.path, 'rb') as sample_file:
+            content = sample_file.read()
+
+        response = self.get_original_response(sample)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(self.read_response(response), content)
+
+        # ranges of an encoding that isn't cached yet are sent uncompressed
+        response = self.get_original_response(
+            sample,
+            HTTP_ACCEPT_ENCODING='gzip',
+            HTTP_RANGE='bytes=0-9'
+        )
+        self.assertEqual(response.status_code, 206)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(self.read_response(response), content[:10])
+
+        for accept_encoding, encoding, decompress in (
+                ('gzip, deflate', 'gzip', lambda data: zlib.decompress(
+                    data,
+                    16 + zlib.MAX_WBITS
+                )),
+                ('gzip;q=0, deflate', 'deflate', zlib.decompress)):
+            for cached in (False, True):
+                response = self.get_original_response(
+                    sample,
+                    HTTP_ACCEPT_ENCODING=accept_encoding
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Encoding'], encoding)
+                self.assertEqual(
+                    response['ETag'],
+                    '"%s-%s"' % (sample.sha1, encoding)
+                )
+                self.assertEqual(response.has_header('Content-Length'), cached)
+                compressed = self.read_response(response)
+                self.assertEqual(decompress(compressed), content)
+
+            response = self.get_original_response(
+                sample,
+                HTTP_ACCEPT_ENCODING=accept_encoding,
+                HTTP_RANGE='bytes=0-9'
+            )
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Encoding'], encoding)
+            self.assertEqual(self.read_response(response), compressed[:10])
+
+            response = self.get_original_response(
+                sample,
+                HTTP_ACCEPT_ENCODING=accept_encoding,
+                HTTP_IF_NONE_MATCH='"%s-%s"' % (sample.sha1, encoding)
+            )
+            self.assertEqual(response.status_code, 304)
+
+
+class SampleResumableUploadUnitTestCase(SampleUnitTestCase):
+
+    def start_upload(self, file_size):
+        data = dict(self.sample_data)
+        data['filename'] = 'test.fcs'
+        data['file_size'] = file_size
+        request = self.factory.post(
+            '/api/repository/sample_uploads/',
+            data,
+            format='json'
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views.SampleUploadList.as_view()(request)
+
+    def send_request(self, method, upload_id, view=None, **kwargs):
+        request = getattr(self.factory, method)(
+            '/api/repository/sample_uploads/%d/' % upload_id,
+            **kwargs
+        )
+        force_authenticate(request, user=self.test_user)
+
+        if view is None:
+            view = api_views.SampleUploadDetail.as_view()
+        return view(request, pk=upload_id)
+
+    def put_chunk(self, upload_id, content, start, total=None):
+        return self.send_request(
+            'put',
+            upload_id,
+            data=content,
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes %d-%d/%s' % (
+                start,
+                start + len(content) - 1,
+                total
+            )
+        )
+
+    def finalize(self, upload_id):
+        return self.send_request(
+            'post',
+            upload_id,
+            view=api_views.finalize_sample_upload
+        )
+
+    def test_upload_chunks_out_of_order(self):
+        """
+        Chunks may arrive in any order, the received ranges let a client
+        resume, and the upload can only be finalized once complete
+        """
+        content = build_fcs_content(self.build_events(), self.channel_names)
+        chunks = [
+            (start, content[start:start + 1000])
+            for start in range(0, len(content), 1000)
+        ]
+        upload_id = self.start_upload(len(content)).data['id']
+
+        for start, chunk in chunks[1:][::-1]:
+            response = self.put_chunk(upload_id, chunk, start, len(content))
+            self.assertEqual(response.status_code, 200)
+
+        response = self.send_request('get', upload_id)
+        self.assertEqual(
+            response.data['received_ranges'],
+            [[1000, len(content) - 1]]
+        )
+        self.assertFalse(response.data['complete'])
+        self.assertEqual(self.finalize(upload_id).status_code, 400)
+
+        # resume with the missing chunk
+        response = self.put_chunk(upload_id, chunks[0][1], 0, '*')
+        self.assertTrue(response.data['complete'])
+
+        response = self.finalize(upload_id)
+        self.assertEqual(response.status_code, 201)
+        sample = Sample.objects.get(id=response.data['id'])
+        self.assertEqual(sample.event_count, 100)
+        self.assertFalse(SampleUpload.objects.filter(id=upload_id).exists())
+
+    def test_upload_bad_ranges(self):
+        """
+        Chunks without a Content-Range, past the end of the file, with the
+        wrong total or a body shorter than the range are rejected
+        """
+        upload_id = self.start_upload(1000).data['id']
+
+        response = self.send_request(
+            'put',
+            upload_id,
+            data='x' * 10,
+            content_type='application/octet-stream'
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = self.put_chunk(upload_id, 'x' * 10, 995, 1000)
+        self.assertEqual(response.status_code, 416)
+
+        response = self.put_chunk(upload_id, 'x' * 10, 0, 2000)
+        self.assertEqual(response.status_code, 400)
+
+        response = self.send_request(
+            'put',
+            upload_id,
+            data='x' * 10,
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes 0-19/1000'
+        )
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(
+            self.send_request('get', upload_id).data['received_ranges'],
+            []
+        )
+
+    def test_upload_max_size(self):
+        """ Uploads larger than SAMPLE_UPLOAD_MAX_SIZE can't be started """
+        with self.settings(SAMPLE_UPLOAD_MAX_SIZE=1000):
+            self.assertEqual(self.start_upload(1001).status_code, 400)
+            self.assertEqual(self.start_upload(1000).status_code, 201)
+
+    def test_expired_uploads(self):
+        """
+        Inactive uploads are no longer available, and are deleted along
+        with their staging file by delete_expired_sample_uploads
+        """
+        upload_id = self.start_upload(1000).data['id']
+        upload = SampleUpload.objects.get(id=upload_id)
+        SampleUpload.objects.filter(id=upload_id).update(
+            modified_date=datetime.datetime.now() - datetime.timedelta(
+                hours=49
+            )
+        )
+
+        self.assertEqual(self.send_request('get', upload_id).status_code, 404)
+        self.assertEqual(
+            self.put_chunk(upload_id, 'x' * 10, 0, 1000).status_code,
+            404
+        )
+
+        call_command('delete_expired_sample_uploads', stdout=StringIO())
+
+        self.assertFalse(SampleUpload.objects.filter(id=upload_id).exists())
+        self.assertFalse(os.path.exists(upload.staging_path))
+
+
+class SampleCompensationUnitTestCase(SampleUnitTestCase):
+
+    def create_compensation(self, name, acquisition_date, site_panel=None,
+                            matrix_text='FITC-A\n1.5'):
+        compensation = Compensation(
+            name=name,
+            site_panel=site_panel or self.site_panel,
+            acquisition_date=acquisition_date,
+            matrix_text=matrix_text
+        )
+        compensation.clean()
+        compensation.save()
+
+        return compensation
+
+    def create_spill_sample(self, seed, spill=None):
+        return self.create_sample(
+            self.build_events(seed=seed),
+            filename='%d.fcs' % seed,
+            extra_keywords=[] if spill is None else [('$SPILLOVER', spill)]
+        )
+
+    def test_sample_list_has_compensation(self):
+        """
+        Sample lists annotate whether a compensation matches each sample,
+        without a query per sample
+        """
+        self.create_compensation('C1', datetime.date(2016, 1, 1))
+        compensated_sample = self.create_spill_sample(1)
+        sample = self.create_spill_sample(2)
+        Sample.objects.filter(id=sample.id).update(
+            acquisition_date=datetime.date(2016, 1, 2)
+        )
+        expected = {compensated_sample.id: True, sample.id: False}
+
+        samples = Sample.annotate_compensation_exists(Sample.objects.all())
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                dict((s.id, s.has_compensation) for s in samples),
+                expected
+            )
+        self.assertEqual(
+            dict((s.id, s.has_compensation) for s in Sample.objects.all()),
+            expected
+        )
+
+        request = self.factory.get('/api/repository/samples/')
+        force_authenticate(request, user=self.test_user)
+        response = api_views.SampleList.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            dict((s['id'], s['has_compensation']) for s in response.data),
+            expected
+        )
+
+    def test_find_sample_compensations(self):
+        """
+        Samples match a compensation on their acquisition date, else the
+        nearest date, else a spillover valid for their site panel
+        """
+        exact = self.create_compensation('C1', datetime.date(2016, 1, 1))
+        self.create_compensation('C1B', datetime.date(2016, 1, 1))
+        nearest = self.create_compensation('C2', datetime.date(2016, 1, 10))
+        self.create_compensation('C3', datetime.date(2016, 2, 10))
+
+        exact_sample = self.create_spill_sample(1)
+        nearest_sample = self.create_spill_sample(2)
+        Sample.objects.filter(id=nearest_sample.id).update(
+            acquisition_date=datetime.date(2016, 1, 20)
+        )
+
+        # samples on a site panel without compensations
+        self.sample_data['site_panel'] = self.create_site_panel().id
+        spill_sample = self.create_spill_sample(3, '1,FITC-A,0.5')
+        # too long for a SampleMetadata row
+        long_spill_sample = self.create_spill_sample(
+            4,
+            '1,FITC-A,0.5' + '0' * 3000
+        )
+        other_channel_sample = self.create_spill_sample(5, '1,SSC-A,0.5')
+        invalid_spill_sample = self.create_spill_sample(6, '1,FITC-A,x')
+        no_spill_sample = self.create_spill_sample(7)
+
+        matches = controllers.find_sample_compensations(
+            Sample.objects.values_list(
+                'id',
+                'site_panel_id',
+                'acquisition_date'
+            )
+        )
+
+        self.assertEqual(matches[exact_sample.id]['match'], 'exact')
+        self.assertEqual(matches[exact_sample.id]['compensation'], exact.id)
+        self.assertEqual(matches[nearest_sample.id]['match'], 'nearest')
+        self.assertEqual(
+            matches[nearest_sample.id]['compensation'],
+            nearest.id
+        )
+        self.assertEqual(
+            matches[exact_sample.id]['matrix'],
+            exact.get_compensation_as_csv().getvalue()
+        )
+
+        for sample in (spill_sample, long_spill_sample):
+            self.assertEqual(matches[sample.id]['match'], 'spill')
+            self.assertIsNone(matches[sample.id]['compensation'])
+            self.assertEqual(matches[sample.id]['matrix'], '3\n0.500000\n')
+
+        for sample in (
+                other_channel_sample,
+                invalid_spill_sample,
+                no_spill_sample):
+            self.assertEqual(
+                matches[sample.id],
+                {
+                    'match': None,
+                    'compensation': None,
+                    'compensation_name': None,
+                    'matrix': None
+                }
+            )
+
+    def test_extract_spill_compensations(self):
+        """
+        A compensation is created per distinct spillover, site panel &
+        acquisition date, including spillovers too long for a
+        SampleMetadata row, and extracting again creates none
+        """
+        self.create_spill_sample(1, '1,FITC-A,0.5')
+        self.create_spill_sample(2, '1,FITC-A,0.5')
+        self.create_spill_sample(3, '1,FITC-A,0.9')
+        Sample.objects.filter(
+            id=self.create_spill_sample(4, '1,FITC-A,0.5').id
+        ).update(acquisition_date=datetime.date(2016, 3, 3))
+        site_panel_id = self.site_panel.id
+        site_panel_2_id = self.create_site_panel().id
+        self.sample_data['site_panel'] = site_panel_2_id
+        self.create_spill_sample(5, '1,FITC-A,0.5' + '0' * 3000)
+        self.create_spill_sample(6)
+
+        created_count, errors = controllers.extract_spill_compensations(
+            Sample.objects.all()
+        )
+
+        self.assertEqual(created_count, 4)
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            sorted(
+                Compensation.objects.values_list(
+                    'site_panel_id',
+                    'acquisition_date',
+                    'matrix_text'
+                )
+            ),
+            [
+                (site_panel_id, datetime.date(2016, 1, 1), u'FITC-A\n0.5'),
+                (site_panel_id, datetime.date(2016, 1, 1), u'FITC-A\n0.9'),
+                (site_panel_id, datetime.date(2016, 3, 3), u'FITC-A\n0.5'),
+                (site_panel_2_id, datetime.date(2016, 1, 1), u'FITC-A\n0.5')
+            ]
+        )
+        for compensation in Compensation.objects.all():
+            self.assertEqual(
+                compensation.sha1,
+                get_file_sha1(compensation.compensation_file)
+            )
+
+        self.assertEqual(
+            controllers.extract_spill_compensations(Sample.objects.all()),
+            (0, [])
+        )
+        self.assertEqual(Compensation.objects.count(), 4)
+
+    def test_extract_spill_compensations_errors(self):
+        """
+        Spillovers for channels other than the site panel's fluoro
+        channels are reported, without creating a compensation
+        """
+        self.create_spill_sample(1, '1,SSC-A,0.5')
+        self.create_spill_sample(2, '1,FITC-A,0.5')
+
+        request = self.factory.post(
+            '/api/repository/compensations/extract_spill/',
+            {'site_panel': self.site_panel.id},
+            format='json'
+        )
+        force_authenticate(request, user=self.test_user)
+        response = api_views.extract_spill_compensations(request)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(len(response.data['errors']), 1)
+        self.assertEqual(
+            response.data['errors'][0]['site_panel'],
+            self.site_panel.id
+        )
+        self.assertEqual(
+            list(Compensation.objects.values_list('matrix_text', flat=True)),
+            [u'FITC-A\n0.5']
+        )
+
+
+    def post_compensations(self, data, user=None):
+        request = self.factory.post(
+            '/api/repository/compensations/bulk/',
+            data,
+            format='json'
+        )
+        force_authenticate(request, user=user or self.test_user)
+
+        return api_views.create_compensations(request)
+
+    def test_create_compensations(self):
+        """ Compensations are created together, if they're all valid """
+        self.create_compensation('C1', datetime.date(2016, 1, 1))
+        compensation_data = [
+            {
+                'site_panel': self.site_panel.id,
+                'acquisition_date': '2016-01-02',
+                'name': 'C2',
+                'matrix_text': 'FITC-A\n1.2'
+            },
+            {
+                'site_panel': self.site_panel.id,
+                'acquisition_date': '2016-01-03',
+                'name': 'C3',
+                'matrix_text': 'FITC-A\n1.3'
+            }
+        ]
+
+        response = self.post_compensations(compensation_data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            [compensation['name'] for compensation in response.data],
+            ['C2', 'C3']
+        )
+        compensation = Compensation.objects.get(name='C3')
+        self.assertEqual(compensation.acquisition_date.day, 3)
+        compensation.compensation_file.open('rb')
+        np.testing.assert_array_equal(
+            np.load(compensation.compensation_file),
+            [[3], [1.3]]
+        )
+        compensation.compensation_file.close()
+
+    def test_create_compensations_errors(self):
+        """
+        Invalid requests are rejected, with an error per invalid item &
+        nothing created
+        """
+        valid_data = {
+            'site_panel': self.site_panel.id,
+            'acquisition_date': '2016-01-02',
+            'name': 'C2',
+            'matrix_text': 'FITC-A\n1.2'
+        }
+        self.create_compensation('C1', datetime.date(2016, 1, 1))
+
+        for data in ({'name': 'C2'}, [valid_data, 'C3'], [valid_data, [1]]):
+            response = self.post_compensations(data)
+            self.assertEqual(response.status_code, 400)
+            self.assertIsNone(response.data)
+
+        response = self.post_compensations(
+            [
+                valid_data,
+                dict(valid_data, name='C1'),
+                dict(valid_data, name=['C3']),
+                dict(valid_data, name='C4', acquisition_date='2016'),
+                dict(valid_data, name='C5', matrix_text='PE-A\n1.2'),
+                dict(valid_data)
+            ]
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertEqual(
+            response.data[1]['detail'],
+            'Compensation with this name already exists in this site.'
+        )
+        self.assertTrue(
+            response.data[2]['detail'].startswith('A valid site_panel')
+        )
+        self.assertTrue(
+            response.data[3]['detail'].startswith('A valid site_panel')
+        )
+        self.assertIn('detail', response.data[4])
+        self.assertEqual(
+            response.data[5]['detail'],
+            'Compensation with this name already exists in this site.'
+        )
+        self.assertEqual(Compensation.objects.count(), 1)
+
+        other_user = User.objects.create_user('other', password='other')
+        response = self.post_compensations([valid_data], other_user)
+        self.assertEqual(response.status_code, 403)
+
+
+class SampleCollectionUnitTestCase(SampleUnitTestCase):
+
+    def setUp(self):
+        super(SampleCollectionUnitTestCase, self).setUp()
+        self.samples = [
+            self.create_sample(self.build_events(seed=i), '%d.fcs' % i)
+            for i in range(2)
+        ]
+        self.collection = SampleCollection.objects.create(project=self.project)
+        compensation = FrozenCompensation(matrix_text=u'3\n1.000000\n')
+        compensation.save()
+        for sample in self.samples:
+            SampleCollectionMember.objects.create(
+                sample_collection=self.collection,
+                sample=sample,
+                compensation=compensation
+            )
+
+    def get_archive_response(self, **query_params):
+        request = self.factory.get(
+            '/api/repository/sample_collections/%d/archive/' %
+            self.collection.id,
+            query_params
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views_process_request.retrieve_sample_collection_archive(
+            request,
+            pk=self.collection.id
+        )
+
+    def read_archive(self, response):
+        self.assertEqual(response.status_code, 200)
+
+        return tarfile.open(
+            fileobj=StringIO(''.join(response.streaming_content))
+        )
+
+    def test_collection_archive(self):
+        """
+        The archive has the manifest, the frozen compensations & the
+        original FCS file of every member
+        """
+        archive = self.read_archive(self.get_archive_response())
+
+        manifest = json.loads(archive.extractfile('manifest.json').read())
+        self.assertEqual(manifest['sample_collection'], self.collection.id)
+        self.assertEqual(len(manifest['members']), 2)
+        for member, sample in zip(manifest['members'], self.samples):
+            self.assertEqual(member['sample'], sample.id)
+            self.assertEqual(member['sha1'], sample.sha1)
+            self.assertEqual(member['event_count'], 100)
+            sample.sample_file.open('rb')
+            self.assertEqual(
+                archive.extractfile(member['sample_file']).read(),
+                sample.sample_file.read()
+            )
+            sample.sample_file.close()
+            self.assertEqual(
+                archive.extractfile(member['compensation_file']).read(),
+                '3\n1.000000\n'
+            )
+
+    def test_collection_archive_clean(self):
+        """ With clean=true the archive has the clean FCS files """
+        archive = self.read_archive(self.get_archive_response(clean='true'))
+
+        for sample in self.samples:
+            with open(sample.get_clean_fcs_path(), 'rb') as clean_file:
+                self.assertEqual(
+                    archive.extractfile(
+                        'samples/%d_clean.fcs' % sample.id
+                    ).read(),
+                    clean_file.read()
+                )
+
+    def test_collection_archive_missing_file(self):
+        """
+        A sample file that can't be read fails the request before the
+        archive starts streaming
+        """
+        os.remove(self.samples[1].sample_file.path)
+
+        response = self.get_archive_response()
+
+        self.assertEqual(response.status_code, 500)
+        self.assertIn(
+            'samples/%d.fcs' % self.samples[1].id,
+            response.data['detail']
+        )
+
+    def test_collection_archive_clean_limit(self):
+        """
+        Clean archives of more samples than the limit are rejected, the
+        clean files are all generated before the archive starts streaming
+        """
+        with self.settings(SAMPLE_COLLECTION_CLEAN_ARCHIVE_MAX_SAMPLES=1):
+            response = self.get_archive_response(clean='true')
+
+        self.assertEqual(response.status_code, 400)
+
+        with self.settings(SAMPLE_COLLECTION_CLEAN_ARCHIVE_MAX_SAMPLES=2):
+            response = self.get_archive_response(clean='true')
+
+        self.read_archive(response)
+
+
+class SampleCollectionMemberUnitTestCase(SampleUnitTestCase):
+
+    def setUp(self):
+        super(SampleCollectionMemberUnitTestCase, self).setUp()
+        self.samples = [
+            self.create_sample(self.build_events(seed=i), '%d.fcs' % i)
+            for i in range(3)
+        ]
+        self.collection = SampleCollection.objects.create(project=self.project)
+        self.compensation = Compensation(
+            name='C1',
+            site_panel=self.site_panel,
+            acquisition_date=datetime.date(2016, 1, 1),
+            matrix_text='FITC-A\n1.5'
+        )
+        self.compensation.clean()
+        self.compensation.save()
+
+    def post_members(self, data):
+        request = self.factory.post(
+            '/api/repository/sample_collection_members/',
+            data,
+            format='json'
+        )
+        force_authenticate(request, user=self.test_user)
+
+        return api_views_process_request.SampleCollectionMemberList.as_view()(
+            request
+        )
+
+    def test_freeze_compensations(self):
+        """
+        Each matrix text is frozen once, existing ones are reused
+        """
+        existing = FrozenCompensation.objects.create(matrix_text='3\n1')
+
+        with self.assertNumQueries(3):
+            frozen_ids = FrozenCompensation.freeze(
+                ['3\n1', '3\n2', '3\n2']
+            )
+
+        self.assertEqual(len(frozen_ids), 2)
+        self.assertEqual(
+            frozen_ids[hashlib.sha1('3\n1').hexdigest()],
+            existing.id
+        )
+        self.assertEqual(
+            FrozenCompensation.objects.get(
+                id=frozen_ids[hashlib.sha1('3\n2').hexdigest()]
+            ).matrix_text,
+            '3\n2'
+        )
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                FrozenCompensation.freeze(['3\n1', '3\n2']),
+                frozen_ids
+            )
+
+    def test_create_members(self):
+        """
+        Members are created with their matrix text or compensation frozen,
+        identical matrices sharing a frozen compensation
+        """
+        response = self.post_members(
+            [
+                {
+                    'sample_collection': self.collection.id,
+                    'sample': self.samples[0].id,
+                    'compensation': '3\n2'
+                },
+                {
+                    'sample_collection': self.collection.id,
+                    'sample': self.samples[1].id,
+                    'compensation': '3\n2'
+                },
+                {
+                    'sample_collection': self.collection.id,
+                    'sample': self.samples[2].id,
+                    'compensation_id': self.compensation.id
+                }
+            ]
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            [member['sample'] for member in response.data],
+            [sample.id for sample in self.samples]
+        )
+
+        members = SampleCollectionMember.objects.filter(
+            sample_collection=self.collection
+        ).order_by('sample_id')
+        self.assertEqual(
+            members[0].compensation_id,
+            members[1].compensation_id
+        )
+        self.assertEqual(members[0].compensation.matrix_text, '3\n2')
+        self.assertEqual(
+            members[2].compensation.matrix_text,
+            self.compensation.get_compensation_as_csv().getvalue()
+        )
+
+    def test_create_members_errors(self):
+        """
+        Invalid requests are rejected, with an error per invalid member &
+        nothing created
+        """
+        SampleCollectionMember.objects.create(
+            sample_collection=self.collection,
+            sample=self.samples[1],
+            compensation=FrozenCompensation.objects.create(matrix_text='3\n1')
+        )
+        member = {
+            'sample_collection': self.collection.id,
+            'sample': self.samples[0].id,
+            'compensation': '3\n2'
+        }
+
+        for data in (member, [member, 'x']):
+            self.assertEqual(self.post_members(data).status_code, 400)
+
+        response = self.post_members(
+            [
+                member,
+                dict(member, sample_collection=0),
+                dict(member, sample=0),
+                dict(member, sample='x'),
+                dict(member, sample=self.samples[1].id),
+                {
+                    'sample_collection': self.collection.id,
+                    'sample': self.samples[2].id,
+                    'compensation_id': 0
+                },
+                {
+                    'sample_collection': self.collection.id,
+                    'sample': self.samples[2].id,
+                    'compensation': 1
+                },
+                member
+            ]
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [error.get('detail') for error in response.data],
+            [
+                None,
+                'Invalid sample_collection',
+                'Invalid sample',
+                'sample_collection & sample are required',
+                'Sample is already in the sample collection',
+                'Invalid compensation_id',
+                'compensation or compensation_id is required',
+                'Sample is already in the sample collection'
+            ]
+        )
+        self.assertEqual(
+            SampleCollectionMember.objects.filter(
+                sample_collection=self.collection
+            ).count(),
+            1
+        )
+
+
+class SitePanelUnitTestCase(SampleUnitTestCase):
+
+    def test_create_site_panel(self):
+        """
+        The parameters & their markers are saved, and the signature is
+        computed once they all are
+        """
+        fluorochrome = Fluorochrome.objects.create(
+            project=self.project,
+            fluorochrome_abbreviation='FITC'
+        )
+        marker = Marker.objects.create(
+            project=self.project,
+            marker_abbreviation='CD3'
+        )
+        parameters = [
+            {
+                'fcs_number': 1,
+                'fcs_text': 'FSC-A',
+                'fcs_opt_text': None,
+                'parameter_type': 'FSC',
+                'parameter_value_type': 'A',
+                'fluorochrome': None,
+                'markers': []
+            },
+            {
+                'fcs_number': 2,
+                'fcs_text': 'FITC-A',
+                'fcs_opt_text': 'CD3',
+                'parameter_type': 'FLR',
+                'parameter_value_type': 'A',
+                'fluorochrome': fluorochrome.id,
+                'markers': [marker.id]
+            }
+        ]
+        request = self.factory.post(
+            '/api/repository/site_panels/',
+            {
+                'site': self.site.id,
+                'panel_template': self.panel_template.id,
+                'site_panel_comments': '',
+                'parameters': parameters
+            },
+            format='json'
+        )
+        force_authenticate(request, user=self.test_user)
+
+        response = api_views.SitePanelList.as_view()(request)
+
+        self.assertEqual(response.status_code, 201)
+        site_panel = SitePanel.objects.get(id=response.data['id'])
+        self.assertEqual(
+            site_panel.signature,
+            get_fcs_channel_signature(
+                [(1, 'FSC-A', None), (2, 'FITC-A', 'CD3')]
+            )
+        )
+        self.assertEqual(
+            list(
+                SitePanelParameterMarker.objects.values_list(
+                    'site_panel_parameter__fcs_number',
+                    'marker_id'
+                )
+            ),
+            [(2, marker.id)]
+        )
+
+    def test_match_site_panels(self):
+        """
+        Site panels match FCS files with the same channels, those without
+        a signature once it's computed by update_site_panel_signatures
+        """
+        SitePanel.objects.filter(id=self.site_panel.id).update(signature=None)
+        other_site_panel = self.create_site_panel()
+        SitePanelParameter.objects.filter(
+            site_panel=other_site_panel,
+            fcs_number=3
+        ).update(fcs_text='PE-A')
+        other_site_panel.update_signature()
+
+        def get_matches():
+            request = self.factory.post(
+                '/api/repository/site_panels/match/',
+                {
+                    'project': self.project.id,
+                    'fcs_file': self.build_fcs_file(self.build_events())
+                },
+                format='multipart'
+            )
+            force_authenticate(request, user=self.test_user)
+            response = api_views.find_matching_site_panels(request)
+            self.assertEqual(response.status_code, 200)
+
+            return [site_panel['id'] for site_panel in response.data]
+
+        self.assertEqual(get_matches(), [])
+
+        call_command('update_site_panel_signatures', stdout=StringIO())
+
+        self.assertEqual(get_matches(), [self.site_panel.id])
+
+
+class SampleJobUnitTestCase(SampleUnitTestCase):
+
+    def get_statistics(self, sample):
+        return [
+            [
+                statistics.minimum,
+                statistics.maximum,
+                statistics.mean,
+                statistics.median,
+                statistics.std
+            ]
+            for statistics in SampleChannelStatistics.objects.filter(
+                sample=sample
+            ).order_by('fcs_number')
+        ]
+
+    def assertStatisticsEqual(self, statistics, events):
+        events = events.astype(np.float64)
+        np.testing.assert_allclose(
+            statistics,
+            np.column_stack(
+                [
+                    events.min(axis=0),
+                    events.max(axis=0),
+                    events.mean(axis=0),
+                    np.median(events, axis=0),
+                    events.std(axis=0)
+                ]
+            ),
+            rtol=1e-9
+        )
+
+    def test_process_sample_jobs(self):
+        """
+        Jobs are claimed oldest first, and the statistics match those of
+        all the events
+        """
+        events = self.build_events(101)
+        sample = self.create_sample(events)
+        self.create_sample(self.build_events(100, seed=1), 'test_2.fcs')
+        self.assertEqual(sample.processing_status, 'Pending')
+
+        job = jobs.claim_sample_job()
+        self.assertEqual(job.sample_id, sample.id)
+        self.assertEqual(job.status, 'Working')
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(
+            Sample.objects.get(id=sample.id).processing_status,
+            'Working'
+        )
+
+        job = jobs.run_sample_job(job)
+        self.assertEqual(job.status, 'Complete')
+        self.assertIsNotNone(job.completion_date)
+
+        call_command('process_sample_jobs', once=True, stdout=StringIO())
+
+        self.assertFalse(SampleJob.objects.exclude(status='Complete').exists())
+        sample = Sample.objects.get(id=sample.id)
+        self.assertEqual(sample.processing_status, 'Complete')
+        self.assertEqual(sample.event_count, 101)
+        self.assertStatisticsEqual(self.get_statistics(sample), events)
+
+    def test_channel_statistics_chunks(self):
+        """
+        Statistics over many chunks match those of all the events, with
+        medians found by narrowing the histogram over several passes
+        """
+        events = np.vstack(
+            [
+                self.build_events(1000),
+                # repeated values on either side of the median
+                np.full((500, 3), 500, dtype=np.float32),
+                np.full((499, 3), 1e-3, dtype=np.float32)
+            ]
+        )
+        sort_limit = jobs.MEDIAN_SORT_LIMIT
+        bins = jobs.MEDIAN_HISTOGRAM_BINS
+        jobs.MEDIAN_SORT_LIMIT = 10
+        jobs.MEDIAN_HISTOGRAM_BINS = 4
+        try:
+            for event_count in (len(events), len(events) - 1):
+                def iter_chunks():
+                    chunks = events[:event_count].astype(np.float64)
+                    return (
+                        chunks[i:i + 64]
+                        for i in range(0, event_count, 64)
+                    )
+
+                count, minimums, maximums, means, stds = \
+                    jobs.get_channel_summaries(iter_chunks())
+                medians = jobs.get_channel_medians(
+                    iter_chunks,
+                    count,
+                    minimums,
+                    maximums
+                )
+
+                self.assertEqual(count, event_count)
+                self.assertStatisticsEqual(
+                    np.column_stack(
+                        [minimums, maximums, means, medians, stds]
+                    ),
+                    events[:event_count]
+                )
+        finally:
+            jobs.MEDIAN_SORT_LIMIT = sort_limit
+            jobs.MEDIAN_HISTOGRAM_BINS = bins
+
+    def test_channel_median_clustered_values(self):
+        """
+        The median of millions of events piled on two close values, with
+        one far outlier, is found without sorting more than the limit
+        """
+        events = np.concatenate(
+            [
+                np.full(1000000, 100.0),
+                np.full(1000000, np.nextafter(100.0, np.inf)),
+                [1e9]
+            ]
+        ).reshape(-1, 1)
+
+        def iter_chunks():
+            return (
+                events[i:i + jobs.STATISTICS_CHUNK_SIZE]
+                for i in range(0, len(events), jobs.STATISTICS_CHUNK_SIZE)
+            )
+
+        sorted_sizes = []
+        sort_rank = jobs._sort_rank
+
+        def record_sort_rank(columns, rank):
+            sorted_sizes.append(sum(len(column) for column in columns))
+            return sort_rank(columns, rank)
+
+        jobs._sort_rank = record_sort_rank
+        try:
+            medians = jobs.get_channel_medians(
+                iter_chunks,
+                len(events),
+                events.min(axis=0),
+                events.max(axis=0)
+            )
+        finally:
+            jobs._sort_rank = sort_rank
+
+        self.assertEqual(medians[0], np.median(events[:, 0]))
+        self.assertTrue(
+            all(size <= jobs.MEDIAN_SORT_LIMIT for size in sorted_sizes)
+        )
+
+    @override_settings(SAMPLE_JOB_MAX_ATTEMPTS=2)
+    def test_failed_job_retried(self):
+        """ Failed jobs are re-queued until they reach the max attempts """
+        sample = self.create_sample(self.build_events())
+        SampleJob.objects.filter(
+            sample=sample
+        ).exclude(job_type='statistics').update(status='Complete')
+
+        def fail(sample):
+            raise ValueError('Failed')
+
+        handler = jobs.SAMPLE_JOB_HANDLERS['statistics']
+        jobs.SAMPLE_JOB_HANDLERS['statistics'] = fail
+        try:
+            job = jobs.run_sample_job(jobs.claim_sample_job())
+            self.assertEqual(job.status, 'Pending')
+            self.assertEqual(job.status_message, 'Failed')
+            self.assertIsNone(job.start_date)
+            self.assertEqual(
+                Sample.objects.get(id=sample.id).processing_status,
+                'Working'
+            )
+
+            job = jobs.run_sample_job(jobs.claim_sample_job())
+            self.assertEqual(job.status, 'Error')
+            self.assertEqual(job.attempts, 2)
+            self.assertEqual(
+                Sample.objects.get(id=sample.id).processing_status,
+                'Error'
+            )
+            self.assertIsNone(jobs.claim_sample_job())
+        finally:
+            jobs.SAMPLE_JOB_HANDLERS['statistics'] = handler
+
+    @override_settings(SAMPLE_JOB_MAX_ATTEMPTS=2)
+    def test_reset_stale_sample_jobs(self):
+        """
+        Jobs left working are re-queued, unless they've used up their
+        attempts
+        """
+        sample = self.create_sample(self.build_events())
+        other_sample = self.create_sample(
+            self.build_events(seed=1),
+            'test_2.fcs'
+        )
+        started_before = datetime.datetime.now()
+        job = jobs.claim_sample_job()
+        other_job = jobs.claim_sample_job()
+        SampleJob.objects.filter(id=other_job.id).update(attempts=2)
+
+        self.assertEqual(jobs.reset_stale_sample_jobs(started_before), 0)
+
+        SampleJob.objects.update(
+            start_date=started_before - datetime.timedelta(hours=1)
+        )
+        self.assertEqual(
+            jobs.reset_stale_sample_jobs(started_before),
+            1
+        )
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'Pending')
+        self.assertIsNone(job.start_date)
+        self.assertEqual(
+            Sample.objects.get(id=sample.id).processing_status,
+            'Pending'
+        )
+        other_job.refresh_from_db()
+        self.assertEqual(other_job.status, 'Error')
+        self.assertEqual(
+            Sample.objects.get(id=other_sample.id).processing_status,
+            'Error'
+        )
+
+    def test_statistics_wait_for_event_store(self):
+        """ Statistics jobs aren't claimed until the event store is built """
+        sample = self.create_sample(self.build_events())
+        SampleJob.objects.filter(
+            sample=sample,
+            job_type='statistics'
+        ).update(created_date=datetime.datetime(2016, 1, 1))
+
+        job = jobs.claim_sample_job()
+        self.assertEqual(job.job_type, 'event_store')
+        self.assertIsNone(jobs.claim_sample_job())
+
+        jobs.run_sample_job(job)
+        job = jobs.claim_sample_job()
+        self.assertEqual(job.job_type, 'statistics')
+
+        jobs.run_sample_job(job)
+        self.assertEqual(
+            Sample.objects.get(id=sample.id).processing_status,
+            'Complete'
+        )
+
+    def test_build_event_stores(self):
+        """
+        Event store jobs are queued for samples without a store, & their
+        processing status updated
+        """
+        sample = self.create_sample(self.build_events())
+        call_command('process_sample_jobs', once=True, stdout=StringIO())
+        old_sample = self.create_sample(self.build_events(seed=1), 'old.fcs')
+        SampleJob.objects.filter(sample=old_sample).delete()
+        Sample.objects.filter(id=old_sample.id).update(processing_status=None)
+
+        output = StringIO()
+        call_command('build_event_stores', stdout=output)
+        self.assertIn('Queued 1 event store job(s)', output.getvalue())
+        self.assertEqual(
+            Sample.objects.get(id=old_sample.id).processing_status,
+            'Pending'
+        )
+
+        Sample.objects.filter(id=sample.id).update(event_store='')
+        SampleJob.objects.filter(sample=sample).update(attempts=3)
+        call_command('build_event_stores', stdout=output)
+        job = SampleJob.objects.get(sample=sample, job_type='event_store')
+        self.assertEqual(job.status, 'Pending')
+        self.assertEqual(job.attempts, 0)
+        self.assertEqual(
+            Sample.objects.get(id=sample.id).processing_status,
+            'Working'
+        )
+
+        call_command('process_sample_jobs', once=True, stdout=StringIO())
+        self.assertEqual(
+            set(Sample.objects.values_list('processing_status', flat=True)),
+            {'Complete'}
+        )
+        self.assertTrue(Sample.objects.get(id=old_sample.id).event_store)
+
+
+class RegisterSamplesUnitTestCase(SampleUnitTestCase):
+
+    def setUp(self):
+        super(RegisterSamplesUnitTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(RegisterSamplesUnitTestCase, self).tearDown()
+
+    def write_file(self, filename, content):
+        with open(os.path.join(self.directory, filename), 'wb') as f:
+            f.write(content)
+
+    def register_samples(self, rows):
+        manifest_path = os.path.join(self.directory, 'manifest.csv')
+        fields = ('filename',) + controllers.SAMPLE_ANNOTATION_FIELDS
+        with open(manifest_path, 'wb') as manifest_file:
+            writer = csv.DictWriter(manifest_file, fields)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(dict(self.sample_data, **row))
+
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command(
+            'register_samples',
+            self.directory,
+            manifest_path,
+            processes=1,
+            stdout=stdout,
+            stderr=stderr
+        )
+
+        return stdout.getvalue(), sorted(stderr.getvalue().splitlines())
+
+    def test_register_samples(self):
+        """
+        Valid files are registered once per project, the rest reported as
+        errors
+        """
+        content = build_fcs_content(self.build_events(), self.channel_names)
+        self.write_file('a.fcs', content)
+        self.write_file('a_copy.fcs', content)
+        self.write_file('b.fcs', build_fcs_content(
+            self.build_events(seed=1),
+            self.channel_names
+        ))
+        self.write_file('bad.fcs', 'not an FCS file')
+        existing_sample = self.create_sample(self.build_events(seed=2))
+        self.write_file('existing.fcs', build_fcs_content(
+            self.build_events(seed=2),
+            self.channel_names
+        ))
+
+        other_project = Project.objects.create(project_name='Project T')
+        other_panel_template = PanelTemplate.objects.create(
+            project=other_project,
+            panel_name='Panel T'
+        )
+        other_site_panel = self.create_site_panel(
+            other_panel_template,
+            Site.objects.create(project=other_project, site_name='T1')
+        )
+        other_sample_data = {
+            'subject': Subject.objects.create(
+                project=other_project,
+                subject_code='T001'
+            ).id,
+            'visit': VisitType.objects.create(
+                project=other_project,
+                visit_type_name='Visit T'
+            ).id,
+            'site_panel': other_site_panel.id,
+            'panel_variant': PanelVariant.objects.create(
+                panel_template=other_panel_template,
+                staining_type='FULL',
+                name=''
+            ).id
+        }
+
+        output, errors = self.register_samples(
+            [
+                {'filename': 'a.fcs'},
+                {'filename': 'a_copy.fcs'},
+                dict(other_sample_data, filename='a_copy.fcs'),
+                {'filename': 'b.fcs', 'subject': 'x'},
+                {'filename': 'b.fcs'},
+                {'filename': 'bad.fcs'},
+                {'filename': 'existing.fcs'}
+            ]
+        )
+
+        self.assertIn('Registered 3 sample(s), 4 error(s)', output)
+        self.assertEqual(len(errors), 4)
+        self.assertTrue(
+            errors[0].startswith('a_copy.fcs: File is a duplicate')
+        )
+        self.assertEqual(errors[1], 'b.fcs: Invalid subject: x')
+        self.assertTrue(errors[2].startswith('bad.fcs: '))
+        self.assertTrue(errors[3].startswith('existing.fcs: '))
+
+        samples = Sample.objects.exclude(id=existing_sample.id)
+        self.assertEqual(
+            sorted(
+                samples.values_list('original_filename', 'site_panel_id')
+            ),
+            [
+                ('a.fcs', self.site_panel.id),
+                ('a_copy.fcs', other_site_panel.id),
+                ('b.fcs', self.site_panel.id)
+            ]
+        )
+        for sample in samples:
+            with open(sample.sample_file.path, 'rb') as sample_file:
+                self.assertEqual(get_file_sha1(sample_file), sample.sha1)
+            self.assertEqual(sample.event_count, 100)
+            self.assertEqual(sample.processing_status, 'Pending')
+        self.assertTrue(
+            os.path.exists(os.path.join(self.directory, 'a.fcs'))
+        )
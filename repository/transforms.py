@@ -0,0 +1,124 @@
+"""
+Vectorized compensation & transforms for preprocessing sample events on
+the server. Each transform in TRANSFORMS takes a 2-D array of events and
+its parameters as keyword arguments, TRANSFORM_PARAMETERS lists the
+parameters with their defaults.
+"""
+
+import math
+
+import numpy as np
+
+# number of points in the logicle lookup grid, refined by Newton's method
+LOGICLE_GRID_SIZE = 4096
+
+
+def compensate(events, columns, spill):
+    """
+    Compensate the given columns of a 2-D events array in place, using the
+    spillover matrix for those columns (in the same order)
+    """
+    events[:, columns] = np.dot(
+        events[:, columns].astype(np.float64),
+        np.linalg.inv(spill)
+    )
+
+    return events
+
+
+def asinh(data, pre_scale):
+    """ Inverse hyperbolic sine of the data multiplied by pre_scale """
+    if pre_scale <= 0:
+        raise ValueError("pre_scale must be positive")
+
+    return np.arcsinh(data * pre_scale)
+
+
+class _LogicleScale(object):
+    """
+    The logicle scale (Parks, Roederer & Moore 2006) for parameters T, M, W
+    & A. Only the inverse (scale to data value) has a closed form, data
+    values are mapped to the scale by interpolating the inverse & refining
+    with Newton's method.
+    """
+
+    def __init__(self, t, m, w, a):
+        t, m, w, a = float(t), float(m), float(w), float(a)
+        if t <= 0 or m <= 0:
+            raise ValueError("t & m must be positive")
+        if not 0 <= w <= m / 2.0:
+            raise ValueError("w must be between 0 and m / 2")
+        if not 0 <= a <= m - 2 * w:
+            raise ValueError("a must be between 0 and m - 2w")
+
+        w = w / (m + a)
+        self.x1 = a / (m + a) + w
+        x0 = self.x1 + w
+        self.b = (m + a) * math.log(10)
+        self.d = self._solve_d(self.b, w)
+
+        c_a = math.exp(x0 * (self.b + self.d))
+        mf_a = math.exp(self.b * self.x1) - c_a / math.exp(self.d * self.x1)
+        self.a = t / ((math.exp(self.b) - mf_a) - c_a / math.exp(self.d))
+        self.c = c_a * self.a
+        self.f = -mf_a * self.a
+
+    @staticmethod
+    def _solve_d(b, w):
+        """ Solve 2 (ln d - ln b) + w (b + d) = 0 for d, by bisection """
+        if w == 0:
+            return b
+
+        d_low, d_high = 0.0, b
+        for i in range(100):
+            d = (d_low + d_high) / 2
+            if 2 * (math.log(d) - math.log(b)) + w * (b + d) < 0:
+                d_low = d
+            else:
+                d_high = d
+
+        return (d_low + d_high) / 2
+
+    def inverse(self, scale):
+        # the scale is symmetric about x1
+        negative = scale < self.x1
+        scale = np.where(negative, 2 * self.x1 - scale, scale)
+        values = self.a * np.exp(self.b * scale) + self.f - \
+            self.c * np.exp(-self.d * scale)
+
+        return np.where(negative, -values, values), \
+            self.a * self.b * np.exp(self.b * scale) + \
+            self.c * self.d * np.exp(-self.d * scale)
+
+    def scale(self, data):
+        data = np.asarray(data, dtype=np.float64)
+
+        grid = np.linspace(-1.0, 2.0, LOGICLE_GRID_SIZE)
+        grid_values = self.inverse(grid)[0]
+        scale = np.interp(data, grid_values, grid)
+
+        for i in range(3):
+            values, slopes = self.inverse(scale)
+            scale -= (values - data) / slopes
+
+        return scale
+
+
+def logicle(data, t, m, w, a):
+    """
+    Logicle transform of the data, where t is the top of the data range,
+    m the decades of the display, w the decades in the linear region & a
+    additional negative decades
+    """
+    return _LogicleScale(t, m, w, a).scale(data)
+
+
+TRANSFORMS = {
+    'asinh': asinh,
+    'logicle': logicle
+}
+
+TRANSFORM_PARAMETERS = {
+    'asinh': (('pre_scale', 0.003),),
+    'logicle': (('t', 262144.0), ('m', 4.5), ('w', 0.5), ('a', 0.0))
+}
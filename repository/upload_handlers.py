@@ -0,0 +1,129 @@
+from django.core.files import File
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+import os
+import tarfile
+import zipfile
+
+from repository.utils import FCSStreamReader, FCS_CHUNK_SIZE
+
+
+class FCSUploadHandler(TemporaryFileUploadHandler):
+    """
+    Spools uploads to FILE_UPLOAD_TEMP_DIR like TemporaryFileUploadHandler,
+    but also feeds every chunk through an FCSStreamReader as it arrives.
+    The finished reader is attached to the uploaded file as 'fcs_reader',
+    so the SHA-1, HEADER & TEXT are available without re-reading the file.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(FCSUploadHandler, self).new_file(*args, **kwargs)
+        self.fcs_reader = FCSStreamReader()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.fcs_reader.update(raw_data)
+        return super(FCSUploadHandler, self).receive_data_chunk(
+            raw_data,
+            start
+        )
+
+    def file_complete(self, file_size):
+        self.fcs_reader.finish()
+        uploaded_file = super(FCSUploadHandler, self).file_complete(file_size)
+        uploaded_file.fcs_reader = self.fcs_reader
+
+        return uploaded_file
+
+
+class StagedFile(File):
+    """
+    A complete file staged on the server's filesystem (e.g. a finished
+    SampleUpload). Providing temporary_file_path lets Django's storage
+    move the file into place instead of copying it.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def _extract_fcs_member(name, member_file, size):
+    """
+    Copy an archive member to a temporary uploaded file, feeding it through
+    an FCSStreamReader on the way, same as the FCSUploadHandler does.
+    """
+    fcs_file = TemporaryUploadedFile(
+        os.path.basename(name),
+        'application/octet-stream',
+        size,
+        None
+    )
+    fcs_reader = FCSStreamReader()
+
+    while True:
+        chunk = member_file.read(FCS_CHUNK_SIZE)
+        if not chunk:
+            break
+        fcs_reader.update(chunk)
+        fcs_file.write(chunk)
+
+    fcs_reader.finish()
+    fcs_file.seek(0)
+    fcs_file.fcs_reader = fcs_reader
+
+    return fcs_file
+
+
+def add_fcs_file(fcs_files, fcs_file):
+    """
+    Add an uploaded file to the dictionary of files keyed by file name. A
+    file name already in the dictionary is ambiguous, so both files are
+    closed & the name maps to None.
+    """
+    if fcs_file.name in fcs_files:
+        if fcs_files[fcs_file.name] is not None:
+            fcs_files[fcs_file.name].close()
+        fcs_file.close()
+        fcs_files[fcs_file.name] = None
+    else:
+        fcs_files[fcs_file.name] = fcs_file
+
+
+def extract_fcs_archive(archive):
+    """
+    Extract the files in a tar (optionally compressed) or zip archive,
+    returning a dictionary of temporary uploaded files keyed by file name.
+    Directories within the archive are ignored, so a file name found more
+    than once in the archive maps to None (see add_fcs_file).
+    """
+    fcs_files = {}
+
+    archive.seek(0)
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        zip_archive = zipfile.ZipFile(archive)
+        for info in zip_archive.infolist():
+            if info.filename.endswith('/'):
+                continue
+            member_file = zip_archive.open(info)
+            fcs_file = _extract_fcs_member(
+                info.filename,
+                member_file,
+                info.file_size
+            )
+            member_file.close()
+            add_fcs_file(fcs_files, fcs_file)
+        zip_archive.close()
+    else:
+        archive.seek(0)
+        tar_archive = tarfile.open(fileobj=archive, mode='r:*')
+        for info in tar_archive:
+            if not info.isfile():
+                continue
+            member_file = tar_archive.extractfile(info)
+            fcs_file = _extract_fcs_member(info.name, member_file, info.size)
+            member_file.close()
+            add_fcs_file(fcs_files, fcs_file)
+        tar_archive.close()
+
+    return fcs_files
@@ -51,6 +51,7 @@ urlpatterns = [
     url(r'^api/repository/sites/(?P<site>\d+)/permissions/?$', get_site_permissions, name='get-site-permissions'),
     url(r'^api/repository/site_panels/?$', SitePanelList.as_view(), name='site-panel-list'),
     url(r'^api/repository/site_panels/(?P<pk>\d+)/?$', SitePanelDetail.as_view(), name='site-panel-detail'),
+    url(r'^api/repository/site_panels/matching/?$', find_matching_site_panels, name='find-matching-site-panels'),
 
     url(r'^api/repository/subject_groups/?$', SubjectGroupList.as_view(), name='subject-group-list'),
     url(r'^api/repository/subject_groups/(?P<pk>\d+)/?$', SubjectGroupDetail.as_view(), name='subject-group-detail'),
@@ -65,18 +66,33 @@ urlpatterns = [
 
     url(r'^api/repository/samples/?$', SampleList.as_view(), name='sample-list'),
     url(r'^api/repository/samples/add/?$', CreateSample.as_view(), name='create-sample'),
+    url(r'^api/repository/samples/add_batch/?$', CreateSampleBatch.as_view(), name='create-sample-batch'),
+    url(r'^api/repository/samples/existing/?$', find_existing_samples, name='find-existing-samples'),
+    url(r'^api/repository/samples/compensations/?$', find_sample_compensations, name='find_sample_compensations'),
     url(r'^api/repository/samples/(?P<pk>\d+)/?$', SampleDetail.as_view(), name='sample-detail'),
     url(r'^api/repository/samples/(?P<pk>\d+)/fcs_original/?$', retrieve_sample, name='retrieve_sample'),
     url(r'^api/repository/samples/(?P<pk>\d+)/fcs/?$', retrieve_sample_as_pk, name='sample-download-as-pk'),
     url(r'^api/repository/samples/(?P<pk>\d+)/fcs_clean/?$', retrieve_clean_sample, name='retrieve_clean_sample'),
+    url(r'^api/repository/samples/(?P<pk>\d+)/metadata/?$', retrieve_sample_metadata, name='retrieve_sample_metadata'),
+    url(r'^api/repository/samples/(?P<pk>\d+)/statistics/?$', retrieve_sample_statistics, name='retrieve_sample_statistics'),
+    url(r'^api/repository/samples/(?P<pk>\d+)/events/?$', retrieve_sample_events, name='retrieve_sample_events'),
+    url(r'^api/repository/samples/(?P<pk>\d+)/subsample/?$', retrieve_sample_subsample, name='retrieve_sample_subsample'),
+    url(r'^api/repository/samples/(?P<pk>\d+)/preprocessed/?$', retrieve_preprocessed_sample, name='retrieve_preprocessed_sample'),
+
+    url(r'^api/repository/sample_uploads/?$', SampleUploadList.as_view(), name='sample-upload-list'),
+    url(r'^api/repository/sample_uploads/(?P<pk>\d+)/?$', SampleUploadDetail.as_view(), name='sample-upload-detail'),
+    url(r'^api/repository/sample_uploads/(?P<pk>\d+)/finalize/?$', finalize_sample_upload, name='finalize-sample-upload'),
 
     url(r'^api/repository/samplemetadata/?$', SampleMetaDataList.as_view(), name='sample-metadata-list'),
 
     url(r'^api/repository/sample_collections/?$', SampleCollectionList.as_view(), name='sample-collection-list'),
     url(r'^api/repository/sample_collections/(?P<pk>\d+)/?$', SampleCollectionDetail.as_view(), name='sample-collection-detail'),
+    url(r'^api/repository/sample_collections/(?P<pk>\d+)/archive/?$', retrieve_sample_collection_archive, name='retrieve_sample_collection_archive'),
     url(r'^api/repository/sample_collection_members/?$', SampleCollectionMemberList.as_view(), name='sample-collection-member-list'),
 
     url(r'^api/repository/compensations/?$', CompensationList.as_view(), name='compensation-list'),
+    url(r'^api/repository/compensations/bulk/?$', create_compensations, name='create_compensations'),
+    url(r'^api/repository/compensations/extract_spill/?$', extract_spill_compensations, name='extract_spill_compensations'),
     url(r'^api/repository/compensations/(?P<pk>\d+)/?$', CompensationDetail.as_view(), name='compensation-detail'),
     url(r'^api/repository/compensations/(?P<pk>\d+)/csv/?$', retrieve_compensation_as_csv, name='retrieve_compensation_as_csv'),
     url(r'^api/repository/compensations/(?P<pk>\d+)/object/?$', retrieve_compensation_as_csv_object, name='retrieve_compensation_as_csv_object'),
@@ -1,10 +1,24 @@
 from django.core.exceptions import ValidationError
 
+from cStringIO import StringIO
+import hashlib
 import re
 
+import numpy as np
+
+# FCS HEADER is 6 bytes of version, 4 spaces, then 6 8-byte offsets
+FCS_HEADER_SIZE = 58
+
+# read size used when streaming FCS files
+FCS_CHUNK_SIZE = 65536
+
 
 def parse_fcs_text(text):
-    """return key/value pairs from a delimited string"""
+    """
+    Return key/value pairs from a delimited FCS TEXT segment. Keys are
+    lowercase without the leading '$'. A doubled delimiter within a key
+    or value is an escaped delimiter.
+    """
     delimiter = text[0]
 
     if delimiter != text[-1]:
@@ -12,20 +26,635 @@ def parse_fcs_text(text):
             "text in segment does not start and end with delimiter"
         )
 
-    if delimiter == r'|':
-        delimiter = '\|'
-    elif delimiter == r'\a'[0]:  # test for delimiter being \
-        delimiter = '\\\\'  # regex will require it to be \\
+    text = text[1:-1]
+    fields = text.split(delimiter)
+
+    # escaped delimiters split into empty fields, re-join them with their
+    # neighbors in a single pass (most segments don't have any)
+    if delimiter + delimiter in text:
+        field_count = len(fields)
+        joined_fields = []
+        i = 0
+        while i < field_count:
+            field = fields[i]
+            i += 1
+            while i < field_count - 1 and fields[i] == '':
+                field += delimiter + fields[i + 1]
+                i += 2
+            joined_fields.append(field)
+        fields = joined_fields
 
-    tmp = text[1:-1].replace('$', '')
-    # match the delimited character unless it's doubled
-    regex = re.compile('(?<=[^%s])%s(?!%s)' % (
-        delimiter, delimiter, delimiter))
-    tmp = regex.split(tmp)
     return dict(
         zip(
-            [x.lower().replace(
-                delimiter + delimiter, delimiter) for x in tmp[::2]],
-            [x.replace(delimiter + delimiter, delimiter) for x in tmp[1::2]]
+            [
+                k[1:].lower() if k.startswith('$') else k.lower()
+                for k in fields[::2]
+            ],
+            fields[1::2]
+        )
+    )
+
+
+def parse_fcs_header(header):
+    """
+    Return the version and segment offsets found in the 58 byte FCS HEADER.
+    Offsets left blank in the HEADER (e.g. no ANALYSIS segment) are 0.
+    """
+    if len(header) < FCS_HEADER_SIZE or not header.startswith('FCS'):
+        raise ValidationError("FCS HEADER segment not found")
+
+    offsets = []
+    for start in range(10, FCS_HEADER_SIZE, 8):
+        value = header[start:start + 8].strip()
+        try:
+            offsets.append(int(value) if value else 0)
+        except ValueError:
+            raise ValidationError("FCS HEADER contains an invalid offset")
+
+    header_dict = {
+        'version': header[0:6],
+        'text_start': offsets[0],
+        'text_end': offsets[1],
+        'data_start': offsets[2],
+        'data_end': offsets[3],
+        'analysis_start': offsets[4],
+        'analysis_end': offsets[5]
+    }
+
+    if header_dict['text_start'] < FCS_HEADER_SIZE or \
+            header_dict['text_end'] <= header_dict['text_start']:
+        raise ValidationError("FCS HEADER contains invalid TEXT offsets")
+
+    return header_dict
+
+
+class FCSStreamReader(object):
+    """
+    Consumes an FCS file as a series of chunks, in order, doing everything
+    ingest needs from the raw bytes in a single pass:
+        - calculates the SHA-1 of the whole file
+        - parses the HEADER and TEXT segments as soon as they have arrived
+        - locates the DATA segment and counts the total bytes received
+
+    Keywords from a supplemental TEXT segment are merged into the metadata,
+    without replacing any from the primary TEXT segment.
+
+    Only the bytes up to the end of the TEXT segment (and the supplemental
+    TEXT segment) are ever buffered. After the last chunk call finish(),
+    then check error before using the parsed header & metadata.
+    """
+
+    def __init__(self):
+        self.file_hash = hashlib.sha1()
+        self.size = 0
+        self.header = None
+        self.metadata = None
+        self.data_start = None
+        self.data_end = None
+        self.error = None
+        self._prefix = []
+        self._prefix_size = 0
+        self._stext_range = None
+        self._stext_chunks = []
+
+    def _get_sha1(self):
+        return self.file_hash.hexdigest()
+
+    sha1 = property(_get_sha1)
+
+    def update(self, chunk):
+        offset = self.size
+        self.file_hash.update(chunk)
+        self.size += len(chunk)
+
+        if self.error is not None:
+            return
+
+        if self.metadata is None:
+            self._prefix.append(chunk)
+            self._prefix_size += len(chunk)
+            self._parse_prefix()
+        elif self._stext_range is not None:
+            self._capture_stext(chunk, offset)
+
+    def finish(self):
+        if self.error is None:
+            if self.metadata is None:
+                self.error = "File ended before the FCS TEXT segment"
+            elif self._stext_range is not None:
+                self.error = "File ended before the FCS supplemental TEXT"
+        self._prefix = []
+        self._stext_chunks = []
+
+    def _capture_stext(self, data, offset):
+        """
+        Keep the part of data (starting at offset in the file) within the
+        supplemental TEXT segment, parsing the segment once it is complete
+        """
+        stext_start, stext_end = self._stext_range
+        capture_start = max(stext_start, offset)
+        capture_end = min(stext_end + 1, offset + len(data))
+        if capture_start < capture_end:
+            self._stext_chunks.append(
+                data[capture_start - offset:capture_end - offset]
+            )
+
+        if offset + len(data) <= stext_end:
+            return
+
+        self._stext_range = None
+        try:
+            supplemental = parse_fcs_text(''.join(self._stext_chunks))
+        except Exception:
+            self.error = "FCS supplemental TEXT segment could not be parsed"
+            return
+        finally:
+            self._stext_chunks = []
+
+        for key, value in supplemental.items():
+            self.metadata.setdefault(key, value)
+
+    def _parse_prefix(self):
+        if self.header is None:
+            if self._prefix_size < FCS_HEADER_SIZE:
+                return
+
+            prefix = ''.join(self._prefix)
+            self._prefix = [prefix]
+
+            try:
+                self.header = parse_fcs_header(prefix[:FCS_HEADER_SIZE])
+            except ValidationError as e:
+                self.error = e.messages[0]
+                self._prefix = []
+                return
+
+        if self._prefix_size <= self.header['text_end']:
+            return
+
+        prefix = ''.join(self._prefix)
+        self._prefix = []
+
+        try:
+            self.metadata = parse_fcs_text(
+                prefix[self.header['text_start']:self.header['text_end'] + 1]
+            )
+        except Exception:
+            self.error = "FCS TEXT segment could not be parsed"
+            return
+
+        # files with a DATA segment past 99,999,999 bytes have 0 offsets
+        # in the HEADER, the real offsets are in the TEXT segment
+        self.data_start = self.header['data_start']
+        self.data_end = self.header['data_end']
+        try:
+            if self.data_start == 0:
+                self.data_start = int(self.metadata['begindata'])
+            if self.data_end == 0:
+                self.data_end = int(self.metadata['enddata'])
+        except (KeyError, ValueError):
+            self.error = "FCS DATA segment offsets not found"
+            return
+
+        try:
+            stext_start = int(self.metadata.get('beginstext', 0))
+            stext_end = int(self.metadata.get('endstext', 0))
+        except ValueError:
+            self.error = "FCS supplemental TEXT offsets are invalid"
+            return
+
+        if stext_start > 0 and stext_end > stext_start:
+            self._stext_range = (stext_start, stext_end)
+            self._capture_stext(prefix, 0)
+
+
+def read_fcs_file(fcs_file):
+    """
+    Stream an already stored file through an FCSStreamReader, returning
+    the finished reader.
+    """
+    fcs_reader = FCSStreamReader()
+    fcs_file.seek(0)
+
+    while True:
+        chunk = fcs_file.read(FCS_CHUNK_SIZE)
+        if not chunk:
+            break
+        fcs_reader.update(chunk)
+
+    fcs_reader.finish()
+
+    return fcs_reader
+
+
+def build_fcs_text(keywords, delimiter='/'):
+    """
+    Returns a delimited FCS TEXT segment for a list of (keyword, value)
+    pairs. Standard keywords must include their leading '$'. Delimiters
+    within values are doubled, and pairs with empty values are left out
+    since FCS doesn't allow zero-length values.
+    """
+    text = [delimiter]
+    for key, value in keywords:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = str(value)
+        if value == '':
+            continue
+        text.extend(
+            [
+                key.replace(delimiter, delimiter * 2),
+                delimiter,
+                value.replace(delimiter, delimiter * 2),
+                delimiter
+            ]
+        )
+
+    return ''.join(text)
+
+
+def copy_file_segment(source_file, destination_file, start, length):
+    """
+    Copy length bytes of source_file, beginning at offset start, to the
+    current position of destination_file in fixed size chunks
+    """
+    source_file.seek(start)
+    while length > 0:
+        chunk = source_file.read(min(FCS_CHUNK_SIZE, length))
+        if not chunk:
+            raise IOError("Unexpected end of file copying FCS segment")
+        destination_file.write(chunk)
+        length -= len(chunk)
+
+
+def write_spliced_fcs(fcs_file, keywords, source_file, data_start, data_end):
+    """
+    Write an FCS 3.1 file with a new TEXT segment built from keywords (see
+    build_fcs_text), followed by the DATA segment copied byte for byte
+    from source_file (the inclusive data_start/data_end offsets). The
+    keywords must describe the DATA as it is in the source file ($PAR,
+    $TOT, $DATATYPE, $BYTEORD, $PnB, etc.), $BEGINDATA & $ENDDATA are
+    added here.
+    """
+    text_start = 256
+    data_size = data_end - data_start + 1
+
+    # the DATA offsets are part of the TEXT, so they affect its own length
+    new_data_start = new_data_end = 0
+    while True:
+        text = build_fcs_text(
+            keywords + [
+                ('$BEGINDATA', str(new_data_start)),
+                ('$ENDDATA', str(new_data_end))
+            ]
+        )
+        text_end = text_start + len(text) - 1
+        if (new_data_start, new_data_end) == \
+                (text_end + 1, text_end + data_size):
+            break
+        new_data_start, new_data_end = text_end + 1, text_end + data_size
+
+    # offsets too large for the HEADER are 0, they're only in the TEXT
+    header_offsets = [text_start, text_end]
+    if new_data_end <= 99999999:
+        header_offsets.extend([new_data_start, new_data_end])
+    else:
+        header_offsets.extend([0, 0])
+    header_offsets.extend([0, 0])
+
+    fcs_file.seek(0)
+    fcs_file.write('FCS3.1    ')
+    fcs_file.write(''.join(['%8d' % offset for offset in header_offsets]))
+    fcs_file.write(' ' * (text_start - FCS_HEADER_SIZE))
+    fcs_file.write(text)
+    copy_file_segment(source_file, fcs_file, data_start, data_size)
+
+
+def get_fcs_event_count(fcs_reader):
+    """
+    Returns the event count ($TOT) from a finished FCSStreamReader after
+    verifying the DATA segment is the size $TOT, $PAR, $DATATYPE & $PnB
+    say it should be, and is within the file. No events are decoded.
+    Raises ValidationError if the DATA segment is truncated or malformed.
+
+    ASCII ($DATATYPE 'A') DATA can't be sized from the TEXT alone, only
+    the offsets are checked. A single extra trailing byte is allowed, as
+    some cytometers write $ENDDATA one past the last byte.
+    """
+    metadata = fcs_reader.metadata
+
+    try:
+        event_count = int(metadata['tot'])
+        channel_count = int(metadata['par'])
+    except (KeyError, ValueError):
+        raise ValidationError(
+            "FCS file does not report its event & parameter counts"
+        )
+
+    if fcs_reader.data_start < FCS_HEADER_SIZE or \
+            fcs_reader.data_end < fcs_reader.data_start - 1:
+        raise ValidationError("FCS DATA segment offsets are invalid")
+
+    data_type = metadata.get('datatype', '').upper()
+    if data_type == 'F':
+        event_bits = 32 * channel_count
+    elif data_type == 'D':
+        event_bits = 64 * channel_count
+    elif data_type == 'I':
+        try:
+            event_bits = sum(
+                int(metadata['p%db' % n]) for n in range(1, channel_count + 1)
+            )
+        except (KeyError, ValueError):
+            raise ValidationError(
+                "FCS file has missing or invalid parameter bit widths (PnB)"
+            )
+    elif data_type == 'A':
+        if fcs_reader.data_end > fcs_reader.size:
+            raise ValidationError(
+                "FCS file is truncated, the DATA segment ends past the file end"
+            )
+        return event_count
+    else:
+        raise ValidationError("FCS file has an unsupported DATATYPE")
+
+    expected_size = (event_count * event_bits + 7) // 8
+    data_size = fcs_reader.data_end - fcs_reader.data_start + 1
+
+    if data_size not in (expected_size, expected_size + 1):
+        raise ValidationError(
+            "FCS DATA segment is %d bytes, expected %d bytes for %d events" %
+            (data_size, expected_size, event_count)
+        )
+
+    # only the expected bytes must be in the file, the extra byte of an
+    # $ENDDATA one past the end may not be
+    if fcs_reader.data_start + expected_size > fcs_reader.size:
+        raise ValidationError(
+            "FCS file is truncated, the DATA segment ends past the file end"
         )
+
+    return event_count
+
+
+def get_fcs_event_dtype(metadata):
+    """
+    Returns a numpy structured dtype for one event of an FCS DATA segment,
+    with a field per channel named 'p1', 'p2', etc. Raises ValidationError
+    for ASCII DATA or an unsupported byte order or bit width.
+    """
+    try:
+        byte_order = [
+            int(b) for b in metadata.get('byteord', '').split(',')
+        ]
+        channel_count = int(metadata['par'])
+    except (KeyError, ValueError):
+        raise ValidationError("Invalid FCS byte order or parameter count")
+
+    if byte_order == sorted(byte_order):
+        endian = '<'
+    elif byte_order == sorted(byte_order, reverse=True):
+        endian = '>'
+    else:
+        raise ValidationError("Unsupported FCS byte order")
+
+    data_type = metadata.get('datatype', '').upper()
+    fields = []
+    for n in range(1, channel_count + 1):
+        if data_type == 'F':
+            field_type = 'f4'
+        elif data_type == 'D':
+            field_type = 'f8'
+        elif data_type == 'I':
+            bit_width = metadata.get('p%db' % n)
+            if bit_width not in ('8', '16', '32', '64'):
+                raise ValidationError(
+                    "Unsupported FCS bit width for channel %d" % n
+                )
+            field_type = 'u%d' % (int(bit_width) // 8)
+        else:
+            raise ValidationError("Unsupported FCS DATATYPE")
+
+        fields.append(('p%d' % n, endian + field_type))
+
+    return np.dtype(fields)
+
+
+def get_fcs_channel_bitmask(metadata, n):
+    """
+    Returns the bit mask for integer channel n, the unused high bits of
+    values with a $PnR less than the $PnB range are to be ignored. None is
+    returned when no mask is needed.
+    """
+    if metadata.get('datatype', '').upper() != 'I':
+        return None
+
+    bit_width = int(metadata['p%db' % n])
+    try:
+        value_range = int(float(metadata['p%dr' % n]))
+    except (KeyError, ValueError):
+        return None
+
+    if value_range <= 0 or value_range >= 2 ** bit_width:
+        return None
+
+    # smallest all ones mask covering the range
+    return (1 << (value_range - 1).bit_length()) - 1
+
+
+def get_subsample_indices(event_count, subsample_count, seed):
+    """
+    Returns a sorted array of subsample_count unique event indices, chosen
+    at random from range(event_count). The same seed always gives the
+    same indices. Memory use is proportional to the subsample, not the
+    event count, unless the subsample is a large fraction of the events.
+    """
+    random_state = np.random.RandomState(seed)
+    subsample_count = min(subsample_count, event_count)
+
+    if subsample_count * 4 >= event_count:
+        return np.sort(
+            random_state.permutation(event_count)[:subsample_count]
+        )
+
+    indices = np.empty(0, dtype=np.int64)
+    while len(indices) < subsample_count:
+        indices = np.union1d(
+            indices,
+            random_state.randint(
+                0,
+                event_count,
+                size=subsample_count - len(indices)
+            )
+        )
+
+    return indices
+
+
+def write_npy_chunks(npy_file, shape, chunks):
+    """
+    Write a little-endian float32 .npy file of the given 2-D shape from an
+    iterable of arrays holding consecutive rows
+    """
+    np.lib.format.write_array_header_1_0(
+        npy_file,
+        {'descr': '<f4', 'fortran_order': False, 'shape': tuple(shape)}
     )
+    for chunk in chunks:
+        chunk.astype('<f4').tofile(npy_file)
+
+
+def get_file_sha1(file_obj):
+    """ Returns the SHA-1 hex digest of a file's content, read in chunks """
+    file_hash = hashlib.sha1()
+    file_obj.seek(0)
+    while True:
+        chunk = file_obj.read(FCS_CHUNK_SIZE)
+        if not chunk:
+            break
+        file_hash.update(chunk)
+    file_obj.seek(0)
+
+    return file_hash.hexdigest()
+
+
+def get_fcs_channels(metadata):
+    """
+    Returns a list of (channel number, PnN, PnS) tuples for the
+    parameters listed in parsed FCS TEXT metadata. Missing values are None.
+    """
+    channels = []
+    for n in range(1, int(metadata['par']) + 1):
+        channels.append(
+            (n, metadata.get('p%dn' % n), metadata.get('p%ds' % n))
+        )
+
+    return channels
+
+
+def get_fcs_channel_signature(channels):
+    """
+    Returns a SHA-1 hex digest identifying an ordered set of channels,
+    given as (channel number, PnN, PnS) tuples. Channels from an FCS file
+    and from a SitePanel have the same signature if their PnN & PnS
+    values match, with a missing PnS equivalent to an empty one.
+    """
+    signature = hashlib.sha1()
+    for number, pnn, pns in sorted(channels):
+        for value in (str(number), pnn or '', pns or ''):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            signature.update(value)
+            signature.update('\x1f')
+        signature.update('\x1e')
+
+    return signature.hexdigest()
+
+
+def merge_byte_ranges(byte_ranges):
+    """
+    Merge a list of inclusive [start, end] byte ranges, combining any that
+    overlap or are adjacent. Returns a sorted list of [start, end] ranges.
+    """
+    merged = []
+    for start, end in sorted(byte_ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+def parse_compensation_matrix(matrix_text, channel_numbers):
+    """
+    Parse & validate compensation matrix text: a header row of PnN values
+    then a row per channel, tab or comma delimited (spaces can't be
+    delimiters b/c they are allowed in the PnN value). channel_numbers
+    maps the PnN of every channel to compensate to its fcs_number.
+
+    Returns a numpy array of the fcs_numbers (in header order) followed
+    by the matrix rows, the format saved in a compensation_file. Raises
+    ValidationError if the matrix is invalid.
+    """
+    lines = matrix_text.splitlines(False)
+    if not len(lines) > 1:
+        raise ValidationError("Too few rows.")
+
+    headers = re.split('\t|,\s*', lines[0])
+
+    missing_fields = [
+        pnn for pnn in sorted(channel_numbers, key=channel_numbers.get)
+        if pnn not in set(headers)
+    ]
+    if len(missing_fields) > 0:
+        raise ValidationError(
+            "Missing fields: %s" % ", ".join(missing_fields))
+
+    if len(headers) > len(channel_numbers):
+        raise ValidationError("Too many parameters: " + ",".join(headers))
+
+    # the header of matrix text adds a row
+    if len(lines) > len(channel_numbers) + 1:
+        raise ValidationError("Too many rows")
+    elif len(lines) < len(channel_numbers) + 1:
+        raise ValidationError("Too few rows")
+
+    rows = [re.split('\t|,', line) for line in lines[1:]]
+    for line, row in zip(lines[1:], rows):
+        if len(row) > len(headers):
+            raise ValidationError("Too many values in line: %s" % line)
+        elif len(row) < len(headers):
+            raise ValidationError("Too few values in line: %s" % line)
+
+    try:
+        matrix = np.array(rows, dtype=np.float64)
+    except ValueError:
+        for value in [value for row in rows for value in row]:
+            try:
+                float(value)
+            except ValueError:
+                raise ValidationError("%s is an invalid matrix value" % value)
+        raise
+
+    # the channel numbers are stored in the first row, more reliable to
+    # identify parameters than some concatenation of parameter attributes
+    return np.vstack([[channel_numbers[pnn] for pnn in headers], matrix])
+
+
+def parse_fcs_spill(spill):
+    """
+    Returns the channel names (PnN values) & the spillover matrix from
+    an FCS $SPILL / $SPILLOVER value: the channel count, the names, then
+    the matrix values row by row. Raises ValueError if it's malformed.
+    """
+    values = [value.strip() for value in spill.split(',')]
+    channel_count = int(values[0])
+    if channel_count < 1 or \
+            len(values) != 1 + channel_count + channel_count ** 2:
+        raise ValueError("Invalid spillover")
+
+    matrix = np.array(values[channel_count + 1:], dtype=np.float64)
+
+    return (
+        values[1:channel_count + 1],
+        matrix.reshape(channel_count, channel_count)
+    )
+
+
+def format_compensation_csv(np_array):
+    """
+    Returns CSV text of a compensation array (see
+    parse_compensation_matrix), a header of channel numbers then the rows
+    """
+    csv_string = StringIO()
+    csv_string.write(','.join(["%d" % n for n in np_array[0]]) + '\n')
+
+    np.savetxt(
+        csv_string,
+        np_array[1:, :],
+        fmt='%f',
+        delimiter=','
+    )
+
+    return csv_string.getvalue()
@@ -551,10 +551,8 @@ app.controller(
                 $modalInstance.close();
             };
 
-            $scope.metadata = ModelService.getSampleMetadata(
-                {
-                    'sample': $scope.instance.id
-                }
+            $scope.metadata = ModelService.getAllSampleMetadata(
+                $scope.instance.id
             );
         }
     ]
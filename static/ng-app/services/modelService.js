@@ -570,6 +570,13 @@ service.factory('ModelService', function(
     service.getSampleMetadata = function (query_object) {
         return SampleMetadata.query(query_object);
     };
+    service.getAllSampleMetadata = function (sample_id) {
+        return Sample.get_metadata(
+            {
+                'id': sample_id
+            }
+        );
+    };
 
     // Compensation related services
     service.compensationsUpdated = function () {
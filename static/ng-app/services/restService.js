@@ -307,7 +307,11 @@ service
             URLS.SAMPLES + ':id',
             {},
             {
-                update: { method: 'PUT' }
+                update: { method: 'PUT' },
+                get_metadata: {
+                    url: URLS.SAMPLES + ':id/metadata/',
+                    isArray: true
+                }
             }
         );
 